@@ -0,0 +1,53 @@
+""" Compares the in-process FDR engine with FSL's `fdr` binary.
+
+    python benchmarks/bench_fdr.py [n_maps]
+
+The subprocess path is only timed when `fdr` is on the PATH.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import subprocess
+
+from fixtures import has_executable, make_p_maps, make_tempdir
+from gilles_workflows.stats import fdr_adjust_images
+
+
+def time_numpy(p_files, mask_file, directory):
+    out_files = [os.path.join(directory, 'numpy_adjusted%d.nii.gz' % i) for i in range(len(p_files))]
+    t0 = time.time()
+    fdr_adjust_images(p_files, mask_file, out_files)
+    return time.time() - t0
+
+
+def time_subprocess(p_files, mask_file, directory):
+    t0 = time.time()
+    for i, p_file in enumerate(p_files):
+        subprocess.check_call(['fdr', '-i', p_file, '-m', mask_file, '-q', '0.05',
+                               '-a', os.path.join(directory, 'fsl_adjusted%d.nii.gz' % i)],
+                              stdout=open(os.devnull, 'w'))
+    return time.time() - t0
+
+
+def main(n_maps=4):
+    has_fdr = has_executable('fdr')
+
+    print('%-6s %6s %12s %12s' % ('grid', 'maps', 'numpy (s)', 'fdr (s)'))
+    for resolution in ['2mm', '1mm']:
+        directory = make_tempdir()
+        mask_file, p_files, _ = make_p_maps(resolution, n_maps, directory)
+
+        numpy_time = time_numpy(p_files, mask_file, directory)
+
+        if has_fdr:
+            fsl_time = '%12.2f' % time_subprocess(p_files, mask_file, directory)
+        else:
+            fsl_time = '%12s' % 'n/a'
+
+        print('%-6s %6d %12.2f %s' % (resolution, n_maps, numpy_time, fsl_time))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,101 @@
+""" Speed and accuracy of the in-process GLM against FILMGLS on a
+simulated run with AR(1) noise and a known activation.
+
+    python benchmarks/bench_glm.py [n_volumes] [resolution]
+
+FILM is only run when film_gls is on the PATH. Accuracy is reported as
+the correlation of each engine's z-map with FILM's, the mean z inside the
+activation and the fraction of voxels outside it above z = 3.1.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import numpy as np
+import nibabel as nb
+
+from fixtures import (get_shape, make_brain_mask, make_bfsl_files, make_tempdir,
+                      make_z_map, has_executable, save)
+from gilles_workflows import design as design_module
+from gilles_workflows.glm import fit_run
+
+TR = 2.
+
+
+def make_run(resolution, n_volumes, directory, rho=0.3, effect=10., seed=0):
+    """ (in_file, design_file, tcon_file, active) for a run with an effect
+    of the first condition where the blob map exceeds 2. """
+    shape = get_shape(resolution)
+    rs = np.random.RandomState(seed)
+
+    event_files = make_bfsl_files(2, 15, n_volumes * TR, directory, seed)
+    design, names, real_columns = design_module.level1_design(event_files, n_volumes, TR,
+                                                              cache_dir=directory)
+    contrasts = [('first', 'T', [names[real_columns[0]]], [1]),
+                 ('difference', 'T', [names[c] for c in real_columns], [1, -1])]
+
+    design_file = design_module.write_design_mat(design, os.path.join(directory, 'design.mat'))
+    tcon_file = design_module.write_design_con(contrasts,
+                                               design_module.contrast_matrix(contrasts, names, real_columns),
+                                               os.path.join(directory, 'design.con'))
+
+    brain = make_brain_mask(shape)
+    active = (make_z_map(shape, brain, seed=seed) > 2) & brain
+
+    noise = np.empty(shape + (n_volumes,), dtype=np.float32)
+    noise[..., 0] = rs.randn(*shape)
+    for t in range(1, n_volumes):
+        noise[..., t] = rho * noise[..., t - 1] + np.sqrt(1 - rho ** 2) * rs.randn(*shape)
+
+    data = 1000. * brain[..., np.newaxis] + 20 * noise
+    data[active] += effect * design[:, real_columns[0]] / design[:, real_columns[0]].std()
+
+    in_file = save(data.astype(np.float32), os.path.join(directory, 'run.nii.gz'), resolution)
+
+    return in_file, design_file, tcon_file, active
+
+
+def time_numpy(in_file, design_file, tcon_file, directory, prewhiten):
+    t0 = time.time()
+    outputs = fit_run(in_file, design_file, tcon_file,
+                      os.path.join(directory, 'numpy_%s' % ('ar1' if prewhiten else 'ols')),
+                      prewhiten=prewhiten)
+    return time.time() - t0, outputs['zstats'][0]
+
+
+def time_film(in_file, design_file, tcon_file, directory):
+    from nipype.interfaces.fsl import FILMGLS
+
+    t0 = time.time()
+    result = FILMGLS(in_file=in_file, design_file=design_file, tcon_file=tcon_file,
+                     threshold=1000, results_dir=os.path.join(directory, 'film')).run()
+    zstats = result.outputs.zstats
+    return time.time() - t0, zstats[0] if isinstance(zstats, list) else zstats
+
+
+def main(n_volumes=200, resolution='2mm'):
+    directory = make_tempdir()
+    in_file, design_file, tcon_file, active = make_run(resolution, int(n_volumes), directory)
+
+    results = [('numpy OLS',) + time_numpy(in_file, design_file, tcon_file, directory, False),
+               ('numpy AR(1)',) + time_numpy(in_file, design_file, tcon_file, directory, True)]
+
+    if has_executable('film_gls'):
+        results.append(('FILM',) + time_film(in_file, design_file, tcon_file, directory))
+        film = nb.load(results[-1][2]).get_data()
+    else:
+        film = None
+
+    print('%-12s %10s %12s %10s %10s' % ('engine', 'time (s)', 'r with FILM', 'mean z', 'FPR'))
+    for name, seconds, zstat in results:
+        z = nb.load(zstat).get_data()
+        inside = z != 0
+        r = np.corrcoef(z[inside], film[inside])[0, 1] if film is not None else np.nan
+        fpr = (z[inside & ~active] > 3.1).mean()
+        print('%-12s %10.2f %12.4f %10.2f %10.4f' % (name, seconds, r, z[active].mean(), fpr))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,59 @@
+""" Time to `import gilles_workflows` in a fresh interpreter, as paid by
+every MapNode worker and util.Function subprocess.
+
+    python benchmarks/bench_import.py [repeat]
+
+Compares the lazy package import with importing every workflow module
+eagerly (what the package used to do) and with the light stats module a
+Function node typically needs.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import subprocess
+
+
+STATEMENTS = [
+    ('lazy package', 'import gilles_workflows'),
+    ('stats only', 'import gilles_workflows.stats'),
+    ('eager (all modules)', 'import gilles_workflows.registration, gilles_workflows.extract_rois, '
+                            'gilles_workflows.model, gilles_workflows.utils'),
+]
+
+REPORT = ("import sys; print(len(sys.modules), "
+          "any(m.startswith('nipype.interfaces.ants') for m in sys.modules))")
+
+
+def time_import(statement, repeat=5):
+    """ Minimum wall time of `statement` over `repeat` fresh interpreters,
+    the number of modules loaded, and whether nipype's ANTs interfaces got
+    imported. """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                         env.get('PYTHONPATH', '')])
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        output = subprocess.check_output([sys.executable, '-c', '%s; %s' % (statement, REPORT)],
+                                         env=env)
+        times.append(time.time() - t0)
+
+    n_modules, ants_loaded = output.decode().split()
+    return min(times), int(n_modules), ants_loaded == 'True'
+
+
+def main(repeat=5):
+    baseline, _, _ = time_import('pass', repeat)
+
+    print('%-22s %10s %8s %6s' % ('import', 'time (s)', 'modules', 'ants'))
+    for name, statement in STATEMENTS:
+        seconds, n_modules, ants_loaded = time_import(statement, repeat)
+        print('%-22s %10.3f %8d %6s' % (name, seconds - baseline, n_modules,
+                                        'yes' if ants_loaded else 'no'))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,40 @@
+""" Cost of updating the incremental group model: from scratch, after
+adding one subject, and with an unchanged subject list.
+
+    python benchmarks/bench_incremental.py [n_subjects] [resolution]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import numpy as np
+
+from fixtures import get_shape, make_p_maps, make_tempdir, save
+from gilles_workflows.group import IncrementalGroupModel
+
+
+def main(n_subjects=50, resolution='2mm'):
+    n_subjects = int(n_subjects)
+    directory = make_tempdir()
+
+    mask, copes, _ = make_p_maps(resolution, n_subjects + 1, directory)
+    rs = np.random.RandomState(0)
+    varcopes = [save(rs.uniform(0.5, 1.5, get_shape(resolution)).astype(np.float32),
+                     os.path.join(directory, 'varcope%d.nii.gz' % i), resolution)
+                for i in range(n_subjects + 1)]
+
+    model = IncrementalGroupModel(os.path.join(directory, 'state'))
+
+    print('%-24s %10s %10s' % ('update', 'time (s)', 'new'))
+    for name, n in [('%d subjects' % n_subjects, n_subjects),
+                    ('add one subject', n_subjects + 1),
+                    ('unchanged', n_subjects + 1)]:
+        t0 = time.time()
+        _, n_new = model.update(copes[:n], varcopes[:n], mask)
+        print('%-24s %10.2f %10d' % (name, time.time() - t0, n_new))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
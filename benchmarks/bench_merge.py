@@ -0,0 +1,47 @@
+""" Time and disk footprint of merging subject maps into a 4D stack:
+gzipped with fslmerge versus uncompressed through a memory map.
+
+    python benchmarks/bench_merge.py [n_subjects] [resolution]
+
+fslmerge is only timed when it is on the PATH.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+from fixtures import has_executable, make_p_maps, make_tempdir
+from gilles_workflows.group import merge_images
+
+
+def time_fslmerge(in_files, directory):
+    from nipype.interfaces import fsl
+
+    t0 = time.time()
+    result = fsl.Merge(in_files=in_files, dimension='t', output_type='NIFTI_GZ',
+                       merged_file=os.path.join(directory, 'merged.nii.gz')).run()
+    return time.time() - t0, os.path.getsize(result.outputs.merged_file)
+
+
+def time_scratch(in_files, directory):
+    t0 = time.time()
+    merged_file = merge_images(in_files, os.path.join(directory, 'merged.nii'))
+    return time.time() - t0, os.path.getsize(merged_file)
+
+
+def main(n_subjects=50, resolution='2mm'):
+    directory = make_tempdir()
+    _, _, z_files = make_p_maps(resolution, int(n_subjects), directory)
+
+    results = [('scratch',) + time_scratch(z_files, directory)]
+    if has_executable('fslmerge'):
+        results.append(('fslmerge',) + time_fslmerge(z_files, directory))
+
+    print('%-10s %10s %10s' % ('merge', 'time (s)', 'size (MB)'))
+    for name, seconds, size in results:
+        print('%-10s %10.2f %10.1f' % (name, seconds, size / 1024. ** 2))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
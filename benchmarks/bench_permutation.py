@@ -0,0 +1,49 @@
+""" Sign-flip permutations per second against the number of threads.
+
+    python benchmarks/bench_permutation.py [n_subjects] [n_permutations] [resolution]
+
+Every run uses the same seed, so the corrected maps are checked to be
+identical across thread counts.
+"""
+from __future__ import print_function
+
+import sys
+import time
+import multiprocessing
+
+import numpy as np
+import nibabel as nb
+
+from fixtures import make_p_maps, make_tempdir
+from gilles_workflows.stats import load_mask
+from gilles_workflows.permutation import permutation_test
+
+
+def main(n_subjects=16, n_permutations=1000, resolution='2mm'):
+    directory = make_tempdir()
+    mask_file, _, z_files = make_p_maps(resolution, int(n_subjects), directory)
+
+    mask = load_mask(mask_file)
+    data = np.array([nb.load(fn).get_data()[mask] for fn in z_files], dtype=np.float64)
+
+    n_cpus = multiprocessing.cpu_count()
+    n_procs_list = sorted(set([1, 2, 4, 8, n_cpus]) & set(range(1, n_cpus + 1)))
+
+    reference = None
+
+    print('%-8s %10s %12s %10s' % ('threads', 'time (s)', 'perms/s', 'identical'))
+    for n_procs in n_procs_list:
+        t0 = time.time()
+        t, vox_corrp, clusterm_corrp, n_done = permutation_test(data, mask, int(n_permutations),
+                                                                n_procs=n_procs)
+        seconds = time.time() - t0
+
+        if reference is None:
+            reference = vox_corrp, clusterm_corrp
+        identical = np.array_equal(reference[0], vox_corrp) and np.array_equal(reference[1], clusterm_corrp)
+
+        print('%-8d %10.2f %12.1f %10s' % (n_procs, seconds, n_done / seconds, identical))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,72 @@
+""" Wall time and similarity of the ANTs registration presets on a
+synthetic phantom pair.
+
+    python benchmarks/bench_registration_presets.py [size] [out.csv]
+
+Needs antsRegistration on the PATH. Every run uses an empty result cache,
+so no timing is a cache hit.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import csv
+import time
+
+from fixtures import correlation, has_executable, make_phantom_pair, make_tempdir
+from gilles_workflows.registration import create_registration_node
+
+
+def run_preset(fixed, moving, preset, warm_start_transform=None):
+    directory = make_tempdir()
+    cwd = os.getcwd()
+    os.chdir(directory)
+
+    try:
+        reg = create_registration_node(preset=preset,
+                                       warm_start=warm_start_transform is not None).interface
+        reg.inputs.fixed_image = fixed
+        reg.inputs.moving_image = moving
+        reg.inputs.cache_dir = os.path.join(directory, 'cache')
+
+        if warm_start_transform is not None:
+            reg.inputs.initial_moving_transform = warm_start_transform
+
+        t0 = time.time()
+        result = reg.run()
+        wall_time = time.time() - t0
+    finally:
+        os.chdir(cwd)
+
+    outputs = result.outputs
+    return wall_time, correlation(fixed, outputs.warped_image), outputs.composite_transform
+
+
+def main(size=64, out_file='registration_presets.csv'):
+    if not has_executable('antsRegistration'):
+        print('antsRegistration not found, skipping')
+        return
+
+    fixed, moving = make_phantom_pair((size, size, size))
+    rows = [('preset', 'warm_start', 'wall_time_s', 'correlation')]
+
+    print('%-10s %-10s %12s %12s' % rows[0])
+    print('%-10s %-10s %12s %.4f' % ('none', '', '', correlation(fixed, moving)))
+
+    transforms = {}
+    for preset in ['draft', 'standard', 'full']:
+        wall_time, similarity, transforms[preset] = run_preset(fixed, moving, preset)
+        rows.append((preset, False, wall_time, similarity))
+        print('%-10s %-10s %12.1f %12.4f' % rows[-1])
+
+    wall_time, similarity, _ = run_preset(fixed, moving, 'full', transforms['draft'])
+    rows.append(('full', 'draft', wall_time, similarity))
+    print('%-10s %-10s %12.1f %12.4f' % rows[-1])
+
+    with open(out_file, 'w') as f:
+        csv.writer(f).writerows(rows)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*([int(args[0])] + args[1:] if args else []))
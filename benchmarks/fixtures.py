@@ -0,0 +1,281 @@
+""" Synthetic NIfTI fixtures for the benchmarks. """
+import os
+import tempfile
+
+import numpy as np
+import nibabel as nb
+
+# MNI152 grid sizes
+SHAPES = {'2mm': (91, 109, 91),
+          '1mm': (182, 218, 182)}
+
+VOXEL_SIZES = {'2mm': 2.,
+               '1mm': 1.}
+
+
+def has_executable(name):
+    return any(os.access(os.path.join(path, name), os.X_OK)
+               for path in os.environ.get('PATH', '').split(os.pathsep))
+
+
+def get_shape(resolution):
+    if resolution in SHAPES:
+        return SHAPES[resolution]
+    return tuple(resolution)
+
+
+def affine_for(resolution):
+    return np.diag([VOXEL_SIZES.get(resolution, 1.)] * 3 + [1.])
+
+
+def make_brain_mask(shape):
+    """ Ellipsoid filling most of the field of view, roughly as many
+    voxels as an MNI brain mask. """
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    r = sum(((g - (s - 1) / 2.) / (0.45 * s)) ** 2 for g, s in zip(grid, shape))
+    return r <= 1
+
+
+def make_z_map(shape, mask=None, n_blobs=5, seed=0):
+    rs = np.random.RandomState(seed)
+    z = rs.randn(*shape)
+
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    for _ in range(n_blobs):
+        center = [rs.uniform(0.3, 0.7) * s for s in shape]
+        r2 = sum((g - c) ** 2 for g, c in zip(grid, center))
+        z += 4 * np.exp(-r2 / (2 * (0.03 * min(shape)) ** 2))
+
+    if mask is not None:
+        z[~mask] = 0
+
+    return z.astype(np.float32)
+
+
+def save(data, fn, resolution='2mm'):
+    nb.save(nb.Nifti1Image(data, affine_for(resolution)), fn)
+    return fn
+
+
+def make_tempdir(prefix='gilles_workflows_bench_'):
+    return tempfile.mkdtemp(prefix=prefix)
+
+
+def make_p_maps(resolution='2mm', n_maps=1, directory=None):
+    """ Writes a brain mask and `n_maps` p-value maps, returns
+    (mask_file, p_files, z_files). """
+    from scipy.stats import norm
+
+    if directory is None:
+        directory = make_tempdir()
+
+    shape = get_shape(resolution)
+    mask = make_brain_mask(shape)
+    mask_file = save(mask.astype(np.uint8), os.path.join(directory, 'mask.nii.gz'), resolution)
+
+    p_files, z_files = [], []
+    for i in range(n_maps):
+        z = make_z_map(shape, mask, seed=i)
+        z_files.append(save(z, os.path.join(directory, 'zstat%d.nii.gz' % (i + 1)), resolution))
+        p = norm.sf(z).astype(np.float32)
+        p[~mask] = 1
+        p_files.append(save(p, os.path.join(directory, 'zstat%d_pval.nii.gz' % (i + 1)), resolution))
+
+    return mask_file, p_files, z_files
+
+
+def make_phantom(shape, seed=0):
+    """ Head-like phantom: an ellipsoid 'brain' with a brighter 'white
+    matter' core and a few smooth blobs as landmarks. """
+    rs = np.random.RandomState(seed)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+
+    def ellipsoid(radii, center=None):
+        if center is None:
+            center = [(s - 1) / 2. for s in shape]
+        return sum(((g - c) / r) ** 2 for g, c, r in zip(grid, center, radii))
+
+    phantom = 100. * (ellipsoid([0.42 * s for s in shape]) <= 1)
+    phantom += 50. * (ellipsoid([0.25 * s for s in shape]) <= 1)
+
+    for _ in range(6):
+        center = [rs.uniform(0.3, 0.7) * s for s in shape]
+        phantom += 40. * np.exp(-ellipsoid([0.06 * s for s in shape], center))
+
+    return phantom.astype(np.float32)
+
+
+def make_phantom_pair(resolution=(64, 64, 64), directory=None, seed=0):
+    """ Writes a fixed phantom and a moving copy that is rotated, shifted
+    and smoothly deformed. Returns (fixed_file, moving_file). """
+    from scipy import ndimage
+
+    if directory is None:
+        directory = make_tempdir()
+
+    shape = get_shape(resolution)
+    fixed = make_phantom(shape, seed)
+
+    rs = np.random.RandomState(seed + 1)
+    angle = np.deg2rad(8)
+    rotation = np.array([[np.cos(angle), -np.sin(angle), 0],
+                         [np.sin(angle), np.cos(angle), 0],
+                         [0, 0, 1]])
+    center = (np.array(shape) - 1) / 2.
+    offset = center - rotation.dot(center) + [2, -3, 1]
+
+    coords = np.indices(shape).reshape(3, -1).astype(float)
+    coords = rotation.dot(coords) + offset[:, np.newaxis]
+
+    for axis in range(3):
+        field = ndimage.gaussian_filter(rs.randn(*shape), 0.1 * min(shape))
+        coords[axis] += 2 * field.ravel() / np.abs(field).max()
+
+    moving = ndimage.map_coordinates(fixed, coords, order=1).reshape(shape)
+
+    fixed_file = save(fixed, os.path.join(directory, 'fixed.nii.gz'), resolution)
+    moving_file = save(moving.astype(np.float32), os.path.join(directory, 'moving.nii.gz'), resolution)
+
+    return fixed_file, moving_file
+
+
+def correlation(a_file, b_file, mask=None):
+    a = nb.load(a_file).get_data().ravel()
+    b = nb.load(b_file).get_data().ravel()
+    if mask is None:
+        mask = (a != 0) | (b != 0)
+    else:
+        mask = mask.ravel()
+    return np.corrcoef(a[mask], b[mask])[0, 1]
+
+
+def make_epi(resolution='2mm', n_volumes=100, directory=None, seed=0, fn='epi.nii.gz'):
+    """ 4D EPI-like run: a brain-shaped baseline with noise. """
+    if directory is None:
+        directory = make_tempdir()
+
+    shape = get_shape(resolution)
+    rs = np.random.RandomState(seed)
+    baseline = 1000. * make_brain_mask(shape)
+
+    data = np.empty(shape + (n_volumes,), dtype=np.float32)
+    for t in range(n_volumes):
+        data[..., t] = baseline + 20 * rs.randn(*shape)
+
+    return save(data, os.path.join(directory, fn), resolution)
+
+
+def make_roi_masks(resolution='2mm', n_rois=1, directory=None, seed=0):
+    """ Spherical ROIs inside the brain mask, one file each. """
+    if directory is None:
+        directory = make_tempdir()
+
+    shape = get_shape(resolution)
+    rs = np.random.RandomState(seed)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+
+    masks = []
+    for i in range(n_rois):
+        center = [rs.uniform(0.3, 0.7) * s for s in shape]
+        r2 = sum((g - c) ** 2 for g, c in zip(grid, center))
+        mask = (r2 <= (0.08 * min(shape)) ** 2).astype(np.float32)
+        masks.append(save(mask, os.path.join(directory, 'roi%d.nii.gz' % i), resolution))
+
+    return masks
+
+
+def make_bfsl_files(n_conditions=3, n_events=20, run_length=300., directory=None, seed=0):
+    """ FSL 3-column (onset, duration, weight) event files, one per
+    condition. """
+    if directory is None:
+        directory = make_tempdir()
+
+    rs = np.random.RandomState(seed)
+    files = []
+
+    for condition in range(n_conditions):
+        onsets = np.sort(rs.uniform(0, run_length - 10, n_events))
+        events = np.column_stack([onsets, np.ones(n_events), np.ones(n_events)])
+        fn = os.path.join(directory, 'condition%d.txt' % condition)
+        np.savetxt(fn, events, fmt='%.3f')
+        files.append(fn)
+
+    return files
+
+
+# Stand-ins for the FSL and ANTs binaries. They read their input image and
+# write it back out, which keeps process startup and NIfTI I/O in the
+# timings.
+_STUB_HEADER = '''#!%s
+import sys
+import nibabel as nb
+
+args = sys.argv[1:]
+
+def option(*flags):
+    for flag in flags:
+        if flag in args:
+            value = args[args.index(flag) + 1]
+            if value == '[':
+                value = args[args.index(flag) + 2]
+            return value.strip('[],')
+    return None
+
+def copy(in_file, out_file):
+    image = nb.load(in_file)
+    nb.save(nb.Nifti1Image(image.get_data(), image.affine), out_file)
+'''
+
+STUBS = {
+    'fdr': '''
+if option('-a'):
+    copy(option('-i'), option('-a'))
+print('Probability Threshold is:')
+print('0.001')
+''',
+    'fslmaths': '''
+positional = [arg for arg in args if not arg.startswith('-')]
+if '-odt' in args:
+    positional.remove(args[args.index('-odt') + 1])
+copy(args[0], positional[-1])
+''',
+    'antsApplyTransforms': '''
+copy(option('-i', '--input'), option('-o', '--output'))
+''',
+}
+
+
+def install_stubs(directory=None):
+    """ Writes the stub binaries to `directory` (a new temporary directory
+    by default) and returns it, for prepending to PATH. """
+    import sys
+    import stat
+
+    if directory is None:
+        directory = make_tempdir('gilles_workflows_stubs_')
+
+    for name, body in STUBS.items():
+        fn = os.path.join(directory, name)
+        with open(fn, 'w') as f:
+            f.write(_STUB_HEADER % sys.executable + body)
+        os.chmod(fn, os.stat(fn).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    return directory
+
+
+def make_fake_fsldir(directory=None):
+    """ Just enough of an FSL installation for the workflow factories:
+    the BBR schedule and the MNI template they refer to. """
+    if directory is None:
+        directory = make_tempdir('gilles_workflows_fsldir_')
+
+    for path in ['etc/flirtsch', 'data/standard']:
+        if not os.path.isdir(os.path.join(directory, path)):
+            os.makedirs(os.path.join(directory, path))
+
+    open(os.path.join(directory, 'etc/flirtsch/bbr.sch'), 'w').close()
+
+    template = make_phantom(SHAPES['2mm'])
+    save(template, os.path.join(directory, 'data/standard/MNI152_T1_2mm_brain.nii.gz'))
+
+    return directory
@@ -0,0 +1,424 @@
+""" Benchmark suite for the pure-Python stages and the workflow factories.
+
+    python benchmarks/run.py [--size small|medium|large] [--repeat N] [--only NAME ...]
+    python benchmarks/run.py compare OLD.json NEW.json [--threshold 0.1]
+
+Results are stored as benchmarks/results/<commit>-<size>.json. By default
+the fdr, fslmaths and antsApplyTransforms binaries are replaced by stubs
+(see fixtures.STUBS) and FSLDIR points to a minimal fake installation, so
+the suite runs without FSL or ANTs.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+
+import fixtures
+
+
+SIZES = {'small': {'resolution': (40, 48, 40), 'n_volumes': 50, 'n_maps': 2, 'n_runs': 4,
+                   'n_subjects': 10},
+         'medium': {'resolution': '2mm', 'n_volumes': 100, 'n_maps': 4, 'n_runs': 8,
+                    'n_subjects': 40},
+         'large': {'resolution': '2mm', 'n_volumes': 300, 'n_maps': 8, 'n_runs': 16,
+                   'n_subjects': 100}}
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """ Registers a benchmark. It is called with the size parameters and a
+    scratch directory, does its setup, and returns the callable to time. """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+@benchmark('get_weighted_mean')
+def bench_get_weighted_mean(size, directory):
+    from gilles_workflows.roi import save_roi_weights, extract_roi_weights
+
+    epi = fixtures.make_epi(size['resolution'], size['n_volumes'], directory)
+    # The second sphere stands in for a gray matter map
+    roi, gray_matter = fixtures.make_roi_masks(size['resolution'], 2, directory)
+
+    def run():
+        roi_weights = save_roi_weights(roi, os.path.join(directory, 'roi_weights.npz'),
+                                       gray_matter=gray_matter)
+        extract_roi_weights(epi, roi_weights)
+
+    return run
+
+
+@benchmark('transpose_copes')
+def bench_transpose_copes(size, directory):
+    from gilles_workflows.model import transpose_copes
+
+    copes = [['/data/run%d/cope%d.nii.gz' % (run, contrast) for contrast in range(10)]
+             for run in range(size['n_runs'])]
+
+    def run():
+        for _ in range(1000):
+            transpose_copes(copes)
+
+    return run
+
+
+@benchmark('highpass_cutoff')
+def bench_highpass_cutoff(size, directory):
+    from gilles_workflows.model import get_highpas_filter_cutoff
+
+    def run():
+        for _ in range(100000):
+            get_highpas_filter_cutoff(128, 2.0)
+
+    return run
+
+
+@benchmark('level1_design')
+def bench_level1_design(size, directory):
+    from gilles_workflows import design
+
+    event_files = fixtures.make_bfsl_files(run_length=size['n_volumes'] * 2., directory=directory)
+
+    def run():
+        # Every run after the first reuses the HRF basis and filter matrix
+        design._COMPONENTS.clear()
+        for _ in range(size['n_runs']):
+            design.level1_design(event_files, size['n_volumes'], 2., cache_dir=directory)
+
+    return run
+
+
+@benchmark('glm_numpy')
+def bench_glm_numpy(size, directory):
+    from bench_glm import make_run
+    from gilles_workflows.glm import fit_run
+
+    in_file, design_file, tcon_file, _ = make_run(size['resolution'], size['n_volumes'], directory)
+
+    return lambda: fit_run(in_file, design_file, tcon_file, os.path.join(directory, 'glm'))
+
+
+@benchmark('fixedfx_numpy')
+def bench_fixedfx_numpy(size, directory):
+    from gilles_workflows.group import fixed_effects_images
+
+    mask, copes, _ = fixtures.make_p_maps(size['resolution'], size['n_runs'], directory)
+    varcope = fixtures.save(np.ones(fixtures.get_shape(size['resolution']), dtype=np.float32),
+                            os.path.join(directory, 'varcope.nii.gz'), size['resolution'])
+    dof_file = os.path.join(directory, 'dof')
+    np.savetxt(dof_file, [100], fmt='%d')
+
+    return lambda: fixed_effects_images([copes], [[varcope] * len(copes)], [dof_file] * len(copes),
+                                        mask, directory)
+
+
+@benchmark('merge_scratch')
+def bench_merge_scratch(size, directory):
+    from gilles_workflows.group import merge_images
+
+    _, _, z_files = fixtures.make_p_maps(size['resolution'], size['n_runs'], directory)
+
+    return lambda: merge_images(z_files, os.path.join(directory, 'merged.nii'))
+
+
+@benchmark('cluster_numpy')
+def bench_cluster_numpy(size, directory):
+    from gilles_workflows.cluster import cluster_image
+
+    _, _, z_files = fixtures.make_p_maps(size['resolution'], 1, directory)
+
+    # A fresh cache every call, so the clustering is timed rather than
+    # the cache lookup
+    def run():
+        cluster_image(z_files[0], [2.0, 2.3, 3.1], out_dir=directory,
+                      cache_dir=fixtures.make_tempdir())
+
+    return run
+
+
+@benchmark('fdr_numpy')
+def bench_fdr_numpy(size, directory):
+    from gilles_workflows.stats import fdr_adjust_images
+
+    mask, p_files, _ = fixtures.make_p_maps(size['resolution'], size['n_maps'], directory)
+    out_files = [os.path.join(directory, 'adjusted%d.nii.gz' % i) for i in range(len(p_files))]
+
+    return lambda: fdr_adjust_images(p_files, mask, out_files)
+
+
+@benchmark('fdr_fused_from_z')
+def bench_fdr_fused(size, directory):
+    from gilles_workflows.stats import fdr_threshold_images
+
+    mask, _, z_files = fixtures.make_p_maps(size['resolution'], size['n_maps'], directory)
+    thresholded = [os.path.join(directory, 'thresholded%d.nii.gz' % i) for i in range(len(z_files))]
+    adjusted = [os.path.join(directory, 'adjusted%d.nii.gz' % i) for i in range(len(z_files))]
+
+    return lambda: fdr_threshold_images(z_files, None, mask, thresholded, adjusted)
+
+
+@benchmark('fdr_subprocess')
+def bench_fdr_subprocess(size, directory):
+    from gilles_workflows.interfaces import FDR
+
+    mask, p_files, _ = fixtures.make_p_maps(size['resolution'], size['n_maps'], directory)
+
+    def run():
+        for i, p_file in enumerate(p_files):
+            FDR(p_values=p_file, mask=mask,
+                adjusted_p_values=os.path.join(directory, 'fsl_adjusted%d.nii.gz' % i)).run()
+
+    return run
+
+
+@benchmark('ztop_subprocess')
+def bench_ztop_subprocess(size, directory):
+    from nipype.interfaces import fsl
+
+    _, _, z_files = fixtures.make_p_maps(size['resolution'], size['n_maps'], directory)
+
+    def run():
+        for i, z_file in enumerate(z_files):
+            fsl.ImageMaths(in_file=z_file, op_string='-ztop',
+                           out_file=os.path.join(directory, 'pval%d.nii.gz' % i)).run()
+
+    return run
+
+
+@benchmark('apply_transforms_per_image')
+def bench_apply_transforms(size, directory):
+    from nipype.interfaces import ants
+
+    _, _, z_files = fixtures.make_p_maps(size['resolution'], size['n_maps'], directory)
+    transform = os.path.join(directory, 'identity.txt')
+    np.savetxt(transform, np.eye(4))
+
+    def run():
+        for i, z_file in enumerate(z_files):
+            ants.ApplyTransforms(input_image=z_file, reference_image=z_files[0],
+                                 transforms=[transform],
+                                 output_image=os.path.join(directory, 'trans%d.nii.gz' % i)).run()
+
+    return run
+
+
+@benchmark('import_package')
+def bench_import_package(size, directory):
+    from bench_import import time_import
+
+    return lambda: time_import('import gilles_workflows', repeat=1)
+
+
+def _factory_benchmark(name, factory, **kwargs):
+
+    @benchmark(name)
+    def bench(size, directory):
+        def run():
+            workflow = factory(**kwargs)
+            workflow._create_flat_graph()
+        return run
+
+    return bench
+
+
+def _fanout(factory, n_subjects, base_dir, **kwargs):
+    """ The workflow from `factory`, with its first inputspec field
+    iterated over `n_subjects` values as a per-subject fan-out. """
+    workflow = factory(**kwargs)
+    workflow.base_dir = base_dir
+
+    inputspec = workflow.get_node('inputspec')
+    field = sorted(inputspec.inputs.copyable_trait_names())[0]
+    inputspec.iterables = (field, ['sub-%03d' % i for i in range(n_subjects)])
+
+    return workflow
+
+
+def _graph_benchmarks(name, factory, **kwargs):
+    """ expand_<name>, flattening and expanding a per-subject fan-out as
+    Workflow.run does, next to load_<name>, loading the same execution
+    graph from graphs.load_expanded_graph. The workflow is built (and
+    for load_<name> the graph stored) before timing. """
+
+    @benchmark('expand_' + name)
+    def bench_expand(size, directory):
+        from gilles_workflows.graphs import expanded_graph
+
+        workflow = _fanout(factory, size['n_subjects'], directory, **kwargs)
+        return lambda: expanded_graph(workflow)
+
+    @benchmark('load_' + name)
+    def bench_load(size, directory):
+        from gilles_workflows.graphs import load_expanded_graph
+
+        workflow = _fanout(factory, size['n_subjects'], directory, **kwargs)
+        graph_dir = os.path.join(directory, 'graphs')
+        load_expanded_graph(workflow, graph_dir)
+
+        def run():
+            _, loaded = load_expanded_graph(workflow, graph_dir)
+            assert loaded
+        return run
+
+    return bench_expand, bench_load
+
+
+def _register_factories():
+    from gilles_workflows import (create_fsl_ants_registration_workflow,
+                                  create_extract_mni_roi_workflow,
+                                  create_modelfit_workflow_bfsl,
+                                  create_random_effects_workflow,
+                                  create_permutation_workflow,
+                                  create_fdr_threshold_workflow)
+
+    _factory_benchmark('build_fsl_ants_registration', create_fsl_ants_registration_workflow)
+    _factory_benchmark('build_extract_mni_roi', create_extract_mni_roi_workflow)
+    _factory_benchmark('build_extract_mni_roi_multi', create_extract_mni_roi_workflow, multi_roi=True)
+    _factory_benchmark('build_modelfit_bfsl', create_modelfit_workflow_bfsl)
+    _factory_benchmark('build_modelfit_bfsl_shared_design', create_modelfit_workflow_bfsl,
+                       shared_design=True)
+    _factory_benchmark('build_modelfit_bfsl_numpy_glm', create_modelfit_workflow_bfsl,
+                       glm_engine='numpy')
+    _factory_benchmark('build_modelfit_bfsl_numpy', create_modelfit_workflow_bfsl,
+                       glm_engine='numpy', fixedfx_engine='numpy')
+    _factory_benchmark('build_random_effects', create_random_effects_workflow)
+    _factory_benchmark('build_random_effects_scratch', create_random_effects_workflow, merge='scratch')
+    _factory_benchmark('build_random_effects_chunked', create_random_effects_workflow, flame_chunks=8)
+    _factory_benchmark('build_random_effects_numpy_cluster', create_random_effects_workflow,
+                       cluster_engine='numpy')
+    _factory_benchmark('build_permutation', create_permutation_workflow)
+    _graph_benchmarks('modelfit_bfsl', create_modelfit_workflow_bfsl)
+    _graph_benchmarks('random_effects', create_random_effects_workflow)
+    _factory_benchmark('build_fdr_threshold', create_fdr_threshold_workflow)
+
+
+def time_benchmark(function, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        function()
+        times.append(time.time() - t0)
+    return {'min': min(times), 'median': float(np.median(times)), 'repeat': repeat}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def setup_environment(use_stubs=True):
+    if use_stubs:
+        os.environ['PATH'] = fixtures.install_stubs() + os.pathsep + os.environ.get('PATH', '')
+        if not os.environ.get('FSLDIR'):
+            os.environ['FSLDIR'] = fixtures.make_fake_fsldir()
+    os.environ.setdefault('FSLOUTPUTTYPE', 'NIFTI_GZ')
+
+
+def run_suite(size_name='small', repeat=3, only=None, use_stubs=True, out_file=None):
+    setup_environment(use_stubs)
+    _register_factories()
+
+    size = SIZES[size_name]
+    results = OrderedDict()
+
+    for name, setup in BENCHMARKS.items():
+        if only and name not in only:
+            continue
+
+        directory = fixtures.make_tempdir()
+        cwd = os.getcwd()
+        os.chdir(directory)
+
+        try:
+            results[name] = time_benchmark(setup(size, directory), repeat)
+            print('%-32s %10.4f s (min) %10.4f s (median)' % (name, results[name]['min'],
+                                                              results[name]['median']))
+        except Exception as e:
+            print('%-32s failed: %s' % (name, e))
+        finally:
+            os.chdir(cwd)
+
+    report = {'commit': git_commit(),
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'size': size_name,
+              'stubs': use_stubs,
+              'results': results}
+
+    if out_file is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        out_file = os.path.join(RESULTS_DIR, '%s-%s.json' % (report['commit'], size_name))
+
+    with open(out_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('Wrote %s' % out_file)
+    return report
+
+
+def compare(old_file, new_file, threshold=0.1):
+    """ Prints the change in median time per benchmark and returns the
+    names that got more than `threshold` slower. """
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+
+    print('%-32s %10s %10s %8s' % ('benchmark', old['commit'], new['commit'], 'ratio'))
+
+    regressions = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+
+        ratio = result['median'] / old['results'][name]['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+
+        print('%-32s %10.4f %10.4f %8.2f%s' % (name, old['results'][name]['median'],
+                                               result['median'], ratio, flag))
+
+    return regressions
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv and argv[0] == 'compare':
+        parser = argparse.ArgumentParser(description='Compare two benchmark results')
+        parser.add_argument('old')
+        parser.add_argument('new')
+        parser.add_argument('--threshold', type=float, default=0.1)
+        args = parser.parse_args(argv[1:])
+        sys.exit(1 if compare(args.old, args.new, args.threshold) else 0)
+
+    parser = argparse.ArgumentParser(description='Run the benchmark suite')
+    parser.add_argument('--size', default='small', choices=sorted(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='*', default=None)
+    parser.add_argument('--no-stubs', dest='use_stubs', action='store_false')
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args(argv)
+
+    run_suite(args.size, args.repeat, args.only, args.use_stubs, args.out)
+
+
+if __name__ == '__main__':
+    main()
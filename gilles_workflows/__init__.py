@@ -1,7 +1,63 @@
-from registration import create_fsl_ants_registration_workflow
-from extract_rois import create_extract_mni_roi_workflow
-from utils import show_workflow
-from interfaces import FDR
-from model import create_fdr_threshold_workflow, create_modelfit_workflow_bfsl, create_random_effects_workflow
+""" Workflows are imported on first use: the submodules pull in the ANTs,
+FSL and C3 interfaces and nipype's FSL workflows, which nodes running
+`gilles_workflows.stats` or `gilles_workflows.roi` never need. """
+import sys
+import types
+import importlib
 
-#from . import extract_rois
+
+# Public name -> submodule it lives in
+_LAZY_ATTRIBUTES = {
+    'create_fsl_ants_registration_workflow': 'registration',
+    'create_extract_mni_roi_workflow': 'extract_rois',
+    'show_workflow': 'utils',
+    'FDR': 'interfaces',
+    'NumpyFDR': 'interfaces',
+    'FDRThreshold': 'interfaces',
+    'CachedFAST': 'interfaces',
+    'CachedRegistration': 'interfaces',
+    'BatchApplyTransforms': 'interfaces',
+    'SharedLevel1Design': 'interfaces',
+    'BatchFILMGLS': 'interfaces',
+    'NumpyGLM': 'interfaces',
+    'NumpyFixedEffects': 'interfaces',
+    'ScratchMerge': 'interfaces',
+    'ChunkedFLAMEO': 'interfaces',
+    'IncrementalRandomEffects': 'interfaces',
+    'NumpyCluster': 'interfaces',
+    'SignFlipPermutation': 'interfaces',
+    'ResultCache': 'cache',
+    'load_expanded_graph': 'graphs',
+    'run_workflow': 'graphs',
+    'create_fdr_threshold_workflow': 'model',
+    'create_modelfit_workflow_bfsl': 'model',
+    'create_random_effects_workflow': 'model',
+    'create_permutation_workflow': 'model',
+}
+
+__all__ = sorted(_LAZY_ATTRIBUTES)
+
+
+class _LazyModule(types.ModuleType):
+
+    def __getattr__(self, name):
+        if name not in _LAZY_ATTRIBUTES:
+            raise AttributeError("module '%s' has no attribute '%s'" % (self.__name__, name))
+
+        module = importlib.import_module('%s.%s' % (self.__name__, _LAZY_ATTRIBUTES[name]))
+        value = getattr(module, name)
+        setattr(self, name, value)
+
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_LAZY_ATTRIBUTES))
+
+
+# Replacing the module object (rather than a module level __getattr__)
+# also works on Python 2. The original module is kept referenced, as
+# Python 2 clears the globals of collected modules.
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
@@ -0,0 +1,215 @@
+""" Cheap checks of FSL (FLIRT) registration matrices, so a full FLIRT
+search can be skipped when a seed matrix is already good. """
+import os
+import json
+import time
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+
+
+def fsl_scaled_voxels(image):
+    """ Voxel to FSL 'scaled voxel' coordinates (mm, x flipped for images
+    with a positive determinant), the space FLIRT matrices live in. """
+    scale = np.diag(list(image.header.get_zooms()[:3]) + [1.])
+
+    if np.linalg.det(image.affine) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = image.shape[0] - 1
+        scale = scale.dot(flip)
+
+    return scale
+
+
+def normalized_mutual_information(a, b, bins=32):
+    """ (H(a) + H(b)) / H(a, b), between 1 (independent) and 2. """
+    joint, _, _ = np.histogram2d(a, b, bins=bins)
+    joint /= joint.sum()
+
+    def entropy(p):
+        p = p[p > 0]
+        return -np.sum(p * np.log(p))
+
+    return (entropy(joint.sum(0)) + entropy(joint.sum(1))) / entropy(joint)
+
+
+def _load(in_file, reference, step):
+    in_image = nb.load(in_file)
+    ref_image = nb.load(reference)
+
+    ref = np.asarray(ref_image.get_data(), dtype=float)[::step, ::step, ::step]
+    in_data = np.asarray(in_image.get_data(), dtype=float)
+    if in_data.ndim > 3:
+        in_data = in_data[..., 0]
+
+    return in_image, in_data, ref_image, ref
+
+
+def _quality(in_image, in_data, ref_image, ref, matrix, step, perturbation):
+    # Coarse reference voxel -> input voxel
+    subsample = np.diag([step] * 3 + [1.])
+    ref_to_in = np.linalg.inv(fsl_scaled_voxels(in_image)).dot(
+        np.linalg.inv(matrix)).dot(perturbation).dot(fsl_scaled_voxels(ref_image)).dot(subsample)
+
+    resampled = ndimage.affine_transform(in_data, ref_to_in[:3, :3], ref_to_in[:3, 3],
+                                         output_shape=ref.shape, order=1, cval=np.nan)
+
+    mask = np.isfinite(resampled) & (ref > 0)
+
+    return normalized_mutual_information(ref[mask], resampled[mask])
+
+
+def alignment_quality(in_file, reference, matrix, step=3, perturbation=None):
+    """ NMI between `reference` and `in_file` resampled with the FLIRT
+    `matrix`, on every `step`-th reference voxel, optionally after an
+    extra 4x4 `perturbation` in reference mm. """
+    if not isinstance(matrix, np.ndarray):
+        matrix = np.loadtxt(matrix)
+    if perturbation is None:
+        perturbation = np.eye(4)
+
+    return _quality(*(_load(in_file, reference, step) + (matrix, step, perturbation)))
+
+
+def perturbations(ref_image, shift_mm=2., rotate_deg=2.):
+    """ Shifts of +-`shift_mm` along every axis and rotations of
+    +-`rotate_deg` about every axis through the centre of `ref_image`, as
+    4x4 matrices in reference mm. """
+    center = fsl_scaled_voxels(ref_image).dot(list((np.array(ref_image.shape[:3]) - 1) / 2.) + [1.])
+    to_center, from_center = np.eye(4), np.eye(4)
+    to_center[:3, 3], from_center[:3, 3] = -center[:3], center[:3]
+
+    matrices = []
+    for axis in range(3):
+        for sign in [-1, 1]:
+            shift = np.eye(4)
+            shift[axis, 3] = sign * shift_mm
+            matrices.append(shift)
+
+            angle = np.deg2rad(sign * rotate_deg)
+            i, j = [a for a in range(3) if a != axis]
+            rotation = np.eye(4)
+            rotation[i, i] = rotation[j, j] = np.cos(angle)
+            rotation[i, j], rotation[j, i] = -np.sin(angle), np.sin(angle)
+            matrices.append(from_center.dot(rotation).dot(to_center))
+
+    return matrices
+
+
+def is_local_optimum(in_file, reference, matrix, shift_mm=2., rotate_deg=2., tolerance=0.002, step=3):
+    """ True if shifting the alignment by `shift_mm` along any axis or
+    rotating it by `rotate_deg` about any axis does not raise the NMI by
+    more than `tolerance`. Returns (is_optimum, quality).
+
+    This only probes the neighbourhood of `matrix`: a seed that is off by
+    more than a few mm or degrees can sit in another local optimum and
+    still pass, see `passes_quality_floor`. """
+    if not isinstance(matrix, np.ndarray):
+        matrix = np.loadtxt(matrix)
+
+    images = _load(in_file, reference, step)
+    quality = _quality(*(images + (matrix, step, np.eye(4))))
+
+    for perturbation in perturbations(images[2], shift_mm, rotate_deg):
+        if _quality(*(images + (matrix, step, perturbation))) > quality + tolerance:
+            return False, quality
+
+    return True, quality
+
+
+def passes_quality_floor(quality, flirt_quality, min_relative_nmi=0.95):
+    """ True if the NMI of a seed is at least `min_relative_nmi` times
+    that of a FLIRT result, both measured above independence (NMI 1).
+    False without a FLIRT result to compare to. """
+    if flirt_quality is None:
+        return False
+    return quality - 1 >= min_relative_nmi * (flirt_quality - 1)
+
+
+def _quality_file(matrix_file):
+    return matrix_file + '.json'
+
+
+def _timings_file():
+    from .cache import default_cache_dir
+    return os.path.join(default_cache_dir(), 'flirt_timings.json')
+
+
+def _load_flirt_runs():
+    """ [{'seconds': ..., 'nmi': ...}] of earlier FLIRT searches. """
+    try:
+        with open(_timings_file()) as f:
+            runs = json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+
+    # Older files only hold durations
+    return [run if isinstance(run, dict) else {'seconds': run, 'nmi': None} for run in runs]
+
+
+def _record_flirt_run(seconds, quality, keep=50):
+    runs = (_load_flirt_runs() + [{'seconds': seconds, 'nmi': quality}])[-keep:]
+    try:
+        if not os.path.isdir(os.path.dirname(_timings_file())):
+            os.makedirs(os.path.dirname(_timings_file()))
+        with open(_timings_file(), 'w') as f:
+            json.dump(runs, f)
+    except (IOError, OSError):
+        pass
+
+
+def flirt_quality(matrix_file):
+    """ NMI of the FLIRT search a matrix is compared against: the one
+    stored with `matrix_file` when FLIRT produced it, otherwise the median
+    of earlier FLIRT searches sharing the cache directory, or None. """
+    try:
+        with open(_quality_file(matrix_file)) as f:
+            return json.load(f)['nmi']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    qualities = [run['nmi'] for run in _load_flirt_runs() if run['nmi'] is not None]
+    return float(np.median(qualities)) if qualities else None
+
+
+def init_epi2anat(in_file, reference, init_matrix=None, shift_mm=2., rotate_deg=2.,
+                  tolerance=0.002, min_relative_nmi=0.95):
+    """ Initial epi -> anat matrix for BBR.
+
+    Uses `init_matrix` when `is_local_optimum` accepts it and its NMI
+    passes the floor set by the FLIRT result stored with it (or by earlier
+    FLIRT searches, see `flirt_quality` and `passes_quality_floor`), and
+    otherwise runs the 6-dof FLIRT search and stores its NMI with the
+    matrix. Returns (matrix_file, used_seed, estimated_seconds_saved).
+    The estimate is the median duration of earlier FLIRT searches minus
+    the time of the check when the seed is used (NaN before any FLIRT
+    search was timed), minus the time of the check when FLIRT ran after
+    all, and 0 without a seed. """
+    from nipype.interfaces import fsl
+
+    check_time = 0.
+
+    if init_matrix is not None:
+        t0 = time.time()
+        good, quality = is_local_optimum(in_file, reference, init_matrix, shift_mm, rotate_deg, tolerance)
+        good = good and passes_quality_floor(quality, flirt_quality(init_matrix), min_relative_nmi)
+        check_time = time.time() - t0
+
+        if good:
+            timings = [run['seconds'] for run in _load_flirt_runs()]
+            estimated_seconds_saved = np.median(timings) - check_time if timings else np.nan
+            return os.path.abspath(init_matrix), True, float(estimated_seconds_saved)
+
+    t0 = time.time()
+    result = fsl.FLIRT(in_file=in_file, reference=reference, dof=6).run()
+    seconds = time.time() - t0
+
+    matrix_file = result.outputs.out_matrix_file
+    quality = alignment_quality(in_file, reference, matrix_file)
+    with open(_quality_file(matrix_file), 'w') as f:
+        json.dump({'nmi': quality}, f)
+    _record_flirt_run(seconds, quality)
+
+    return matrix_file, False, -check_time
@@ -0,0 +1,247 @@
+""" Content-addressed result cache shared between workflows.
+
+Every entry is a directory named after a hash of the input file contents
+and the parameters that produced it. It holds copies of the output files
+and a manifest.json. The manifest's modification time records when the
+entry was last used and drives least-recently-used eviction once the
+cache grows beyond max_size_gb (default $GILLES_WORKFLOWS_CACHE_MAX_SIZE_GB
+or 20 GB).
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+
+def default_cache_dir():
+    return os.environ.get('GILLES_WORKFLOWS_CACHE_DIR',
+                          os.path.expanduser('~/workflow_folders/cache'))
+
+
+def default_max_size_gb():
+    """ Size beyond which least recently used entries are evicted. """
+    return float(os.environ.get('GILLES_WORKFLOWS_CACHE_MAX_SIZE_GB', 20))
+
+
+def json_default(value):
+    """ JSON encoding for the non-JSON values that show up in parameters:
+    numpy arrays and scalars, and sets. Anything else raises a TypeError,
+    as str() of an object includes its memory address and the key would
+    never match again. """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError('%r cannot be used in a cache key' % (value,))
+
+
+def hash_file(fn, chunk_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, fn))
+               for root, _, fns in os.walk(path) for fn in fns)
+
+
+class ResultCache(object):
+
+    def __init__(self, location=None, max_size_gb=None):
+        if location is None:
+            location = default_cache_dir()
+        if max_size_gb is None:
+            max_size_gb = default_max_size_gb()
+
+        self.location = os.path.abspath(location)
+        self.max_size_gb = max_size_gb
+
+        if not os.path.isdir(self.location):
+            try:
+                os.makedirs(self.location)
+            except OSError:
+                if not os.path.isdir(self.location):
+                    raise
+
+    def key(self, files, parameters):
+        """ Hash of the contents of `files` (in order) and of `parameters`,
+        a dict of JSON-serializable values (see `json_default`). """
+        sha1 = hashlib.sha1()
+
+        for fn in files:
+            sha1.update(hash_file(fn).encode())
+
+        sha1.update(json.dumps(parameters, sort_keys=True, default=json_default).encode())
+
+        return sha1.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.location, key)
+
+    def _manifest(self, key):
+        return os.path.join(self._entry_dir(key), 'manifest.json')
+
+    def get(self, key):
+        """ Paths of the cached files for `key`, or None on a miss. """
+        manifest = self._manifest(key)
+
+        try:
+            with open(manifest) as f:
+                files = json.load(f)['files']
+            os.utime(manifest, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return [os.path.join(self._entry_dir(key), fn) for fn in files]
+
+    def restore(self, key, directory):
+        """ Links (or copies) the cached files for `key` into `directory`
+        under their original names. Returns the new paths, or None on a
+        miss. """
+        cached = self.get(key)
+
+        if cached is None:
+            return None
+
+        return [_link_or_copy(fn, os.path.join(directory, os.path.basename(fn)))
+                for fn in cached]
+
+    def put(self, key, files, info=None, names=None):
+        """ Stores `files` under `key`, optionally renamed to `names`.
+        `info` is free-form metadata kept in the manifest for `entries`.
+        Returns the cached paths. """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        if names is None:
+            names = [os.path.basename(fn) for fn in files]
+
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=self.location)
+
+        for fn, name in zip(files, names):
+            shutil.copy2(fn, os.path.join(tmp_dir, name))
+
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump({'files': list(names),
+                       'created': time.time(),
+                       'info': info or {}}, f)
+
+        try:
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # Another process stored the same result first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.prune(max_size_gb=self.max_size_gb)
+
+        return self.get(key)
+
+    def entries(self):
+        """ One dict per entry with key, size (bytes), last_used, created,
+        files and info, least recently used first. """
+        entries = []
+
+        for key in os.listdir(self.location):
+            manifest = self._manifest(key)
+
+            try:
+                with open(manifest) as f:
+                    entry = json.load(f)
+                last_used = os.path.getmtime(manifest)
+            except (IOError, OSError, ValueError):
+                continue
+
+            entry.update(key=key,
+                         size=_dir_size(self._entry_dir(key)),
+                         last_used=last_used)
+            entries.append(entry)
+
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    def remove(self, key):
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def prune(self, max_size_gb=None, older_than_days=None):
+        """ Removes entries not used in `older_than_days`, then the least
+        recently used ones until the cache is at most `max_size_gb`.
+        Returns the removed keys. """
+        entries = self.entries()
+        removed = []
+
+        if older_than_days is not None:
+            cutoff = time.time() - older_than_days * 24 * 3600
+            for entry in entries:
+                if entry['last_used'] < cutoff:
+                    self.remove(entry['key'])
+                    removed.append(entry['key'])
+            entries = [entry for entry in entries if entry['key'] not in removed]
+
+        if max_size_gb is not None:
+            total = sum(entry['size'] for entry in entries)
+            for entry in entries:
+                if total <= max_size_gb * 1024 ** 3:
+                    break
+                self.remove(entry['key'])
+                removed.append(entry['key'])
+                total -= entry['size']
+
+        return removed
+
+
+def main(argv=None):
+    """ python -m gilles_workflows.cache [--cache-dir DIR] list|prune ... """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Inspect the gilles_workflows result cache')
+    parser.add_argument('--cache-dir', default=None)
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparsers.add_parser('list', help='list entries, least recently used first')
+
+    prune_parser = subparsers.add_parser('prune', help='remove entries')
+    prune_parser.add_argument('--max-size-gb', type=float, default=None)
+    prune_parser.add_argument('--older-than-days', type=float, default=None)
+    prune_parser.add_argument('--key', action='append', default=[],
+                              help='remove this entry, can be repeated')
+
+    args = parser.parse_args(argv)
+    cache = ResultCache(args.cache_dir)
+
+    if args.command == 'list':
+        total = 0
+        for entry in cache.entries():
+            total += entry['size']
+            print('%s  %8.1f MB  %s  %s' % (entry['key'],
+                                           entry['size'] / 1024. ** 2,
+                                           time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_used'])),
+                                           entry['info'].get('interface', '')))
+        print('%d entries, %.1f MB in %s' % (len(cache.entries()), total / 1024. ** 2, cache.location))
+
+    elif args.command == 'prune':
+        for key in args.key:
+            cache.remove(key)
+        removed = args.key + cache.prune(args.max_size_gb, args.older_than_days)
+        print('Removed %d entries' % len(removed))
+
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
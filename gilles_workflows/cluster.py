@@ -0,0 +1,170 @@
+""" In-process replacement for FSL's `cluster`.
+
+A statistic map is loaded once and clustered at any number of
+thresholds. Every threshold gives a label map (like --oindex), the local
+maxima in FSL's --olmax text format and a per-cluster table like the one
+`cluster` prints. Results are stored in the result cache by map content,
+threshold and connectivity, so re-clustering a map is a lookup.
+"""
+import os
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+
+
+STRUCTURES = {6: 1, 18: 2, 26: 3}
+
+TABLE_COLUMNS = ['Cluster Index', 'Voxels', 'MAX', 'MAX X (vox)', 'MAX Y (vox)', 'MAX Z (vox)',
+                 'COG X (vox)', 'COG Y (vox)', 'COG Z (vox)']
+
+
+def label_clusters(data, threshold, connectivity=26):
+    """ Connected components of data > threshold, numbered like FSL
+    (1 is the smallest cluster). Returns (labels, sizes), with sizes[i]
+    the size of cluster i + 1. """
+    structure = ndimage.generate_binary_structure(3, STRUCTURES[connectivity])
+    labels, n = ndimage.label(data > threshold, structure)
+
+    if n == 0:
+        return labels, np.zeros(0, dtype=int)
+
+    sizes = np.bincount(labels.ravel())[1:]
+
+    # Renumber by increasing size (ties in label order)
+    order = np.argsort(sizes, kind='mergesort')
+    relabel = np.zeros(n + 1, dtype=labels.dtype)
+    relabel[order + 1] = np.arange(1, n + 1)
+
+    return relabel[labels], sizes[order]
+
+
+def cluster_table(data, labels, sizes):
+    """ One row per cluster, largest first, with TABLE_COLUMNS. """
+    index = np.arange(1, len(sizes) + 1)
+    if len(index) == 0:
+        return []
+
+    peaks = ndimage.maximum(data, labels, index)
+    peak_positions = ndimage.maximum_position(data, labels, index)
+    centers = ndimage.center_of_mass(np.ones_like(data), labels, index)
+
+    return [[i, size, peak] + list(position) + list(center)
+            for i, size, peak, position, center
+            in reversed(list(zip(index, sizes, peaks, peak_positions, centers)))]
+
+
+def local_maxima(data, labels, n_maxima=6, connectivity=26):
+    """ Voxels that are the maximum of their neighbourhood within their
+    cluster, at most `n_maxima` per cluster, as (cluster, value, x, y, z)
+    rows sorted like FSL's --olmax output. """
+    footprint = ndimage.generate_binary_structure(3, STRUCTURES[connectivity])
+    masked = np.where(labels > 0, data, -np.inf)
+    is_max = (masked == ndimage.maximum_filter(masked, footprint=footprint)) & (labels > 0)
+
+    rows = []
+    for x, y, z in zip(*np.nonzero(is_max)):
+        rows.append((labels[x, y, z], data[x, y, z], x, y, z))
+
+    rows.sort(key=lambda row: (-row[0], -row[1]))
+
+    kept, counts = [], {}
+    for row in rows:
+        counts[row[0]] = counts.get(row[0], 0) + 1
+        if counts[row[0]] <= n_maxima:
+            kept.append(row)
+
+    return kept
+
+
+def write_localmax(rows, out_file):
+    with open(out_file, 'w') as f:
+        f.write('Cluster Index\tValue\tx\ty\tz\t\n')
+        for cluster, value, x, y, z in rows:
+            f.write('%d\t%g\t%d\t%d\t%d\t\n' % (cluster, value, x, y, z))
+    return os.path.abspath(out_file)
+
+
+def write_table(rows, out_file):
+    with open(out_file, 'w') as f:
+        f.write('\t'.join(TABLE_COLUMNS) + '\n')
+        for row in rows:
+            f.write('%d\t%d\t%g\t%d\t%d\t%d\t%.2f\t%.2f\t%.2f\n' % tuple(row))
+    return os.path.abspath(out_file)
+
+
+def _out_names(in_file, threshold):
+    from nipype.utils.filemanip import split_filename
+    _, base, _ = split_filename(in_file)
+    suffixes = ['_thresh%g_index.nii.gz' % threshold,
+                '_thresh%g_localmax.txt' % threshold,
+                '_thresh%g_table.txt' % threshold]
+    return [base + suffix for suffix in suffixes], ['cached' + suffix for suffix in suffixes]
+
+
+def _restore(cache, key, cached_names, paths):
+    """ Links the entry's files to `paths`. False (and the entry is
+    dropped) unless it holds all of them. """
+    from .cache import _link_or_copy
+
+    cached = cache.get(key)
+    if cached is None:
+        return False
+
+    cached = dict((os.path.basename(fn), fn) for fn in cached)
+    if not all(name in cached and os.path.isfile(cached[name]) for name in cached_names):
+        cache.remove(key)
+        return False
+
+    for name, path in zip(cached_names, paths):
+        _link_or_copy(cached[name], path)
+
+    return True
+
+
+def cluster_image(in_file, thresholds=(2.0,), connectivity=26, n_maxima=6,
+                  out_dir='.', cache_dir=None, use_cache=True, cache_max_size_gb=None):
+    """ Clusters `in_file` at every threshold. Returns one (index_file,
+    localmax_txt_file, table_file) tuple per threshold.
+
+    Results are stored under names relative to the input's basename, so
+    maps with the same content but different names (e.g. empty
+    thresholded maps) share an entry. use_cache=False skips the cache. """
+    from .cache import ResultCache
+
+    cache = ResultCache(cache_dir, cache_max_size_gb) if use_cache else None
+    out_dir = os.path.abspath(out_dir)
+    image, data = None, None
+    results = []
+
+    for threshold in thresholds:
+        names, cached_names = _out_names(in_file, threshold)
+        paths = [os.path.join(out_dir, name) for name in names]
+
+        if cache is not None:
+            key = cache.key([in_file], {'interface': 'cluster',
+                                        'threshold': float(threshold),
+                                        'connectivity': connectivity,
+                                        'n_maxima': n_maxima})
+            if _restore(cache, key, cached_names, paths):
+                results.append(tuple(paths))
+                continue
+
+        if data is None:
+            image = nb.load(in_file)
+            data = np.asarray(image.get_data(), dtype=np.float64)
+
+        labels, sizes = label_clusters(data, threshold, connectivity)
+
+        index_image = nb.Nifti1Image(labels.astype(np.int32), image.affine, image.header)
+        index_image.set_data_dtype(np.int32)
+        index_image.to_filename(paths[0])
+        write_localmax(local_maxima(data, labels, n_maxima, connectivity), paths[1])
+        write_table(cluster_table(data, labels, sizes), paths[2])
+
+        if cache is not None:
+            cache.put(key, paths, info={'interface': 'cluster', 'threshold': float(threshold)},
+                      names=cached_names)
+        results.append(tuple(paths))
+
+    return results
@@ -0,0 +1,271 @@
+""" FEAT-style level-1 design matrices from FSL 3-column event files.
+
+The parts of a design that only depend on the TR, the run length and the
+high-pass filter (the sampled HRF basis and the high-pass filter matrix)
+are computed once per combination and kept in memory and in the result
+cache, so runs and subjects with the same acquisition share them.
+"""
+import os
+import re
+import warnings
+
+import numpy as np
+from scipy import stats
+
+
+# Oversampling of the TR grid for the convolution with the HRF
+OVERSAMPLING = 16
+
+# Length of the HRF kernel in seconds
+HRF_LENGTH = 32.
+
+_COMPONENTS = {}
+
+
+def check_design_options(bases, contrasts):
+    """ Raises a ValueError for what this module cannot model: bases
+    other than dgamma (with or without derivatives), and anything but
+    plain T contrasts (name, 'T', conditions, weights). """
+    if bases is not None:
+        if list(bases) != ['dgamma']:
+            raise ValueError('Only the dgamma basis is supported, got %s' % list(bases))
+        if set(bases['dgamma']) - set(['derivs']):
+            raise ValueError('Only the derivs option of dgamma is supported, got %s'
+                             % list(bases['dgamma']))
+
+    for contrast in contrasts:
+        if contrast[1] != 'T':
+            raise ValueError('Only T contrasts are supported, %s is an %s contrast'
+                             % (contrast[0], contrast[1]))
+        if len(contrast) != 4:
+            raise ValueError('Contrast %s has session weights, which are not supported' % contrast[0])
+
+
+def double_gamma(t):
+    """ FSL's double-gamma HRF: a gamma peaking at 5 s minus a sixth of
+    one peaking at 15 s. """
+    return stats.gamma.pdf(t, 6) - stats.gamma.pdf(t, 16) / 6.
+
+
+def hrf_kernels(tr, bases=None):
+    """ HRF (and, for dgamma with derivs, its temporal derivative) sampled
+    at tr / OVERSAMPLING, as a (n_kernels, n_samples) array. """
+    if bases is None:
+        bases = {'dgamma': {'derivs': True}}
+
+    if list(bases) != ['dgamma']:
+        raise ValueError('Only the dgamma basis is supported, got %s' % list(bases))
+
+    dt = float(tr) / OVERSAMPLING
+    t = np.arange(0, HRF_LENGTH, dt)
+
+    kernels = [double_gamma(t)]
+    if bases['dgamma'].get('derivs', False):
+        kernels.append(np.gradient(kernels[0], dt))
+
+    return np.array(kernels)
+
+
+def highpass_matrix(n_volumes, tr, highpass_filter):
+    """ (n_volumes, n_volumes) matrix that applies FSL's Gaussian-weighted
+    running line high-pass filter (sigma = highpass_filter / (2 * TR)
+    volumes) to a time course, as `matrix.dot(timecourse)`.
+    `highpass_filter` is the cutoff in seconds as FEAT gets it, i.e.
+    SpecifyModel's high_pass_filter_cutoff. """
+    if highpass_filter is None or highpass_filter <= 0:
+        return np.eye(n_volumes)
+
+    sigma = highpass_filter / (2. * tr)
+    width = int(np.ceil(3 * sigma))
+    smoother = np.zeros((n_volumes, n_volumes))
+
+    for t in range(n_volumes):
+        k = np.arange(max(0, t - width), min(n_volumes, t + width + 1))
+        w = np.exp(-0.5 * ((k - t) / sigma) ** 2)
+        a = np.column_stack([np.ones(len(k)), k - t])
+
+        # Value at t of the weighted least-squares line through the window
+        smoother[t, k] = np.linalg.solve(a.T.dot(w[:, np.newaxis] * a), (a * w[:, np.newaxis]).T)[0]
+
+    return np.eye(n_volumes) - smoother
+
+
+def _components_key(tr, n_volumes, highpass_filter, bases):
+    return {'interface': 'level1_design_components',
+            'tr': float(tr),
+            'n_volumes': int(n_volumes),
+            'highpass_filter': highpass_filter,
+            'bases': bases,
+            'oversampling': OVERSAMPLING}
+
+
+def design_components(tr, n_volumes, highpass_filter, bases=None, cache_dir=None):
+    """ (hrf_kernels, highpass_matrix) for one acquisition, from memory,
+    the result cache or computed and stored in both. """
+    from .cache import ResultCache
+
+    if bases is None:
+        bases = {'dgamma': {'derivs': True}}
+
+    parameters = _components_key(tr, n_volumes, highpass_filter, bases)
+    memo_key = repr(sorted(parameters.items()))
+
+    if memo_key in _COMPONENTS:
+        return _COMPONENTS[memo_key]
+
+    try:
+        cache = ResultCache(cache_dir)
+        key = cache.key([], parameters)
+        cached = cache.get(key)
+    except (IOError, OSError):
+        cache, cached = None, None
+
+    if cached is not None:
+        components = np.load(cached[0])
+        components = components['kernels'], components['highpass']
+    else:
+        components = hrf_kernels(tr, bases), highpass_matrix(n_volumes, tr, highpass_filter)
+
+        if cache is not None:
+            import tempfile
+            tmp_dir = tempfile.mkdtemp()
+            fn = os.path.join(tmp_dir, 'design_components.npz')
+            np.savez(fn, kernels=components[0], highpass=components[1])
+            cache.put(key, [fn], info=parameters)
+            os.remove(fn)
+            os.rmdir(tmp_dir)
+
+    _COMPONENTS[memo_key] = components
+    return components
+
+
+def condition_name(event_file):
+    """ Condition name of an event file, as SpecifyModel derives it:
+    without the .runNNN or .txt suffix. """
+    name = os.path.basename(event_file)
+    if re.search(r'\.run\d{3}', name):
+        return re.split(r'\.run\d{3}', name)[0]
+    if name.endswith('.txt'):
+        name = name[:-4]
+    return name
+
+
+def read_events(event_file):
+    """ (n_events, 3) onsets, durations and weights of an FSL event file.
+    As in SpecifyModel, a missing duration column means 0 (sticks) and a
+    missing weight column 1. An empty file has no events. """
+    with warnings.catch_warnings():
+        # numpy warns about empty files
+        warnings.simplefilter('ignore')
+        events = np.loadtxt(event_file, ndmin=2)
+
+    if events.size == 0:
+        return np.zeros((0, 3))
+
+    defaults = np.tile([0., 0., 1.], (len(events), 1))
+    defaults[:, :min(3, events.shape[1])] = events[:, :3]
+    return defaults
+
+
+def event_regressor(event_file, tr, n_volumes):
+    """ Stick/boxcar function of an FSL 1- to 3-column (onset, duration,
+    weight) file on the oversampled grid. """
+    dt = float(tr) / OVERSAMPLING
+    boxcar = np.zeros(n_volumes * OVERSAMPLING)
+
+    for onset, duration, weight in read_events(event_file):
+        start = int(round(onset / dt))
+        stop = max(start + 1, int(round((onset + duration) / dt)))
+        boxcar[start:stop] += weight
+
+    return boxcar
+
+
+def level1_design(event_files, n_volumes, tr, highpass_filter=128, bases=None,
+                  realignment_parameters=None, cache_dir=None):
+    """ (design, names, real_columns) for one run: one convolved regressor
+    (plus its orthogonalized temporal derivative) per event file, then the
+    realignment parameters, all high-pass filtered and demeaned.
+    `real_columns` indexes the columns of the conditions themselves.
+    Conditions without events (empty event files) are left out. """
+    kernels, highpass = design_components(tr, n_volumes, highpass_filter, bases, cache_dir)
+
+    columns, names, real_columns = [], [], []
+
+    for event_file in event_files:
+        if not len(read_events(event_file)):
+            continue
+
+        boxcar = event_regressor(event_file, tr, n_volumes)
+        convolved = [np.convolve(boxcar, kernel)[:len(boxcar)][::OVERSAMPLING] for kernel in kernels]
+
+        real_columns.append(len(columns))
+        columns.append(convolved[0])
+        names.append(condition_name(event_file))
+
+        for derivative in convolved[1:]:
+            # As in FEAT, the derivative only explains what the HRF can't
+            regressor = convolved[0] - convolved[0].mean()
+            derivative = derivative - regressor.dot(derivative) / regressor.dot(regressor) * regressor
+            columns.append(derivative)
+            names.append('%s_derivative' % names[real_columns[-1]])
+
+    if realignment_parameters is not None:
+        motion = np.atleast_2d(np.loadtxt(realignment_parameters))
+        for i in range(motion.shape[1]):
+            columns.append(motion[:n_volumes, i])
+            names.append('realign%d' % (i + 1))
+
+    design = highpass.dot(np.column_stack(columns))
+    design -= design.mean(0)
+
+    return design, names, real_columns
+
+
+def contrast_matrix(contrasts, names, real_columns):
+    """ Weights over the design columns for nipype-style T contrasts
+    (name, 'T', conditions, weights). Derivative and confound columns, and
+    conditions that are not in the design, get zero weight. """
+    condition_columns = dict((names[column], column) for column in real_columns)
+    matrix = np.zeros((len(contrasts), len(names)))
+
+    for i, contrast in enumerate(contrasts):
+        if contrast[1] != 'T':
+            raise ValueError('Only T contrasts are supported, %s is %s' % (contrast[0], contrast[1]))
+
+        for condition, weight in zip(contrast[2], contrast[3]):
+            if condition in condition_columns:
+                matrix[i, condition_columns[condition]] = weight
+
+    return matrix
+
+
+def write_design_mat(design, out_file):
+    """ FSL VEST design.mat, as written by feat_model. """
+    with open(out_file, 'w') as f:
+        f.write('/NumWaves\t%d\n' % design.shape[1])
+        f.write('/NumPoints\t%d\n' % design.shape[0])
+        f.write('/PPheights\t%s\n' % '\t'.join('%e' % h for h in design.max(0) - design.min(0)))
+        f.write('\n/Matrix\n')
+        np.savetxt(f, design, fmt='%e', delimiter='\t')
+    return os.path.abspath(out_file)
+
+
+def write_design_con(contrasts, matrix, out_file):
+    with open(out_file, 'w') as f:
+        for i, contrast in enumerate(contrasts):
+            f.write('/ContrastName%d\t%s\n' % (i + 1, contrast[0]))
+        f.write('/NumWaves\t%d\n' % matrix.shape[1])
+        f.write('/NumContrasts\t%d\n' % matrix.shape[0])
+        f.write('/PPheights\t%s\n' % '\t'.join(['1'] * matrix.shape[0]))
+        f.write('/RequiredEffect\t%s\n' % '\t'.join(['1'] * matrix.shape[0]))
+        f.write('\n/Matrix\n')
+        np.savetxt(f, matrix, fmt='%e', delimiter='\t')
+    return os.path.abspath(out_file)
+
+
+def read_vest(fn):
+    """ The /Matrix of an FSL VEST file (design.mat, design.con). """
+    with open(fn) as f:
+        lines = f.read().splitlines()
+    return np.atleast_2d(np.loadtxt(lines[lines.index('/Matrix') + 1:]))
@@ -2,13 +2,24 @@ import os
 
 import nipype.pipeline.engine as pe
 import nipype.interfaces.ants as ants
-import nipype.interfaces.fsl as fsl
 import nipype.interfaces.utility as util
-from nipype.interfaces.c3 import C3dAffineTool
+
+from .interfaces import CachedFAST
 
 
 def create_extract_mni_roi_workflow(name='extract_mni_roi_workflow',
-                                    base_dir=None,):
+                                    base_dir=None,
+                                    max_memory_mb=512,
+                                    multi_roi=False,
+                                    label_atlas=False):
+    """ max_memory_mb bounds how much of a 4D EPI run the extracter holds
+    in memory at once.
+
+    With multi_roi=True, `inputspec_masks.mask` is a list of masks or a 4D
+    image with one ROI per volume (or, with label_atlas=True, a 3D label
+    image). All ROIs are warped in one ApplyTransforms call and extracted
+    in a single pass over every run, giving an ROIs x time array per run
+    (label atlases in increasing label order). """
     
     if base_dir == None:
         base_dir = os.path.expanduser('~/workflow_folders/')
@@ -26,7 +37,7 @@ def create_extract_mni_roi_workflow(name='extract_mni_roi_workflow',
     inputspec_masks = pe.Node(util.IdentityInterface(fields=['mask']),
                         name='inputspec_masks')
 
-    fast = pe.Node(fsl.FAST(), name='fast')
+    fast = pe.Node(CachedFAST(), name='fast')
 
     workflow.connect(inputspec_subjects, 'anatomical_t1_weighted', fast, 'in_files')
 
@@ -37,38 +48,39 @@ def create_extract_mni_roi_workflow(name='extract_mni_roi_workflow',
     apply_transform = pe.Node(ants.ApplyTransforms(),
                               name='apply_transform')
     apply_transform.inputs.invert_transform_flags = [True, False]
-    workflow.connect(inputspec_masks, 'mask', apply_transform, 'input_image')
     workflow.connect(inputspec_subjects, 'mean_epi', apply_transform, 'reference_image')
     workflow.connect(merge, 'out', apply_transform, 'transforms')
 
+    if multi_roi and label_atlas:
+        apply_transform.inputs.interpolation = 'NearestNeighbor'
+        workflow.connect(inputspec_masks, 'mask', apply_transform, 'input_image')
+    elif multi_roi:
 
-    def get_weighted_mean(data, mask):
-        import nibabel as nb
-        import numpy as np
-        import os
-        
-        data_image = nb.load(data)
-        mask_image = nb.load(mask)
-        
-        data = data_image.get_data().astype(float)
-        mask = mask_image.get_data().astype(float)
-        
-        mask = mask / mask.sum()
-        weighted_mean = (data * mask[..., np.newaxis]).reshape((-1, data.shape[-1])).sum(0)
-        
-        fn = os.path.abspath('weighted_mean.txt')
-        
-        np.savetxt(fn, [weighted_mean])
-        
-        return fn
+        def stack_rois(masks):
+            import os
+            import nibabel as nb
+            from gilles_workflows.roi import stack_images
+
+            if not isinstance(masks, (list, tuple)):
+                masks = [masks]
+
+            if len(masks) == 1 and len(nb.load(masks[0]).shape) == 4:
+                return masks[0]
+
+            return stack_images(masks, os.path.abspath('rois.nii.gz'))
+
+        stacker = pe.Node(util.Function(function=stack_rois,
+                                        input_names=['masks'],
+                                        output_names=['rois']),
+                          name='stack_rois')
+        workflow.connect(inputspec_masks, 'mask', stacker, 'masks')
+
+        # Warp all ROIs as one time series
+        apply_transform.inputs.input_image_type = 3
+        workflow.connect(stacker, 'rois', apply_transform, 'input_image')
+    else:
+        workflow.connect(inputspec_masks, 'mask', apply_transform, 'input_image')
 
-    extracter = pe.MapNode(util.Function(function=get_weighted_mean,
-                                         input_names=['data', 'mask'],
-                                         output_names=['weighted_mean']), 
-                           iterfield=['data'],
-                           name='extracter')
-    workflow.connect(apply_transform, 'output_image', extracter, 'mask')
-    workflow.connect(inputspec_subjects, 'epi', extracter, 'data')
 
     pick1 = lambda x: x[1]
     listify = lambda x: [x]
@@ -80,21 +92,54 @@ def create_extract_mni_roi_workflow(name='extract_mni_roi_workflow',
     workflow.connect(inputspec_subjects, ('mat_epi2anat', listify), apply_transform_gray_matter_mask, 'transforms')
 
 
-    gray_matter_mask_conjoiner = pe.Node(fsl.MultiImageMaths(),
-                               name='gray_matter_mask_conjoiner')
-    gray_matter_mask_conjoiner.inputs.op_string = '-mul %s'
-    workflow.connect(apply_transform_gray_matter_mask, 'output_image', gray_matter_mask_conjoiner, 'in_file')
-    workflow.connect(apply_transform, 'output_image', gray_matter_mask_conjoiner, 'operand_files')
+    def get_roi_weights(rois, gray_matter, label_atlas):
+        import os
+        from gilles_workflows.roi import save_roi_weights
+
+        return save_roi_weights(rois, os.path.abspath('roi_weights.npz'),
+                                label_atlas, gray_matter)
+
+    # Normalized plain and gray matter weighted ROIs, once per subject
+    roi_weights = pe.Node(util.Function(function=get_roi_weights,
+                                        input_names=['rois', 'gray_matter', 'label_atlas'],
+                                        output_names=['roi_weights']),
+                          name='roi_weights')
+    roi_weights.inputs.label_atlas = multi_roi and label_atlas
+    workflow.connect(apply_transform, 'output_image', roi_weights, 'rois')
+    workflow.connect(apply_transform_gray_matter_mask, 'output_image', roi_weights, 'gray_matter')
+
+
+    def get_weighted_mean(data, roi_weights, basename, max_memory_mb):
+        import numpy as np
+        import os
+        from gilles_workflows.roi import extract_roi_weights
+
+        weighted_mean, weighted_mean_gray_matter = extract_roi_weights(data, roi_weights, max_memory_mb)
+        
+        fn = os.path.abspath('%s.txt' % basename)
+        fn_gray_matter = os.path.abspath('%s_gray_matter.txt' % basename)
+        
+        np.savetxt(fn, weighted_mean)
+        np.savetxt(fn_gray_matter, weighted_mean_gray_matter)
+        
+        return fn, fn_gray_matter
 
-    extracter_gray_matter_conjunction = extracter.clone(name='extracter_gray_matter_conjunction')
-    workflow.connect(gray_matter_mask_conjoiner, 'out_file', extracter_gray_matter_conjunction, 'mask')
-    workflow.connect(inputspec_subjects, 'epi', extracter_gray_matter_conjunction, 'data')
+    # Reads every run once for both the plain and gray matter time courses
+    extracter = pe.MapNode(util.Function(function=get_weighted_mean,
+                                         input_names=['data', 'roi_weights', 'basename', 'max_memory_mb'],
+                                         output_names=['weighted_mean', 'weighted_mean_gray_matter']), 
+                           iterfield=['data'],
+                           name='extracter')
+    extracter.inputs.basename = 'roi_timecourses' if multi_roi else 'weighted_mean'
+    extracter.inputs.max_memory_mb = max_memory_mb
+    workflow.connect(roi_weights, 'roi_weights', extracter, 'roi_weights')
+    workflow.connect(inputspec_subjects, 'epi', extracter, 'data')
 
     outputspec = pe.Node(util.IdentityInterface(fields=['roi_signal',
                                                         'roi_signal_only_gray_matter']), name='outputspec')
 
     workflow.connect(extracter, 'weighted_mean', outputspec, 'roi_signal')
-    workflow.connect(extracter_gray_matter_conjunction, 'weighted_mean', outputspec, 'roi_signal_only_gray_matter')
+    workflow.connect(extracter, 'weighted_mean_gray_matter', outputspec, 'roi_signal_only_gray_matter')
 
 
     return workflow
@@ -0,0 +1,179 @@
+""" Prebuilt execution graphs.
+
+Workflow.run() flattens the nested workflows and expands iterables into
+an execution graph on every call, which takes minutes for large
+per-subject fan-outs. `run_workflow` stores that execution graph, keyed
+by the configured workflow (the factory arguments, inputs and iterables
+it was built with) and the package version, and runs the stored graph
+when the same workflow is run again.
+
+Graphs are pickled, so they are kept in a per-user directory
+(`default_graph_dir`) that is only used when it is owned by and only
+writable by the current user.
+"""
+import os
+import gzip
+import json
+import hashlib
+from copy import deepcopy
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def package_version():
+    """ Hash of the package source and the nipype version, so a stored
+    graph is rebuilt after any code change. """
+    import nipype
+
+    sha1 = hashlib.sha1(nipype.__version__.encode())
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+
+    for fn in sorted(os.listdir(package_dir)):
+        if fn.endswith('.py'):
+            with open(os.path.join(package_dir, fn), 'rb') as f:
+                sha1.update(f.read())
+
+    return sha1.hexdigest()
+
+
+def default_graph_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'gilles_workflows', 'graphs')
+
+
+def _private_dir(path):
+    """ Creates `path` for the current user only. Raises an IOError when
+    an existing directory belongs to someone else or others can write to
+    it, as loading a pickle from it would run their code. """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        os.chmod(path, 0o700)
+
+    status = os.stat(path)
+    if hasattr(os, 'getuid') and (status.st_uid != os.getuid() or status.st_mode & 0o022):
+        raise IOError('%s can be written by other users, not using it for workflow graphs' % path)
+
+    return path
+
+
+def _plugin_name(plugin):
+    if plugin is None:
+        from nipype import config
+        plugin = config.get('execution', 'plugin')
+    if not isinstance(plugin, (str, bytes)):
+        plugin = plugin.__class__.__name__[:-len('Plugin')]
+    return plugin
+
+
+def workflow_key(workflow, plugin=None, plugin_args=None):
+    """ Hash of the configured workflow (`utils.describe_workflow`,
+    including the resources `scheduling.tag_resources` set), its base_dir,
+    the plugin and its (non-callable) arguments, and the package version.
+    Raises a TypeError when an input or iterable is not JSON-serializable. """
+    from .cache import json_default
+    from .utils import describe_workflow
+
+    description = {'workflow': describe_workflow(workflow),
+                   'base_dir': workflow.base_dir,
+                   'plugin': _plugin_name(plugin),
+                   'plugin_args': dict((name, value) for name, value in (plugin_args or {}).items()
+                                       if not callable(value)),
+                   'version': package_version()}
+
+    return hashlib.sha1(json.dumps(description, sort_keys=True, default=json_default).encode()).hexdigest()
+
+
+def _merge_config(workflow):
+    """ The global nipype config under the workflow's own, as
+    Workflow.run sets it. """
+    from nipype import config
+    from nipype.pipeline.engine.utils import merge_dict
+
+    workflow.config = merge_dict(deepcopy(config._sections), workflow.config)
+
+
+def expanded_graph(workflow):
+    """ The execution graph workflow.run() builds: nested workflows
+    flattened, needed outputs set and iterables expanded. """
+    from nipype.pipeline.engine.utils import generate_expanded_graph
+
+    flatgraph = workflow._create_flat_graph()
+    _merge_config(workflow)
+    workflow._set_needed_outputs(flatgraph)
+
+    return generate_expanded_graph(deepcopy(flatgraph))
+
+
+def _prune(graph_dir, keep=50):
+    graphs = sorted((os.path.join(graph_dir, fn) for fn in os.listdir(graph_dir) if fn.endswith('.pklz')),
+                    key=os.path.getmtime)
+    for fn in graphs[:-keep]:
+        os.remove(fn)
+
+
+def load_expanded_graph(workflow, graph_dir=None, plugin=None, plugin_args=None):
+    """ (execution graph, loaded) for `workflow`, from `graph_dir`
+    (default: `default_graph_dir()`) or expanded and stored there. """
+    _merge_config(workflow)
+
+    try:
+        key = workflow_key(workflow, plugin, plugin_args)
+    except TypeError:
+        # An input or iterable without a stable description
+        return expanded_graph(workflow), False
+
+    graph_dir = _private_dir(graph_dir or default_graph_dir())
+    fn = os.path.join(graph_dir, key + '.pklz')
+
+    if os.path.exists(fn):
+        try:
+            with gzip.open(fn, 'rb') as f:
+                execgraph = pickle.load(f)
+            os.utime(fn, None)
+            return execgraph, True
+        except Exception:
+            # Unreadable (e.g. pickled by another Python), rebuild it
+            os.remove(fn)
+
+    execgraph = expanded_graph(workflow)
+
+    tmp_file = '%s.%d.tmp' % (fn, os.getpid())
+    with gzip.open(tmp_file, 'wb') as f:
+        pickle.dump(execgraph, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, fn)
+    _prune(graph_dir)
+
+    return execgraph, False
+
+
+def run_workflow(workflow, plugin=None, plugin_args=None, updatehash=False, graph_dir=None):
+    """ workflow.run(plugin, plugin_args, updatehash), with the execution
+    graph from `load_expanded_graph`. Workflow.run does everything else
+    (plugin setup, reports, provenance, resource monitor); only its
+    flattening and expansion are replaced by the stored graph. Returns the
+    execution graph.
+
+    This relies on Workflow.run getting the execution graph from
+    `_create_flat_graph` and the `generate_expanded_graph` of its module
+    (tests/test_graphs.py checks this against the installed nipype). With
+    a nipype that has no such function it runs plain workflow.run(). """
+    import networkx as nx
+    from nipype.pipeline.engine import workflows
+
+    if not hasattr(workflows, 'generate_expanded_graph'):
+        return workflow.run(plugin=plugin, plugin_args=plugin_args, updatehash=updatehash)
+
+    execgraph, _ = load_expanded_graph(workflow, graph_dir, plugin, plugin_args)
+
+    generate_expanded_graph = workflows.generate_expanded_graph
+    workflows.generate_expanded_graph = lambda flatgraph: execgraph
+    workflow._create_flat_graph = nx.DiGraph
+
+    try:
+        return workflow.run(plugin=plugin, plugin_args=plugin_args, updatehash=updatehash)
+    finally:
+        workflows.generate_expanded_graph = generate_expanded_graph
+        del workflow._create_flat_graph
@@ -0,0 +1,329 @@
+""" In-process higher-level (across runs or subjects) models. """
+import os
+
+import numpy as np
+import nibabel as nb
+
+from .stats import load_mask, save_like, _save_in_mask
+
+
+def read_dof(dof_file):
+    """ Degrees of freedom from a FILM `dof` text file. """
+    return float(np.loadtxt(dof_file))
+
+
+def fixed_effects(copes, varcopes, mask):
+    """ Inverse-variance weighted combination of one contrast over runs,
+    reading one run at a time. Returns (cope, varcope) within `mask`.
+    Voxels where any varcope is not positive get zero. """
+    sum_weights = np.zeros(mask.sum())
+    sum_weighted_copes = np.zeros(mask.sum())
+    valid = np.ones(mask.sum(), dtype=bool)
+
+    for cope, varcope in zip(copes, varcopes):
+        varcope = nb.load(varcope).get_data()[mask].astype(np.float64)
+        valid &= varcope > 0
+
+        weights = 1. / np.where(varcope > 0, varcope, np.inf)
+        sum_weights += weights
+        sum_weighted_copes += weights * nb.load(cope).get_data()[mask]
+
+    sum_weights[~valid] = np.inf
+
+    return sum_weighted_copes / sum_weights, 1. / sum_weights
+
+
+def fixed_effects_images(copes, varcopes, dof_files, mask, out_dir='.'):
+    """ Fixed-effects combination of every contrast.
+
+    `copes` and `varcopes` hold one list of run images per contrast (as
+    fed to create_fixed_effects_flow), `dof_files` one FILM dof file per
+    run. Writes copeN, varcopeN, zstatN and tdof_tN (N = contrast number)
+    to `out_dir` and returns their paths as a dict of lists. """
+    from .glm import t_to_z
+
+    mask_image = nb.load(mask)
+    mask = load_mask(mask)
+
+    tdof = sum(read_dof(fn) for fn in dof_files)
+
+    outputs = {'copes': [], 'varcopes': [], 'zstats': [], 'tdof': []}
+
+    def path(name, i):
+        return os.path.abspath(os.path.join(out_dir, '%s%d.nii.gz' % (name, i + 1)))
+
+    for i, (contrast_copes, contrast_varcopes) in enumerate(zip(copes, varcopes)):
+        cope, varcope = fixed_effects(contrast_copes, contrast_varcopes, mask)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.nan_to_num(t_to_z(cope / np.sqrt(varcope), tdof))
+
+        outputs['copes'].append(_save_in_mask(cope, mask, mask_image, path('cope', i)))
+        outputs['varcopes'].append(_save_in_mask(varcope, mask, mask_image, path('varcope', i)))
+        outputs['zstats'].append(_save_in_mask(z, mask, mask_image, path('zstat', i)))
+        outputs['tdof'].append(_save_in_mask(np.full(mask.sum(), tdof), mask, mask_image,
+                                             path('tdof_t', i)))
+
+    return outputs
+
+
+def default_scratch_dir():
+    import tempfile
+    return os.environ.get('GILLES_WORKFLOWS_SCRATCH_DIR', tempfile.gettempdir())
+
+
+def merge_images(in_files, out_file, dtype=np.float32):
+    """ Stacks 3D images along the 4th dimension into an uncompressed
+    NIfTI file, writing one volume at a time through a memory map. The
+    result can be memory-mapped by nibabel and read by FSL tools. Returns
+    the path. """
+    first = nb.load(in_files[0])
+    shape = first.shape[:3] + (len(in_files),)
+
+    header = nb.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_zooms(first.header.get_zooms()[:3] + (1.,))
+    header.set_qform(first.affine, 1)
+    header.set_sform(first.affine, 1)
+    header.set_data_offset(352)
+
+    with open(out_file, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (352 - f.tell()))
+
+    merged = np.memmap(out_file, dtype=dtype, mode='r+', offset=352, shape=shape, order='F')
+
+    for i, fn in enumerate(in_files):
+        merged[..., i] = np.asarray(nb.load(fn).get_data()).reshape(shape[:3])
+
+    merged.flush()
+    del merged
+
+    return os.path.abspath(out_file)
+
+
+def load_stack(fn, mask=None):
+    """ A merged stack as a read-only memory map (uncompressed files), or
+    the (voxels x images) values within `mask`. """
+    data = nb.load(fn, mmap='r').get_data()
+    if mask is None:
+        return data
+    return data[mask]
+
+
+def split_mask(mask_file, n_chunks, out_dir='.'):
+    """ Splits a mask into `n_chunks` masks with (nearly) the same number
+    of voxels, as contiguous slabs along the last axis. Returns the chunk
+    mask files. """
+    mask_image = nb.load(mask_file)
+    mask = load_mask(mask_file)
+
+    voxels = np.flatnonzero(mask.ravel(order='F'))
+    chunk_files = []
+
+    for i, chunk_voxels in enumerate(np.array_split(voxels, max(1, min(n_chunks, len(voxels))))):
+        chunk = np.zeros(mask.size, dtype=np.uint8)
+        chunk[chunk_voxels] = 1
+        chunk_file = os.path.abspath(os.path.join(out_dir, 'chunk%d_mask.nii.gz' % i))
+        nb.save(nb.Nifti1Image(chunk.reshape(mask.shape, order='F'), mask_image.affine),
+                chunk_file)
+        chunk_files.append(chunk_file)
+
+    return chunk_files
+
+
+def assemble_chunks(chunk_results, chunk_masks, out_file):
+    """ Pastes every chunk's result (3D or 4D) into one image, taking each
+    chunk's values inside its own mask. """
+    first = nb.load(chunk_results[0])
+    data = np.zeros(first.shape, dtype=np.float32)
+
+    for fn, chunk_mask in zip(chunk_results, chunk_masks):
+        chunk_mask = load_mask(chunk_mask)
+        data[chunk_mask] = nb.load(fn).get_data()[chunk_mask]
+
+    return save_like(data, first, out_file)
+
+
+def mixed_effects(copes, varcopes, sigma_squared=None, max_iter=50, tol=1e-6):
+    """ One-sample mixed-effects mean over subjects (rows) for every voxel
+    (column), given the within-subject variances `varcopes`.
+
+    The between-subject variance is estimated by REML Fisher scoring,
+    starting from `sigma_squared` when given (e.g. the estimate before
+    the last subjects were added, which then converges in a few
+    iterations). Returns (cope, varcope, sigma_squared, n_iter). """
+    n = copes.shape[0]
+    varcopes = np.maximum(varcopes, 0)
+
+    if sigma_squared is None:
+        sigma_squared = np.maximum(copes.var(0, ddof=1) - varcopes.mean(0), 0)
+    sigma_squared = sigma_squared.copy()
+
+    for n_iter in range(1, max_iter + 1):
+        weights = 1. / np.maximum(varcopes + sigma_squared, 1e-12)
+        sum_weights = weights.sum(0)
+        cope = (weights * copes).sum(0) / sum_weights
+
+        residuals = copes - cope
+        score = 0.5 * ((weights * residuals) ** 2).sum(0) - 0.5 * sum_weights \
+            + 0.5 * (weights ** 2).sum(0) / sum_weights
+        information = 0.5 * (weights ** 2).sum(0)
+
+        step = score / information
+        sigma_squared = np.maximum(sigma_squared + step, 0)
+
+        if np.all(np.abs(step) <= tol * np.maximum(sigma_squared, 1)) or n < 3:
+            break
+
+    weights = 1. / np.maximum(varcopes + sigma_squared, 1e-12)
+    sum_weights = weights.sum(0)
+    cope = (weights * copes).sum(0) / sum_weights
+
+    return cope, 1. / sum_weights, sigma_squared, n_iter
+
+
+def _file_entry(fn):
+    fn = os.path.abspath(fn)
+    return [fn, os.path.getsize(fn), os.path.getmtime(fn)]
+
+
+class IncrementalGroupModel(object):
+    """ Mixed-effects group mean that keeps its inputs in `state_dir`.
+
+    The in-mask copes and varcopes of every subject seen so far are kept
+    as raw float64 (subjects x voxels) stacks that new subjects are
+    appended to, together with the subject list (path, size and mtime of
+    every file) and the last estimate. `update` only reads the images of
+    subjects that were appended to the list, warm-starts the estimate
+    from the stored between-subject variance and does nothing at all
+    when the list did not change. Any other change (removed, reordered
+    or modified subjects, another mask) rebuilds the state.
+
+    The subject list is written last, so an interrupted update leaves
+    stacks with extra rows. These are cut back to the listed subjects on
+    the next update. """
+
+    STACKS = ['copes.dat', 'varcopes.dat']
+
+    def __init__(self, state_dir):
+        self.state_dir = os.path.abspath(state_dir)
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+
+    def _path(self, fn):
+        return os.path.join(self.state_dir, fn)
+
+    def _load_subjects(self):
+        import json
+        try:
+            with open(self._path('subjects.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_subjects(self, subjects):
+        import json
+        with open(self._path('subjects.json.tmp'), 'w') as f:
+            json.dump(subjects, f, indent=1)
+        os.rename(self._path('subjects.json.tmp'), self._path('subjects.json'))
+
+    def _n_rows(self, name, n_voxels):
+        fn = self._path(name)
+        if not os.path.exists(fn):
+            return 0
+        if n_voxels == 0:
+            return None
+        return os.path.getsize(fn) // (8 * n_voxels)
+
+    def _truncate(self, name, n_rows, n_voxels):
+        with open(self._path(name), 'ab') as f:
+            f.truncate(8 * n_rows * n_voxels)
+
+    def _append(self, name, rows):
+        with open(self._path(name), 'ab') as f:
+            rows.astype(np.float64).tofile(f)
+
+    def _load_stack(self, name, n_rows, n_voxels):
+        return np.fromfile(self._path(name), dtype=np.float64,
+                           count=n_rows * n_voxels).reshape(n_rows, n_voxels)
+
+    def update(self, cope_files, varcope_files, mask_file):
+        """ Brings the state up to date with the subject list. Returns
+        (changed, n_new_subjects). """
+        subjects = {'mask': _file_entry(mask_file),
+                    'copes': [_file_entry(fn) for fn in cope_files],
+                    'varcopes': [_file_entry(fn) for fn in varcope_files]}
+        old = self._load_subjects()
+
+        if old == subjects and os.path.exists(self._path('result.npz')):
+            return False, 0
+
+        mask = load_mask(mask_file)
+        n_voxels = int(mask.sum())
+
+        n_old = 0
+        if old is not None and old['mask'] == subjects['mask'] \
+                and subjects['copes'][:len(old['copes'])] == old['copes'] \
+                and subjects['varcopes'][:len(old['varcopes'])] == old['varcopes'] \
+                and os.path.exists(self._path('result.npz')):
+            n_old = len(old['copes'])
+
+        # Rows beyond n_old come from an interrupted update, missing rows
+        # mean the stacks are damaged and everything is read again
+        for name in self.STACKS:
+            n_rows = self._n_rows(name, n_voxels)
+            if n_rows is not None and n_rows < n_old:
+                n_old = 0
+
+        for name in self.STACKS:
+            self._truncate(name, n_old, n_voxels)
+
+        new_copes = np.array([nb.load(fn).get_data()[mask] for fn in cope_files[n_old:]],
+                             dtype=np.float64).reshape(len(cope_files) - n_old, n_voxels)
+        new_varcopes = np.array([nb.load(fn).get_data()[mask] for fn in varcope_files[n_old:]],
+                                dtype=np.float64).reshape(len(cope_files) - n_old, n_voxels)
+
+        self._append('copes.dat', new_copes)
+        self._append('varcopes.dat', new_varcopes)
+
+        sigma_squared = None
+        if n_old:
+            sigma_squared = np.load(self._path('result.npz'))['sigma_squared']
+
+        copes = self._load_stack('copes.dat', len(cope_files), n_voxels)
+        varcopes = self._load_stack('varcopes.dat', len(cope_files), n_voxels)
+
+        cope, varcope, sigma_squared, n_iter = mixed_effects(copes, varcopes, sigma_squared)
+
+        with open(self._path('result.tmp.npz'), 'wb') as f:
+            np.savez(f, cope=cope, varcope=varcope, sigma_squared=sigma_squared,
+                     n_iter=n_iter, n=len(cope_files))
+        os.rename(self._path('result.tmp.npz'), self._path('result.npz'))
+
+        self._save_subjects(subjects)
+
+        return True, len(cope_files) - n_old
+
+    def write_results(self, mask_file, out_dir='.'):
+        """ Writes cope1, varcope1, zstat1 and mean_random_effects_var1
+        (FLAMEO's names) and returns their paths. """
+        from .glm import t_to_z
+
+        mask_image = nb.load(mask_file)
+        mask = load_mask(mask_file)
+        result = np.load(self._path('result.npz'))
+        n = int(result['n'])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.nan_to_num(t_to_z(result['cope'] / np.sqrt(result['varcope']), max(n - 1, 1)))
+
+        def path(name):
+            return os.path.abspath(os.path.join(out_dir, name))
+
+        return {'cope': _save_in_mask(result['cope'], mask, mask_image, path('cope1.nii.gz')),
+                'varcope': _save_in_mask(result['varcope'], mask, mask_image, path('varcope1.nii.gz')),
+                'zstat': _save_in_mask(z, mask, mask_image, path('zstat1.nii.gz')),
+                'sigma_squared': _save_in_mask(result['sigma_squared'], mask, mask_image,
+                                               path('mean_random_effects_var1.nii.gz'))}
@@ -5,12 +5,28 @@ from nipype.interfaces.base import (
     TraitedSpec,
     CommandLineInputSpec,
     CommandLine,
+    BaseInterface,
+    BaseInterfaceInputSpec,
+    InputMultiPath,
+    OutputMultiPath,
     File,
+    Directory,
     isdefined
 )
+from nipype.utils.filemanip import fname_presuffix
 import os
 
 from nipype.interfaces.fsl.base import FSLCommand, FSLCommandInputSpec
+from nipype.interfaces.fsl.preprocess import FAST, FASTInputSpec
+from nipype.interfaces.ants.registration import Registration, RegistrationInputSpec
+from nipype.interfaces.ants.resampling import ApplyTransforms
+
+from .cache import ResultCache, hash_file, _link_or_copy
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 class FDRInputSpec(FSLCommandInputSpec):
     p_values = traits.File(exists=True, mandatory=True, position=0, argstr='-i %s', genfile=True, desc='image of p-values')
@@ -43,3 +59,853 @@ class FDR(FSLCommand):
         if name == 'adjusted_p_values':
             return self._gen_outfilename()
         return None
+
+
+def _q_value(q):
+    """ FDR.q is a tuple, accept both forms. """
+    if isinstance(q, tuple):
+        return q[0]
+    return q
+
+
+class NumpyFDRInputSpec(BaseInterfaceInputSpec):
+    p_values = InputMultiPath(File(exists=True), mandatory=True, xor=['z_stats'], desc='image(s) of p-values')
+    z_stats = InputMultiPath(File(exists=True), mandatory=True, xor=['p_values'],
+                             desc='image(s) of z-values, converted to p-values in memory')
+    mask = File(exists=True, mandatory=True, desc='mask')
+    q = traits.Either(traits.Float(), traits.Tuple(traits.Float()), default=0.05, usedefault=True,
+                      desc='threshold, a float or a 1-tuple as for FDR')
+    method = traits.Enum('bh', 'by', usedefault=True, desc='Benjamini-Hochberg (bh) or Benjamini-Yekutieli (by)')
+    adjusted_p_values = InputMultiPath(File(), desc='FDR-adjusted p-value image(s)')
+
+
+class NumpyFDROutputSpec(TraitedSpec):
+    adjusted_p_values = OutputMultiPath(File(exists=True))
+    p_threshold = traits.List(traits.Float(), desc='uncorrected p-value threshold per image')
+
+
+class NumpyFDR(BaseInterface):
+    """ In-process replacement for `FDR` that adjusts all p-value images in
+    a single batch instead of running `fdr` once per image."""
+
+    input_spec = NumpyFDRInputSpec
+    output_spec = NumpyFDROutputSpec
+
+    def _run_interface(self, runtime):
+        from .stats import fdr_adjust_images
+
+        from_z = not isdefined(self.inputs.p_values)
+        in_files = self.inputs.z_stats if from_z else self.inputs.p_values
+
+        self._p_threshold = fdr_adjust_images(in_files,
+                                              self.inputs.mask,
+                                              self._gen_outfilenames(),
+                                              q=_q_value(self.inputs.q),
+                                              method=self.inputs.method,
+                                              from_z=from_z)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['adjusted_p_values'] = self._gen_outfilenames()
+        outputs['p_threshold'] = getattr(self, '_p_threshold', [])
+        return outputs
+
+    def _gen_outfilenames(self):
+        if isdefined(self.inputs.adjusted_p_values):
+            return [os.path.abspath(fn) for fn in self.inputs.adjusted_p_values]
+        if isdefined(self.inputs.p_values):
+            return gen_batch_fnames(self.inputs.p_values, '_adjusted')
+        return gen_batch_fnames(self.inputs.z_stats, '_pval_adjusted')
+
+
+def gen_batch_fnames(in_files, suffix):
+    out_files = [fname_presuffix(fn, suffix=suffix, newpath=os.getcwd())
+                 for fn in in_files]
+
+    # Every flameo run calls its output zstat1, so batched maps often
+    # share a basename
+    if len(set(out_files)) < len(out_files):
+        out_files = [fname_presuffix(fn, suffix='%s%d' % (suffix, i), newpath=os.getcwd())
+                     for i, fn in enumerate(in_files)]
+
+    return out_files
+
+
+class FDRThresholdInputSpec(BaseInterfaceInputSpec):
+    z_stats = InputMultiPath(File(exists=True), mandatory=True, desc='image(s) of z-values')
+    p_values = InputMultiPath(File(exists=True), desc='image(s) of p-values, one per z-stat. '
+                                                       'Computed from the z-stats when left undefined')
+    mask = File(exists=True, mandatory=True, desc='mask')
+    q = traits.Either(traits.Float(), traits.Tuple(traits.Float()), default=0.05, usedefault=True,
+                      desc='threshold, a float or a 1-tuple as for FDR')
+    method = traits.Enum('bh', 'by', usedefault=True, desc='Benjamini-Hochberg (bh) or Benjamini-Yekutieli (by)')
+
+
+class FDRThresholdOutputSpec(TraitedSpec):
+    thresholded_z_stats = OutputMultiPath(File(exists=True), desc='z-stats masked by FDR-adjusted p <= q')
+    adjusted_p_values = OutputMultiPath(File(exists=True))
+    p_threshold = traits.List(traits.Float(), desc='uncorrected p-value threshold per image')
+
+
+class FDRThreshold(BaseInterface):
+    """ Fused FDR, threshold and mask: reads every z-map and p-map once and
+    writes only the thresholded z-maps and adjusted p-maps."""
+
+    input_spec = FDRThresholdInputSpec
+    output_spec = FDRThresholdOutputSpec
+
+    def _run_interface(self, runtime):
+        from .stats import fdr_threshold_images
+
+        outputs = self._list_outputs()
+        p_values = self.inputs.p_values if isdefined(self.inputs.p_values) else None
+
+        self._p_threshold = fdr_threshold_images(self.inputs.z_stats,
+                                                 p_values,
+                                                 self.inputs.mask,
+                                                 outputs['thresholded_z_stats'],
+                                                 outputs['adjusted_p_values'],
+                                                 q=_q_value(self.inputs.q),
+                                                 method=self.inputs.method)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['thresholded_z_stats'] = gen_batch_fnames(self.inputs.z_stats, '_masked')
+        if isdefined(self.inputs.p_values):
+            outputs['adjusted_p_values'] = gen_batch_fnames(self.inputs.p_values, '_adjusted')
+        else:
+            outputs['adjusted_p_values'] = gen_batch_fnames(self.inputs.z_stats, '_pval_adjusted')
+        outputs['p_threshold'] = getattr(self, '_p_threshold', [])
+        return outputs
+
+
+def _flatten(value):
+    if isinstance(value, (list, tuple)):
+        return [item for v in value for item in _flatten(v)]
+    if isdefined(value) and value is not None:
+        return [value]
+    return []
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple)):
+        return [_hashable(v) for v in value]
+    if isinstance(value, string_types) and os.path.isfile(value):
+        return 'sha1:' + hash_file(value)
+    return value
+
+
+class ResultCacheMixin(object):
+    """ Looks up the outputs of a file-producing interface in a
+    `cache.ResultCache` before running it and stores them afterwards.
+
+    The key hashes the contents of the `_cache_input_files` inputs and of
+    any other input that points to an existing file, plus all remaining
+    defined inputs. Output names are stored relative to `_cache_stem()` so
+    a hit can be restored under a different input basename. An entry that
+    lacks any of the expected outputs is treated as a miss. Set
+    use_cache=False to bypass the cache. """
+
+    _cache_input_files = []
+    _cache_exclude = ['cache_dir', 'cache_max_size_gb', 'use_cache', 'environ']
+
+    def _cache_stem(self):
+        return None
+
+    def _cache_name(self, fn):
+        name = os.path.basename(fn)
+        stem = self._cache_stem()
+        if stem and name.startswith(stem):
+            return 'cached' + name[len(stem):]
+        return name
+
+    def _get_result_cache(self):
+        location = self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None
+        max_size_gb = self.inputs.cache_max_size_gb if isdefined(self.inputs.cache_max_size_gb) else None
+        return ResultCache(location, max_size_gb)
+
+    def _cache_key(self, cache):
+        files = [fn for name in self._cache_input_files
+                 for fn in _flatten(getattr(self.inputs, name))]
+
+        parameters = dict((name, _hashable(value))
+                          for name, value in self.inputs.get().items()
+                          if isdefined(value) and name not in self._cache_exclude
+                          and name not in self._cache_input_files)
+        parameters['interface'] = self.__class__.__name__
+
+        return cache.key(files, parameters)
+
+    def _run_interface(self, runtime):
+        cache = self._get_result_cache()
+        key = self._cache_key(cache)
+
+        expected = _flatten(list(self._list_outputs().values()))
+        names = [self._cache_name(fn) for fn in expected]
+
+        cached = cache.get(key) if self.inputs.use_cache else None
+
+        if cached is not None:
+            cached = dict((os.path.basename(fn), fn) for fn in cached)
+
+            if all(name in cached and os.path.isfile(cached[name]) for name in names):
+                for fn, name in zip(expected, names):
+                    _link_or_copy(cached[name], fn)
+
+                runtime.returncode = 0
+                runtime.stdout = runtime.stderr = 'Restored from cache entry %s' % key
+                return runtime
+
+            # Partial or stale entry, run again and replace it
+            cache.remove(key)
+
+        runtime = super(ResultCacheMixin, self)._run_interface(runtime)
+
+        if self.inputs.use_cache and getattr(runtime, 'returncode', 0) == 0:
+            produced = [(fn, name) for fn, name in zip(expected, names)
+                        if os.path.isfile(fn)]
+            cache.put(key,
+                      [fn for fn, _ in produced],
+                      info={'interface': self.__class__.__name__},
+                      names=[name for _, name in produced])
+
+        return runtime
+
+
+class CachedFASTInputSpec(FASTInputSpec):
+    cache_dir = Directory(desc='location of the result cache, defaults to '
+                               '$GILLES_WORKFLOWS_CACHE_DIR or ~/workflow_folders/cache')
+    cache_max_size_gb = traits.Float(desc='evict least recently used results beyond this size, '
+                                          'defaults to $GILLES_WORKFLOWS_CACHE_MAX_SIZE_GB or 20')
+    use_cache = traits.Bool(True, usedefault=True, desc='look up and store results in the cache')
+
+
+class CachedFAST(ResultCacheMixin, FAST):
+    """ FAST that reuses an earlier segmentation of the same image with the
+    same parameters, from any workflow that shares the cache. """
+
+    input_spec = CachedFASTInputSpec
+    _cache_input_files = ['in_files']
+
+    def _cache_stem(self):
+        if isdefined(self.inputs.out_basename):
+            return filemanip.split_filename(self.inputs.out_basename)[1]
+        return filemanip.split_filename(self.inputs.in_files[-1])[1]
+
+
+class CachedRegistrationInputSpec(RegistrationInputSpec):
+    cache_dir = Directory(desc='location of the result cache, defaults to '
+                               '$GILLES_WORKFLOWS_CACHE_DIR or ~/workflow_folders/cache')
+    cache_max_size_gb = traits.Float(desc='evict least recently used results beyond this size, '
+                                          'defaults to $GILLES_WORKFLOWS_CACHE_MAX_SIZE_GB or 20')
+    use_cache = traits.Bool(True, usedefault=True, desc='look up and store results in the cache')
+
+
+class CachedRegistration(ResultCacheMixin, Registration):
+    """ ANTs Registration that returns the stored transforms and warped
+    images when the same fixed and moving images were already registered
+    with the same parameters. """
+
+    input_spec = CachedRegistrationInputSpec
+    _cache_input_files = ['fixed_image', 'moving_image']
+    _cache_exclude = ResultCacheMixin._cache_exclude + ['num_threads']
+
+
+class BatchApplyTransformsInputSpec(BaseInterfaceInputSpec):
+    input_images = InputMultiPath(File(exists=True), desc='images to transform')
+    reference_image = File(exists=True, mandatory=True, desc='defines the output space')
+    transforms = InputMultiPath(File(exists=True), mandatory=True, desc='transform chain, as for ApplyTransforms')
+    invert_transform_flags = traits.List(traits.Bool(), desc='as for ApplyTransforms')
+    interpolation = traits.Str('Linear', usedefault=True, desc='as for ApplyTransforms')
+    n_procs = traits.Int(1, usedefault=True, desc='number of single-threaded antsApplyTransforms '
+                                                  'processes to run at once')
+    cache_dir = Directory(desc='location of the result cache, defaults to '
+                               '$GILLES_WORKFLOWS_CACHE_DIR or ~/workflow_folders/cache')
+
+
+class BatchApplyTransformsOutputSpec(TraitedSpec):
+    output_images = traits.List(File(exists=True), desc='transformed images, in the order of input_images')
+    composite_warp = File(desc='the transform chain composed into one displacement field')
+
+
+class BatchApplyTransforms(BaseInterface):
+    """ Composes the transform chain into a single displacement field on
+    the reference grid once (cached by content), then resamples all input
+    images with that field. """
+
+    input_spec = BatchApplyTransformsInputSpec
+    output_spec = BatchApplyTransformsOutputSpec
+
+    def _compose(self):
+        cache = ResultCache(self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None)
+
+        flags = self.inputs.invert_transform_flags if isdefined(self.inputs.invert_transform_flags) else []
+        key = cache.key([self.inputs.reference_image] + list(self.inputs.transforms),
+                        {'interface': 'composite_warp', 'invert_transform_flags': flags})
+
+        composite_warp = os.path.abspath('composite_warp.nii.gz')
+
+        if cache.restore(key, os.getcwd()) is not None:
+            return composite_warp
+
+        composer = ApplyTransforms(input_image=self.inputs.reference_image,
+                                   reference_image=self.inputs.reference_image,
+                                   transforms=self.inputs.transforms,
+                                   output_image=composite_warp,
+                                   print_out_composite_warp_file=True)
+        if flags:
+            composer.inputs.invert_transform_flags = flags
+        composer.run()
+
+        cache.put(key, [composite_warp], info={'interface': 'composite_warp'})
+
+        return composite_warp
+
+    def _run_interface(self, runtime):
+        from multiprocessing.pool import ThreadPool
+
+        input_images = self.inputs.input_images if isdefined(self.inputs.input_images) else []
+        output_images = self._list_outputs()['output_images']
+
+        if not input_images:
+            self._composite_warp = None
+            return runtime
+
+        self._composite_warp = self._compose()
+
+        def apply(args):
+            input_image, output_image = args
+            ApplyTransforms(input_image=input_image,
+                            reference_image=self.inputs.reference_image,
+                            transforms=[self._composite_warp],
+                            interpolation=self.inputs.interpolation,
+                            output_image=output_image,
+                            num_threads=1).run()
+
+        # The work happens in antsApplyTransforms subprocesses, so threads
+        # are enough to keep n_procs of them busy. Each is limited to one
+        # ITK thread so n_procs of them use n_procs cores
+        pool = ThreadPool(self.inputs.n_procs)
+        try:
+            pool.map(apply, zip(input_images, output_images))
+        finally:
+            pool.close()
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        input_images = self.inputs.input_images if isdefined(self.inputs.input_images) else []
+        outputs['output_images'] = gen_batch_fnames(input_images, '_trans')
+        if getattr(self, '_composite_warp', None):
+            outputs['composite_warp'] = self._composite_warp
+        return outputs
+
+
+class SharedLevel1DesignInputSpec(BaseInterfaceInputSpec):
+    functional_runs = InputMultiPath(File(exists=True), mandatory=True, desc='one 4D image per run')
+    event_files = traits.List(traits.List(File(exists=True)), mandatory=True,
+                              desc='per run, one FSL 1- to 3-column event file per condition')
+    realignment_parameters = InputMultiPath(File(exists=True), desc='per run, added as confounds')
+    interscan_interval = traits.Float(mandatory=True, desc='TR in seconds')
+    highpass_filter = traits.Float(128, usedefault=True, desc='high-pass filter cutoff in seconds, '
+                                                              "as SpecifyModel's high_pass_filter_cutoff")
+    bases = traits.Dict(desc="as for Level1Design, only {'dgamma': {'derivs': True/False}}")
+    contrasts = traits.List(traits.Any(), mandatory=True, desc='T contrasts, as for Level1Design. '
+                                                               'F contrasts are rejected')
+    cache_dir = Directory(desc='location of the result cache, defaults to '
+                               '$GILLES_WORKFLOWS_CACHE_DIR or ~/workflow_folders/cache')
+
+
+class SharedLevel1DesignOutputSpec(TraitedSpec):
+    design_files = traits.List(File(exists=True), desc='design.mat per run')
+    con_files = traits.List(File(exists=True), desc='design.con per run')
+
+
+class SharedLevel1Design(BaseInterface):
+    """ SpecifyModel, Level1Design and FEATModel for all runs at once. The
+    HRF basis and high-pass filter matrix are computed once per TR, run
+    length and filter and shared between runs (see `design`). """
+
+    input_spec = SharedLevel1DesignInputSpec
+    output_spec = SharedLevel1DesignOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nb
+        from .design import (check_design_options, level1_design, contrast_matrix,
+                             write_design_mat, write_design_con)
+
+        bases = self.inputs.bases if isdefined(self.inputs.bases) else None
+        check_design_options(bases, self.inputs.contrasts)
+
+        cache_dir = self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None
+        outputs = self._list_outputs()
+
+        for i, (run, event_files) in enumerate(zip(self.inputs.functional_runs, self.inputs.event_files)):
+            realignment_parameters = None
+            if isdefined(self.inputs.realignment_parameters):
+                realignment_parameters = self.inputs.realignment_parameters[i]
+
+            design, names, real_columns = level1_design(event_files,
+                                                        nb.load(run).shape[3],
+                                                        self.inputs.interscan_interval,
+                                                        self.inputs.highpass_filter,
+                                                        bases,
+                                                        realignment_parameters,
+                                                        cache_dir)
+
+            write_design_mat(design, outputs['design_files'][i])
+            write_design_con(self.inputs.contrasts,
+                             contrast_matrix(self.inputs.contrasts, names, real_columns),
+                             outputs['con_files'][i])
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        n_runs = len(self.inputs.functional_runs)
+        outputs['design_files'] = [os.path.abspath('run%d.mat' % i) for i in range(n_runs)]
+        outputs['con_files'] = [os.path.abspath('run%d.con' % i) for i in range(n_runs)]
+        return outputs
+
+
+class BatchFILMGLSInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True, desc='one 4D image per run')
+    design_files = InputMultiPath(File(exists=True), mandatory=True, desc='design.mat per run')
+    tcon_files = InputMultiPath(File(exists=True), mandatory=True, desc='design.con per run')
+    threshold = traits.Float(1000, usedefault=True, desc='as for FILMGLS')
+    autocorr_noestimate = traits.Bool(False, usedefault=True, desc='do not model serial correlations')
+    n_procs = traits.Int(1, usedefault=True, desc='number of film_gls processes to run at once')
+
+
+class BatchFILMGLSOutputSpec(TraitedSpec):
+    copes = traits.List(traits.List(File(exists=True)), desc='per run, one cope per contrast')
+    varcopes = traits.List(traits.List(File(exists=True)), desc='per run, one varcope per contrast')
+    zstats = traits.List(traits.List(File(exists=True)), desc='per run, one zstat per contrast')
+    dof_file = traits.List(File(exists=True), desc='per run')
+
+
+def _listify(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+class BatchFILMGLS(BaseInterface):
+    """ Fits all runs with FILMGLS, `n_procs` runs at a time, each in its
+    own results directory (run0, run1, ...). """
+
+    input_spec = BatchFILMGLSInputSpec
+    output_spec = BatchFILMGLSOutputSpec
+
+    def _run_interface(self, runtime):
+        from multiprocessing.pool import ThreadPool
+        from nipype.interfaces.fsl import FILMGLS
+
+        def fit(args):
+            i, (in_file, design_file, tcon_file) = args
+            film = FILMGLS(in_file=in_file,
+                           design_file=design_file,
+                           tcon_file=tcon_file,
+                           threshold=self.inputs.threshold,
+                           smooth_autocorr=True,
+                           mask_size=5,
+                           results_dir=os.path.abspath('run%d' % i))
+            if self.inputs.autocorr_noestimate:
+                film.inputs.autocorr_noestimate = True
+            return film.run().outputs
+
+        # film_gls runs as a subprocess, so threads are enough to keep
+        # n_procs of them busy
+        pool = ThreadPool(self.inputs.n_procs)
+        try:
+            self._results = pool.map(fit, enumerate(zip(self.inputs.in_files,
+                                                        self.inputs.design_files,
+                                                        self.inputs.tcon_files)))
+        finally:
+            pool.close()
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        results = getattr(self, '_results', [])
+        outputs['copes'] = [_listify(result.copes) for result in results]
+        outputs['varcopes'] = [_listify(result.varcopes) for result in results]
+        outputs['zstats'] = [_listify(result.zstats) for result in results]
+        outputs['dof_file'] = [result.dof_file for result in results]
+        return outputs
+
+
+class NumpyGLMInputSpec(BatchFILMGLSInputSpec):
+    n_procs = traits.Int(1, usedefault=True, desc='number of runs to fit at once, one at a time '
+                                                  'inside a MultiProc worker')
+
+
+class NumpyGLM(BaseInterface):
+    """ In-process drop-in for `BatchFILMGLS`: one batched least-squares
+    fit per run, with AR(1) prewhitening unless autocorr_noestimate is
+    set (see `glm`). """
+
+    input_spec = NumpyGLMInputSpec
+    output_spec = BatchFILMGLSOutputSpec
+
+    def _run_interface(self, runtime):
+        from .glm import fit_runs
+
+        self._results = fit_runs(self.inputs.in_files,
+                                 self.inputs.design_files,
+                                 self.inputs.tcon_files,
+                                 [os.path.abspath('run%d' % i) for i in range(len(self.inputs.in_files))],
+                                 threshold=self.inputs.threshold,
+                                 prewhiten=not self.inputs.autocorr_noestimate,
+                                 n_procs=self.inputs.n_procs)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        results = getattr(self, '_results', [])
+        for name in ['copes', 'varcopes', 'zstats', 'dof_file']:
+            outputs[name] = [result[name] for result in results]
+        return outputs
+
+
+class NumpyFixedEffectsInputSpec(BaseInterfaceInputSpec):
+    copes = traits.List(traits.List(File(exists=True)), mandatory=True,
+                        desc='per contrast, the copes of every run')
+    varcopes = traits.List(traits.List(File(exists=True)), mandatory=True,
+                           desc='per contrast, the varcopes of every run')
+    dof_files = InputMultiPath(File(exists=True), mandatory=True, desc='FILM dof file per run')
+    mask = File(exists=True, mandatory=True, desc='mask')
+
+
+class NumpyFixedEffectsOutputSpec(TraitedSpec):
+    copes = OutputMultiPath(File(exists=True), desc='per contrast')
+    varcopes = OutputMultiPath(File(exists=True), desc='per contrast')
+    zstats = OutputMultiPath(File(exists=True), desc='per contrast')
+    tdof = OutputMultiPath(File(exists=True), desc='per contrast')
+
+
+class NumpyFixedEffects(BaseInterface):
+    """ In-process replacement for create_fixed_effects_flow: streams the
+    run copes and varcopes of each contrast once and writes the combined
+    cope, varcope, z and tdof, without merged 4D intermediates. """
+
+    input_spec = NumpyFixedEffectsInputSpec
+    output_spec = NumpyFixedEffectsOutputSpec
+
+    def _run_interface(self, runtime):
+        from .group import fixed_effects_images
+
+        self._outputs = fixed_effects_images(self.inputs.copes,
+                                             self.inputs.varcopes,
+                                             self.inputs.dof_files,
+                                             self.inputs.mask,
+                                             os.getcwd())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs.update(getattr(self, '_outputs', {}))
+        return outputs
+
+
+class ScratchMergeInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(File(exists=True), mandatory=True, desc='3D images to stack')
+    scratch_dir = Directory(desc='where to write the stack, defaults to '
+                                 '$GILLES_WORKFLOWS_SCRATCH_DIR or the system temp directory')
+
+
+class ScratchMergeOutputSpec(TraitedSpec):
+    merged_file = File(exists=True, desc='uncompressed, memory-mappable 4D stack')
+    merge_seconds = traits.Float(desc='time spent merging')
+    merged_bytes = traits.Int(desc='size of the stack on disk')
+
+
+class ScratchMerge(BaseInterface):
+    """ fsl.Merge(dimension='t') replacement that writes an uncompressed
+    stack to a scratch directory instead of a gzipped one to the node
+    directory. The name depends on the node directory and the inputs, so
+    reruns overwrite rather than accumulate stacks and different
+    workflows never share one.
+
+    The node always runs, but only merges again when the stack is
+    missing (e.g. the scratch directory was cleaned) or the inputs
+    changed since it was written. """
+
+    input_spec = ScratchMergeInputSpec
+    output_spec = ScratchMergeOutputSpec
+    always_run = True
+
+    def _merged_file(self):
+        import hashlib
+        from .group import default_scratch_dir
+
+        scratch_dir = self.inputs.scratch_dir if isdefined(self.inputs.scratch_dir) else default_scratch_dir()
+        key = hashlib.sha1(''.join([os.getcwd()] + [os.path.abspath(fn) for fn in self.inputs.in_files]).encode()).hexdigest()
+
+        return os.path.join(os.path.abspath(scratch_dir), 'merged_%s.nii' % key[:16])
+
+    def _stamp(self):
+        return [[os.path.abspath(fn), os.path.getsize(fn), os.path.getmtime(fn)]
+                for fn in self.inputs.in_files]
+
+    def _run_interface(self, runtime):
+        import json
+        import time
+        from .group import merge_images
+
+        merged_file = self._merged_file()
+        stamp_file = merged_file[:-len('.nii')] + '.json'
+        stamp = self._stamp()
+
+        self._merge_seconds = 0.
+
+        try:
+            with open(stamp_file) as f:
+                if os.path.exists(merged_file) and json.load(f) == stamp:
+                    return runtime
+        except (IOError, OSError, ValueError):
+            pass
+
+        if not os.path.isdir(os.path.dirname(merged_file)):
+            os.makedirs(os.path.dirname(merged_file))
+
+        t0 = time.time()
+        merge_images(self.inputs.in_files, merged_file + '.tmp')
+        os.rename(merged_file + '.tmp', merged_file)
+        self._merge_seconds = time.time() - t0
+
+        with open(stamp_file, 'w') as f:
+            json.dump(stamp, f)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['merged_file'] = self._merged_file()
+        if hasattr(self, '_merge_seconds'):
+            outputs['merge_seconds'] = self._merge_seconds
+            outputs['merged_bytes'] = os.path.getsize(outputs['merged_file'])
+        return outputs
+
+
+class ChunkedFLAMEOInputSpec(BaseInterfaceInputSpec):
+    cope_file = File(exists=True, mandatory=True, desc='as for FLAMEO')
+    var_cope_file = File(exists=True, desc='as for FLAMEO')
+    dof_var_cope_file = File(exists=True, desc='as for FLAMEO')
+    mask_file = File(exists=True, mandatory=True, desc='as for FLAMEO')
+    design_file = File(exists=True, mandatory=True, desc='as for FLAMEO')
+    t_con_file = File(exists=True, mandatory=True, desc='as for FLAMEO')
+    cov_split_file = File(exists=True, mandatory=True, desc='as for FLAMEO')
+    run_mode = traits.Enum('fe', 'ols', 'flame1', 'flame12', mandatory=True, desc='as for FLAMEO')
+    n_chunks = traits.Int(4, usedefault=True, desc='number of sub-masks to split the mask into')
+    n_procs = traits.Int(1, usedefault=True, desc='number of flameo processes to run at once')
+
+
+class ChunkedFLAMEOOutputSpec(TraitedSpec):
+    pes = OutputMultiPath(File(exists=True))
+    res4d = OutputMultiPath(File(exists=True))
+    copes = OutputMultiPath(File(exists=True))
+    var_copes = OutputMultiPath(File(exists=True))
+    zstats = OutputMultiPath(File(exists=True))
+    tstats = OutputMultiPath(File(exists=True))
+    tdof = OutputMultiPath(File(exists=True))
+
+
+class ChunkedFLAMEO(BaseInterface):
+    """ FLAMEO on `n_chunks` disjoint sub-masks, `n_procs` at a time, with
+    the chunk results pasted back into whole-mask images in `stats/`.
+    FLAME1 estimates every voxel on its own, so the results are the same
+    as one whole-brain run. """
+
+    input_spec = ChunkedFLAMEOInputSpec
+    output_spec = ChunkedFLAMEOOutputSpec
+
+    _assembled = ['pes', 'res4d', 'copes', 'var_copes', 'zstats', 'tstats', 'tdof']
+
+    def _run_interface(self, runtime):
+        from multiprocessing.pool import ThreadPool
+        from nipype.interfaces.fsl import FLAMEO
+        from .group import split_mask, assemble_chunks
+
+        chunk_masks = split_mask(self.inputs.mask_file, self.inputs.n_chunks)
+
+        def run_chunk(args):
+            i, chunk_mask = args
+            flameo = FLAMEO(mask_file=chunk_mask,
+                            log_dir=os.path.abspath('chunk%d' % i))
+            for name in ['cope_file', 'var_cope_file', 'dof_var_cope_file', 'design_file',
+                         't_con_file', 'cov_split_file', 'run_mode']:
+                value = getattr(self.inputs, name)
+                if isdefined(value):
+                    setattr(flameo.inputs, name, value)
+            return flameo.run().outputs
+
+        # flameo runs as a subprocess, so threads are enough to keep
+        # n_procs of them busy
+        pool = ThreadPool(self.inputs.n_procs)
+        try:
+            results = pool.map(run_chunk, enumerate(chunk_masks))
+        finally:
+            pool.close()
+
+        if not os.path.isdir('stats'):
+            os.makedirs('stats')
+
+        self._outputs = {}
+        for name in self._assembled:
+            chunk_files = [_listify(getattr(result, name)) for result in results]
+            if not isdefined(chunk_files[0][0]):
+                continue
+
+            self._outputs[name] = [assemble_chunks(list(files), chunk_masks,
+                                                   os.path.join('stats', os.path.basename(files[0])))
+                                   for files in zip(*chunk_files)]
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs.update(getattr(self, '_outputs', {}))
+        return outputs
+
+
+class IncrementalRandomEffectsInputSpec(BaseInterfaceInputSpec):
+    cope_files = InputMultiPath(File(exists=True), mandatory=True, desc='one cope per subject')
+    varcope_files = InputMultiPath(File(exists=True), mandatory=True, desc='one varcope per subject')
+    mask_file = File(exists=True, mandatory=True, desc='mask')
+    state_dir = Directory(mandatory=True, desc='where the stacks and statistics are kept between runs')
+
+
+class IncrementalRandomEffectsOutputSpec(TraitedSpec):
+    copes = OutputMultiPath(File(exists=True))
+    var_copes = OutputMultiPath(File(exists=True))
+    zstats = OutputMultiPath(File(exists=True))
+    mean_random_effects_var = OutputMultiPath(File(exists=True))
+    n_new_subjects = traits.Int(desc='subjects added since the last run')
+
+
+class IncrementalRandomEffects(BaseInterface):
+    """ Mixed-effects group mean that only reads the subjects added since
+    its last run on the same `state_dir` (see `group.IncrementalGroupModel`). """
+
+    input_spec = IncrementalRandomEffectsInputSpec
+    output_spec = IncrementalRandomEffectsOutputSpec
+
+    def _run_interface(self, runtime):
+        from .group import IncrementalGroupModel
+
+        model = IncrementalGroupModel(self.inputs.state_dir)
+        _, self._n_new_subjects = model.update(self.inputs.cope_files,
+                                               self.inputs.varcope_files,
+                                               self.inputs.mask_file)
+        self._results = model.write_results(self.inputs.mask_file)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        results = getattr(self, '_results', None)
+        if results is not None:
+            outputs['copes'] = results['cope']
+            outputs['var_copes'] = results['varcope']
+            outputs['zstats'] = results['zstat']
+            outputs['mean_random_effects_var'] = results['sigma_squared']
+            outputs['n_new_subjects'] = self._n_new_subjects
+        return outputs
+
+
+class NumpyClusterInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc='statistic map')
+    thresholds = traits.List(traits.Float(), [2.0], usedefault=True,
+                             desc='cluster-forming thresholds, all computed from one load')
+    connectivity = traits.Enum(26, 18, 6, usedefault=True, desc='voxel neighbourhood')
+    n_maxima = traits.Int(6, usedefault=True, desc='local maxima reported per cluster')
+    cache_dir = Directory(desc='location of the result cache, defaults to '
+                               '$GILLES_WORKFLOWS_CACHE_DIR or ~/workflow_folders/cache')
+    cache_max_size_gb = traits.Float(desc='evict least recently used results beyond this size, '
+                                          'defaults to $GILLES_WORKFLOWS_CACHE_MAX_SIZE_GB or 20')
+    use_cache = traits.Bool(True, usedefault=True, desc='look up and store results in the cache')
+
+
+class NumpyClusterOutputSpec(TraitedSpec):
+    index_file = OutputMultiPath(File(exists=True), desc='cluster label map per threshold')
+    localmax_txt_file = OutputMultiPath(File(exists=True), desc='local maxima per threshold, '
+                                                                'in the format of cluster --olmax')
+    table_file = OutputMultiPath(File(exists=True), desc='per-cluster table per threshold')
+
+
+class NumpyCluster(BaseInterface):
+    """ In-process `fsl.Cluster` for several thresholds at once (see
+    `cluster`). """
+
+    input_spec = NumpyClusterInputSpec
+    output_spec = NumpyClusterOutputSpec
+
+    def _run_interface(self, runtime):
+        from .cluster import cluster_image
+
+        self._results = cluster_image(self.inputs.in_file,
+                                      self.inputs.thresholds,
+                                      self.inputs.connectivity,
+                                      self.inputs.n_maxima,
+                                      cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None,
+                                      use_cache=self.inputs.use_cache,
+                                      cache_max_size_gb=self.inputs.cache_max_size_gb
+                                      if isdefined(self.inputs.cache_max_size_gb) else None)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        results = getattr(self, '_results', [])
+        if results:
+            outputs['index_file'] = [result[0] for result in results]
+            outputs['localmax_txt_file'] = [result[1] for result in results]
+            outputs['table_file'] = [result[2] for result in results]
+        return outputs
+
+
+class SignFlipPermutationInputSpec(BaseInterfaceInputSpec):
+    cope_files = InputMultiPath(File(exists=True), mandatory=True, desc='one cope per subject')
+    mask_file = File(exists=True, mandatory=True, desc='mask')
+    n_permutations = traits.Int(5000, usedefault=True, desc='all sign flips are used when there are fewer')
+    cluster_threshold = traits.Float(3., usedefault=True, desc='t threshold for cluster-mass inference')
+    seed = traits.Int(0, usedefault=True, desc='results only depend on the seed, not on n_procs')
+    n_procs = traits.Int(1, usedefault=True, desc='number of threads running permutation batches')
+    batch_size = traits.Int(100, usedefault=True, desc='permutations per matrix product')
+    base_name = traits.Str('randomise', usedefault=True, desc='output file prefix')
+
+
+class SignFlipPermutationOutputSpec(TraitedSpec):
+    tstat = File(exists=True)
+    vox_corrp = File(exists=True, desc='1 - max-statistic FWE p-value')
+    clusterm_corrp = File(exists=True, desc='1 - cluster-mass FWE p-value')
+
+
+class SignFlipPermutation(BaseInterface):
+    """ In-process `randomise -1` with max-statistic and cluster-mass
+    correction (see `permutation`). """
+
+    input_spec = SignFlipPermutationInputSpec
+    output_spec = SignFlipPermutationOutputSpec
+
+    def _run_interface(self, runtime):
+        from .permutation import permutation_test_images
+
+        self._results = permutation_test_images(self.inputs.cope_files,
+                                                self.inputs.mask_file,
+                                                base_name=self.inputs.base_name,
+                                                n_permutations=self.inputs.n_permutations,
+                                                cluster_threshold=self.inputs.cluster_threshold,
+                                                seed=self.inputs.seed,
+                                                n_procs=self.inputs.n_procs,
+                                                batch_size=self.inputs.batch_size)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs.update(getattr(self, '_results', {}))
+        return outputs
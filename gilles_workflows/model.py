@@ -1,5 +1,7 @@
 import os
-from . import FDR
+from .interfaces import (FDR, NumpyFDR, FDRThreshold, SharedLevel1Design, BatchFILMGLS, NumpyGLM,
+                         NumpyFixedEffects, ScratchMerge, ChunkedFLAMEO,
+                         IncrementalRandomEffects, NumpyCluster, SignFlipPermutation)
 
 import nipype.pipeline.engine as pe
 import nipype.interfaces.ants as ants
@@ -10,7 +12,52 @@ from nipype.workflows.fmri.fsl import create_modelfit_workflow, create_fixed_eff
 
 from nipype.algorithms.modelgen import SpecifyModel
 
-def create_fdr_threshold_workflow(name='fdr_threshold'):
+def num_copes(files):
+    return len(files)
+
+
+def transpose_copes(copes):    
+    import numpy as np
+    return np.array(copes).T.tolist()
+
+
+def listify(x):
+    return [x]
+
+
+def get_highpas_filter_cutoff(hz, tr):
+    return float(hz) / (tr * 2)
+
+
+def negate(x):
+    return not x
+
+
+def first_threshold(files):
+    """ From a list (per map) of one-or-more-files-per-threshold outputs,
+    the file of the first threshold for every map. """
+    return [f[0] if isinstance(f, list) else f for f in files]
+
+
+def sum_merge_reports(cope_seconds, cope_bytes, varcope_seconds, varcope_bytes,
+                      tdof_seconds, tdof_bytes):
+    def total(values):
+        if isinstance(values, list):
+            return sum(values)
+        return values
+
+    return (total(cope_seconds) + total(varcope_seconds) + tdof_seconds,
+            total(cope_bytes) + total(varcope_bytes) + tdof_bytes)
+
+
+def create_fdr_threshold_workflow(name='fdr_threshold', engine=None, fused=False,
+                                  p_from_z=False):
+    """ engine='fsl' (the default) runs FSL's `fdr` once per map,
+    engine='numpy' adjusts all p-value maps in-process in one node.
+    fused=True does the FDR adjustment, thresholding and masking in a
+    single in-process node, so it cannot be combined with engine='fsl'.
+    With p_from_z=True the p-values are computed from `z_stats` and
+    `inputspec.p_values` is ignored. """
     
     workflow = pe.Workflow(name=name)
     
@@ -21,9 +68,55 @@ def create_fdr_threshold_workflow(name='fdr_threshold'):
 
     inputspec.inputs.q = 0.05
 
-    fdr = pe.MapNode(FDR(), iterfield=['p_values'], name='fdr')
+    outputspec = pe.Node(util.IdentityInterface(fields=['thresholded_z_stats',
+        'adjusted_p_values']), name='outputspec')
+
+    if fused and engine == 'fsl':
+        raise ValueError('fused=True always runs in-process, it cannot use engine="fsl"')
+
+    if engine is None:
+        engine = 'numpy' if fused else 'fsl'
+
+    if fused:
+        fdr_thresholder = pe.Node(FDRThreshold(), name='fdr_thresholder')
+
+        for field in ['z_stats', 'mask', 'q']:
+            workflow.connect(inputspec, field, fdr_thresholder, field)
+
+        if not p_from_z:
+            workflow.connect(inputspec, 'p_values', fdr_thresholder, 'p_values')
+
+        workflow.connect(fdr_thresholder, 'thresholded_z_stats', outputspec, 'thresholded_z_stats')
+        workflow.connect(fdr_thresholder, 'adjusted_p_values', outputspec, 'adjusted_p_values')
+
+        return workflow
+
+    if engine == 'numpy':
+        fdr = pe.Node(NumpyFDR(), name='fdr')
+        workflow.connect(inputspec, 'q', fdr, 'q')
+
+        if p_from_z:
+            workflow.connect(inputspec, 'z_stats', fdr, 'z_stats')
+        else:
+            workflow.connect(inputspec, 'p_values', fdr, 'p_values')
+
+    elif engine == 'fsl':
+        fdr = pe.MapNode(FDR(), iterfield=['p_values'], name='fdr')
+
+        if p_from_z:
+            ztopval = pe.MapNode(interface=fsl.ImageMaths(op_string='-ztop',
+                                                          suffix='_pval'),
+                                 iterfield=['in_file'],
+                                 nested=True,
+                                 name='ztop',)
+            workflow.connect(inputspec, 'z_stats', ztopval, 'in_file')
+            workflow.connect(ztopval, 'out_file', fdr, 'p_values')
+        else:
+            workflow.connect(inputspec, 'p_values', fdr, 'p_values')
+
+    else:
+        raise ValueError('Unknown FDR engine %r, use "numpy" or "fsl"' % engine)
 
-    workflow.connect(inputspec, 'p_values', fdr, 'p_values')
     workflow.connect(inputspec, 'mask', fdr, 'mask')
 
     thresholder = pe.MapNode(fsl.Threshold(), iterfield=['in_file'], name='thresholder')
@@ -35,16 +128,32 @@ def create_fdr_threshold_workflow(name='fdr_threshold'):
     workflow.connect(thresholder, 'out_file', masker, 'mask_file')
     workflow.connect(inputspec, 'z_stats', masker, 'in_file')
 
-    outputspec = pe.Node(util.IdentityInterface(fields=['thresholded_z_stats',
-        'adjusted_p_values']), name='outputspec')
-
     workflow.connect(masker, 'out_file', outputspec, 'thresholded_z_stats')
     workflow.connect(fdr, 'adjusted_p_values', outputspec, 'adjusted_p_values')
 
     return workflow
     
     
-def create_modelfit_workflow_bfsl(name='modelfit_workflow_bfsl'):
+def create_modelfit_workflow_bfsl(name='modelfit_workflow_bfsl', shared_design=False, n_procs=1,
+                                  glm_engine='film', fixedfx_engine='flameo', fdr_engine='numpy'):
+    """ With shared_design=True all runs are modelled by two nodes: one
+    that builds every run's design from an HRF basis and high-pass filter
+    computed once per TR, run length and filter (and cached across
+    subjects), and one that runs FILMGLS on `n_procs` runs at a time.
+    Both paths filter with the same cutoff, derived from
+    `inputspec.highpass_filter` by get_highpas_filter_cutoff. The shared
+    design only supports the dgamma basis and T contrasts.
+
+    glm_engine='numpy' fits the runs in-process instead of with FILMGLS
+    (AR(1) prewhitening when model_serial_correlations is set) and implies
+    shared_design.
+
+    fixedfx_engine='numpy' combines the runs in-process instead of with
+    create_fixed_effects_flow (Merge, gendofvolume and FLAMEO).
+
+    fdr_engine is passed to create_fdr_threshold_workflow; the default
+    'numpy' computes the p-values from the z-stats in memory, 'fsl' runs
+    fslmaths -ztop and fdr per map. """
     
     
     inputspec = pe.Node(util.IdentityInterface(fields=['functional_runs',
@@ -61,83 +170,112 @@ def create_modelfit_workflow_bfsl(name='modelfit_workflow_bfsl'):
     
     workflow = pe.Workflow(name=name)
 
-        
-    
-
-    modelfit_workflow = create_modelfit_workflow()                      
-                        
     inputspec.inputs.bases = {'dgamma': {'derivs': True}}
     inputspec.inputs.film_threshold = 1000
     inputspec.inputs.interscan_interval = 2.0
     inputspec.inputs.model_serial_correlations = True
     inputspec.inputs.highpass_filter = 128
-    
-    
-
-    for field in ['bases', 'contrasts', 'film_threshold', 'interscan_interval', 'model_serial_correlations']:
-        workflow.connect(inputspec, field, modelfit_workflow, 'inputspec.%s' % field)
 
+    if glm_engine not in ['film', 'numpy']:
+        raise ValueError('Unknown GLM engine %r, use "film" or "numpy"' % glm_engine)
 
-    from nipype.algorithms.modelgen import SpecifyModel
-    from nipype.interfaces import fsl
-
-    specifymodel = pe.Node(SpecifyModel(), name='specifymodel')
-    specifymodel.inputs.input_units = 'secs'
-    
-    def get_highpas_filter_cutoff(hz, tr):
-        return float(hz) / (tr * 2)
-    
+    # Both design paths get the same cutoff
     get_highpas_filter_cutoff_node = pe.Node(util.Function(function=get_highpas_filter_cutoff,
                                                            input_names=['hz', 'tr'],
                                                            output_names='cutoff'),
                                             name='get_highpas_filter_cutoff_node')
-    
+
     workflow.connect(inputspec, 'interscan_interval', get_highpas_filter_cutoff_node, 'tr')
-    workflow.connect(inputspec, 'highpass_filter', get_highpas_filter_cutoff_node, 'hz')    
-    workflow.connect(get_highpas_filter_cutoff_node, 'cutoff', specifymodel, 'high_pass_filter_cutoff')
-    
-    workflow.connect(inputspec, 'interscan_interval', specifymodel, 'time_repetition')    
-    workflow.connect(inputspec, 'bfsl_files', specifymodel, 'event_files')
-    workflow.connect(inputspec, 'functional_runs', specifymodel, 'functional_runs')
-    workflow.connect(inputspec, 'realignment_parameters', specifymodel, 'realignment_parameters')    
-    
-    workflow.connect(specifymodel, 'session_info', modelfit_workflow, 'inputspec.session_info')
-    workflow.connect(inputspec, 'functional_runs', modelfit_workflow, 'inputspec.functional_data')
+    workflow.connect(inputspec, 'highpass_filter', get_highpas_filter_cutoff_node, 'hz')
+
+    if shared_design or glm_engine == 'numpy':
+        level1design = pe.Node(SharedLevel1Design(), name='level1design')
+
+        for field in ['bases', 'contrasts', 'interscan_interval',
+                      'functional_runs', 'realignment_parameters']:
+            workflow.connect(inputspec, field, level1design, field)
+        workflow.connect(get_highpas_filter_cutoff_node, 'cutoff', level1design, 'highpass_filter')
+        workflow.connect(inputspec, 'bfsl_files', level1design, 'event_files')
+
+        if glm_engine == 'numpy':
+            modelestimate = pe.Node(NumpyGLM(n_procs=n_procs), name='modelestimate')
+        else:
+            modelestimate = pe.Node(BatchFILMGLS(n_procs=n_procs), name='modelestimate')
+
+        workflow.connect(inputspec, 'functional_runs', modelestimate, 'in_files')
+        workflow.connect(inputspec, 'film_threshold', modelestimate, 'threshold')
+        workflow.connect(inputspec, ('model_serial_correlations', negate), modelestimate, 'autocorr_noestimate')
+        workflow.connect(level1design, 'design_files', modelestimate, 'design_files')
+        workflow.connect(level1design, 'con_files', modelestimate, 'tcon_files')
+
+        level1, level1_fields = modelestimate, {'copes': 'copes',
+                                                'varcopes': 'varcopes',
+                                                'dof_file': 'dof_file'}
 
+    else:
+        modelfit_workflow = create_modelfit_workflow()
 
-    fixedfx = create_fixed_effects_flow()
+        for field in ['bases', 'contrasts', 'film_threshold', 'interscan_interval', 'model_serial_correlations']:
+            workflow.connect(inputspec, field, modelfit_workflow, 'inputspec.%s' % field)
 
-    workflow.connect(inputspec, 'mask', fixedfx, 'flameo.mask_file')
+        specifymodel = pe.Node(SpecifyModel(), name='specifymodel')
+        specifymodel.inputs.input_units = 'secs'
+        
+        workflow.connect(get_highpas_filter_cutoff_node, 'cutoff', specifymodel, 'high_pass_filter_cutoff')
+        
+        workflow.connect(inputspec, 'interscan_interval', specifymodel, 'time_repetition')    
+        workflow.connect(inputspec, 'bfsl_files', specifymodel, 'event_files')
+        workflow.connect(inputspec, 'functional_runs', specifymodel, 'functional_runs')
+        workflow.connect(inputspec, 'realignment_parameters', specifymodel, 'realignment_parameters')    
+        
+        workflow.connect(specifymodel, 'session_info', modelfit_workflow, 'inputspec.session_info')
+        workflow.connect(inputspec, 'functional_runs', modelfit_workflow, 'inputspec.functional_data')
+
+        level1, level1_fields = modelfit_workflow, {'copes': 'outputspec.copes',
+                                                    'varcopes': 'outputspec.varcopes',
+                                                    'dof_file': 'outputspec.dof_file'}
+
+
+    if fixedfx_engine == 'numpy':
+        fixedfx = pe.Node(NumpyFixedEffects(), name='fixedfx')
+
+        workflow.connect(inputspec, 'mask', fixedfx, 'mask')
 
-    def num_copes(files):
-        return len(files)
+        workflow.connect([(level1, fixedfx,
+                           [((level1_fields['copes'], transpose_copes), 'copes'),
+                            ((level1_fields['varcopes'], transpose_copes), 'varcopes'),
+                            (level1_fields['dof_file'], 'dof_files')])])
 
-    def transpose_copes(copes):    
-        import numpy as np
-        return np.array(copes).T.tolist()
+        fixedfx_fields = {'zstats': 'zstats',
+                          'copes': 'copes',
+                          'varcopes': 'varcopes',
+                          'tdof': 'tdof'}
 
-    workflow.connect([(modelfit_workflow, fixedfx,
-                       [(('outputspec.copes', transpose_copes), 'inputspec.copes'),
-                        (('outputspec.varcopes', transpose_copes), 'inputspec.varcopes'),
-                        ('outputspec.dof_file', 'inputspec.dof_files'),
-                        (('outputspec.copes', num_copes), 'l2model.num_copes')])])
+    elif fixedfx_engine == 'flameo':
+        fixedfx = create_fixed_effects_flow()
 
+        workflow.connect(inputspec, 'mask', fixedfx, 'flameo.mask_file')
 
-    ztopval = pe.MapNode(interface=fsl.ImageMaths(op_string='-ztop',
-                                                  suffix='_pval'),
-                         nested=True,
-                         iterfield=['in_file'],
-                         name='ztop',)
+        workflow.connect([(level1, fixedfx,
+                           [((level1_fields['copes'], transpose_copes), 'inputspec.copes'),
+                            ((level1_fields['varcopes'], transpose_copes), 'inputspec.varcopes'),
+                            (level1_fields['dof_file'], 'inputspec.dof_files'),
+                            ((level1_fields['copes'], num_copes), 'l2model.num_copes')])])
 
-    fdr_workflow = create_fdr_threshold_workflow()
+        fixedfx_fields = {'zstats': 'outputspec.zstats',
+                          'copes': 'outputspec.copes',
+                          'varcopes': 'outputspec.varcopes',
+                          'tdof': 'flameo.tdof'}
+
+    else:
+        raise ValueError('Unknown fixed-effects engine %r, use "flameo" or "numpy"' % fixedfx_engine)
+
+
+    fdr_workflow = create_fdr_threshold_workflow(engine=fdr_engine, p_from_z=True)
 
     workflow.connect([
-                      (fixedfx, ztopval,
-                       [('outputspec.zstats', 'in_file'),]),
                       (fixedfx, fdr_workflow,
-                       [('outputspec.zstats', 'inputspec.z_stats'),]),
-                      (ztopval, fdr_workflow,
-                       [('out_file', 'inputspec.p_values'),]),
+                       [(fixedfx_fields['zstats'], 'inputspec.z_stats'),]),
                       (inputspec, fdr_workflow,
                        [('mask', 'inputspec.mask'),]),
                       ])
@@ -145,17 +283,67 @@ def create_modelfit_workflow_bfsl(name='modelfit_workflow_bfsl'):
     outputpsec = pe.Node(util.IdentityInterface(fields=['zstats', 'level2_copes', 'level2_varcopes', 'level2_tdof', 'thresholded_zstats']), name='outputspec')
 
 
-    workflow.connect(fixedfx, 'outputspec.zstats', outputpsec, 'zstats')
-    workflow.connect(fixedfx, 'outputspec.copes', outputpsec, 'level2_copes')
-    workflow.connect(fixedfx, 'outputspec.varcopes', outputpsec, 'level2_varcopes')
-    workflow.connect(fixedfx, 'flameo.tdof', outputpsec, 'level2_tdof')
+    workflow.connect(fixedfx, fixedfx_fields['zstats'], outputpsec, 'zstats')
+    workflow.connect(fixedfx, fixedfx_fields['copes'], outputpsec, 'level2_copes')
+    workflow.connect(fixedfx, fixedfx_fields['varcopes'], outputpsec, 'level2_varcopes')
+    workflow.connect(fixedfx, fixedfx_fields['tdof'], outputpsec, 'level2_tdof')
     workflow.connect(fdr_workflow, 'outputspec.thresholded_z_stats', outputpsec, 'thresholded_z_stats')
 
     
     return workflow
 
 
-def create_random_effects_workflow(name='randomfx'):
+def replace_node(flow, new):
+    """ Swaps the node of `flow` named like `new` for `new`, keeping its
+    connections. """
+    from .utils import node_connections
+
+    old = flow.get_node(new.name)
+    connections = node_connections(flow, old)
+
+    for u, v, connect in connections:
+        flow.disconnect([(u, v, connect)])
+
+    flow.remove_nodes([old])
+
+    for u, v, connect in connections:
+        flow.connect([(new if u is old else u, new if v is old else v, connect)])
+
+    return new
+
+
+def create_scratch_merge_node(name, scratch_dir=None):
+    merge = pe.MapNode(ScratchMerge(), iterfield=['in_files'], name=name)
+    if scratch_dir is not None:
+        merge.inputs.scratch_dir = scratch_dir
+    return merge
+
+
+def create_random_effects_workflow(name='randomfx', merge='fsl', scratch_dir=None,
+                                   flame_chunks=1, n_procs=1, incremental_dir=None,
+                                   cluster_engine='fsl', cluster_thresholds=(2.0,), fdr_engine='numpy'):
+    """ merge='scratch' writes the merged cope, varcope and tdof stacks
+    uncompressed to `scratch_dir` (default $GILLES_WORKFLOWS_SCRATCH_DIR or
+    the system temp directory) instead of gzipped to the node
+    directories. outputspec.merge_seconds and outputspec.merged_bytes then
+    report the cost of merging.
+
+    With flame_chunks > 1 the mask is split into that many sub-masks and
+    FLAME1 runs on them separately, `n_procs` at a time (ChunkedFLAMEO).
+
+    With `incremental_dir` the group mean is estimated in-process by
+    IncrementalRandomEffects, which keeps the subject stacks and
+    statistics in that directory and only reads subjects appended to
+    cope_files/varcope_files since the last run. Merging, tdof_files,
+    merge, flame_chunks and n_procs are then not used.
+
+    cluster_engine='numpy' clusters in-process at every threshold in
+    `cluster_thresholds` (NumpyCluster). outputspec.txt_index_file then
+    holds the local maxima of the first threshold, and
+    outputspec.cluster_tables the per-cluster tables.
+
+    fdr_engine is passed to create_fdr_threshold_workflow, as in
+    create_modelfit_workflow_bfsl. """
 
 
     inputspec = pe.Node(util.IdentityInterface(fields=['cope_files',
@@ -169,71 +357,152 @@ def create_random_effects_workflow(name='randomfx'):
     inputspec.inputs.fdr_q = 0.05
     
     workflow = pe.Workflow(name=name)
-    fixedfx_flow = create_fixed_effects_flow()
 
+    if incremental_dir is not None:
+        group_model = pe.Node(IncrementalRandomEffects(state_dir=incremental_dir), name='group_model')
+
+        workflow.connect(inputspec, 'cope_files', group_model, 'cope_files')
+        workflow.connect(inputspec, 'varcope_files', group_model, 'varcope_files')
+        workflow.connect(inputspec, 'mask_file', group_model, 'mask_file')
+
+        group, zstats_field = group_model, 'zstats'
 
+    else:
+        fixedfx_flow = create_fixed_effects_flow()
 
-    def num_copes(files):
-        return len(files)
+        if flame_chunks > 1:
+            replace_node(fixedfx_flow, pe.MapNode(ChunkedFLAMEO(n_chunks=flame_chunks, n_procs=n_procs),
+                                                  iterfield=['cope_file', 'var_cope_file'],
+                                                  name='flameo'))
 
-    def listify(x):
-        return [x]
 
-    workflow.connect(inputspec, ('cope_files', listify), fixedfx_flow, 'inputspec.copes')
-    workflow.connect(inputspec, ('varcope_files', listify), fixedfx_flow, 'inputspec.varcopes')
 
-    workflow.connect(inputspec, ('varcope_files', num_copes), fixedfx_flow, 'l2model.num_copes')
+        workflow.connect(inputspec, ('cope_files', listify), fixedfx_flow, 'inputspec.copes')
+        workflow.connect(inputspec, ('varcope_files', listify), fixedfx_flow, 'inputspec.varcopes')
 
-    workflow.connect(inputspec, 'mask_file', fixedfx_flow, 'flameo.mask_file')
+        workflow.connect(inputspec, ('varcope_files', num_copes), fixedfx_flow, 'l2model.num_copes')
 
-    fixedfx_flow.inputs.flameo.run_mode = 'flame1'
+        workflow.connect(inputspec, 'mask_file', fixedfx_flow, 'flameo.mask_file')
+
+        fixedfx_flow.inputs.flameo.run_mode = 'flame1'
 
     
-    fixedfx_flow.disconnect([(fixedfx_flow.get_node('inputspec'), fixedfx_flow.get_node('gendofvolume'), [('dof_files', 'dof_files')]),
-                             (fixedfx_flow.get_node('copemerge'), fixedfx_flow.get_node('gendofvolume'), [('merged_file', 'cope_files')]),
-                             (fixedfx_flow.get_node('gendofvolume'), fixedfx_flow.get_node('flameo'), [('dof_volume', 'dof_var_cope_file')])])
-    fixedfx_flow.remove_nodes([fixedfx_flow.get_node('gendofvolume')])
+        fixedfx_flow.disconnect([(fixedfx_flow.get_node('inputspec'), fixedfx_flow.get_node('gendofvolume'), [('dof_files', 'dof_files')]),
+                                 (fixedfx_flow.get_node('copemerge'), fixedfx_flow.get_node('gendofvolume'), [('merged_file', 'cope_files')]),
+                                 (fixedfx_flow.get_node('gendofvolume'), fixedfx_flow.get_node('flameo'), [('dof_volume', 'dof_var_cope_file')])])
+        fixedfx_flow.remove_nodes([fixedfx_flow.get_node('gendofvolume')])
+
+        if merge == 'scratch':
+            replace_node(fixedfx_flow, create_scratch_merge_node('copemerge', scratch_dir))
+            replace_node(fixedfx_flow, create_scratch_merge_node('varcopemerge', scratch_dir))
+
+            tdof_merge = pe.Node(ScratchMerge(), name='tdof_merge')
+            if scratch_dir is not None:
+                tdof_merge.inputs.scratch_dir = scratch_dir
+
+            merge_report = pe.Node(util.Function(function=sum_merge_reports,
+                                                 input_names=['cope_seconds', 'cope_bytes',
+                                                              'varcope_seconds', 'varcope_bytes',
+                                                              'tdof_seconds', 'tdof_bytes'],
+                                                 output_names=['merge_seconds', 'merged_bytes']),
+                                   name='merge_report')
+
+            for prefix in ['cope', 'varcope']:
+                workflow.connect(fixedfx_flow, '%smerge.merge_seconds' % prefix, merge_report, '%s_seconds' % prefix)
+                workflow.connect(fixedfx_flow, '%smerge.merged_bytes' % prefix, merge_report, '%s_bytes' % prefix)
+            workflow.connect(tdof_merge, 'merge_seconds', merge_report, 'tdof_seconds')
+            workflow.connect(tdof_merge, 'merged_bytes', merge_report, 'tdof_bytes')
+
+        elif merge == 'fsl':
+            tdof_merge =  pe.Node(interface=fsl.Merge(dimension='t'), name="tdof_merge")
+
+        else:
+            raise ValueError('Unknown merge mode %r, use "fsl" or "scratch"' % merge)
 
-    tdof_merge =  pe.Node(interface=fsl.Merge(dimension='t'), name="tdof_merge")
-    workflow.connect(inputspec, 'tdof_files', tdof_merge, 'in_files')
-    workflow.connect(tdof_merge, 'merged_file', fixedfx_flow, 'flameo.dof_var_cope_file')
+        workflow.connect(inputspec, 'tdof_files', tdof_merge, 'in_files')
+        workflow.connect(tdof_merge, 'merged_file', fixedfx_flow, 'flameo.dof_var_cope_file')
 
+        group, zstats_field = fixedfx_flow, 'outputspec.zstats'
 
-    ztopval = pe.MapNode(interface=fsl.ImageMaths(op_string='-ztop',
-                                                  suffix='_pval'),
-                         iterfield=['in_file'],
-                         nested=True,
-                         name='ztop',)
 
-    fdr_workflow = create_fdr_threshold_workflow()
+    fdr_workflow = create_fdr_threshold_workflow(engine=fdr_engine, p_from_z=True)
 
     workflow.connect([
-                      (fixedfx_flow, ztopval,
-                       [('outputspec.zstats', 'in_file'),]),
-                      (fixedfx_flow, fdr_workflow,
-                       [('outputspec.zstats', 'inputspec.z_stats'),]),
-                      (ztopval, fdr_workflow,
-                       [('out_file', 'inputspec.p_values'),]),
+                      (group, fdr_workflow,
+                       [(zstats_field, 'inputspec.z_stats'),]),
                       ])
 
     workflow.connect(inputspec, 'mask_file', fdr_workflow, 'inputspec.mask')
     workflow.connect(inputspec, 'fdr_q', fdr_workflow, 'inputspec.q')
 
 
-    cluster = pe.MapNode(fsl.Cluster(), iterfield=['in_file'], name='cluster')
-    cluster.inputs.threshold = 2.0
-    cluster.inputs.out_threshold_file = True
-    cluster.inputs.out_localmax_txt_file = True
+    if cluster_engine == 'numpy':
+        cluster = pe.MapNode(NumpyCluster(thresholds=list(cluster_thresholds)),
+                             iterfield=['in_file'], name='cluster')
+        localmax_field = ('localmax_txt_file', first_threshold)
+
+    elif cluster_engine == 'fsl':
+        cluster = pe.MapNode(fsl.Cluster(), iterfield=['in_file'], name='cluster')
+        cluster.inputs.threshold = 2.0
+        cluster.inputs.out_threshold_file = True
+        cluster.inputs.out_localmax_txt_file = True
+        localmax_field = 'localmax_txt_file'
+
+    else:
+        raise ValueError('Unknown cluster engine %r, use "fsl" or "numpy"' % cluster_engine)
+
     workflow.connect(fdr_workflow, 'outputspec.thresholded_z_stats', cluster, 'in_file')
 
 
 
-    outputspec = pe.Node(util.IdentityInterface(fields=['zstats', 'thresholded_z_stats', 'txt_index_file']), name='outputspec')
+    outputspec = pe.Node(util.IdentityInterface(fields=['zstats', 'thresholded_z_stats', 'txt_index_file',
+                                                        'merge_seconds', 'merged_bytes',
+                                                        'cluster_tables']), name='outputspec')
 
+    if merge == 'scratch' and incremental_dir is None:
+        workflow.connect(merge_report, 'merge_seconds', outputspec, 'merge_seconds')
+        workflow.connect(merge_report, 'merged_bytes', outputspec, 'merged_bytes')
 
-    workflow.connect(fixedfx_flow, 'outputspec.zstats', outputspec, 'zstats')
+
+    workflow.connect(group, zstats_field, outputspec, 'zstats')
     workflow.connect(fdr_workflow, 'outputspec.thresholded_z_stats', outputspec, 'thresholded_z_stats')
 
-    workflow.connect(cluster, 'localmax_txt_file', outputspec, 'txt_index_file')
+    workflow.connect(cluster, localmax_field, outputspec, 'txt_index_file')
+
+    if cluster_engine == 'numpy':
+        workflow.connect(cluster, 'table_file', outputspec, 'cluster_tables')
+
+    return workflow
+
+
+def create_permutation_workflow(name='permutation', n_permutations=5000, cluster_threshold=3.,
+                                n_procs=1, seed=0):
+    """ Nonparametric alternative to create_random_effects_workflow for
+    small groups: sign-flip permutations of the subject copes with
+    max-statistic and cluster-mass FWE correction (SignFlipPermutation).
+    Takes the same inputspec; varcope_files and tdof_files are not used. """
+
+    inputspec = pe.Node(util.IdentityInterface(fields=['cope_files',
+                                                       'varcope_files',
+                                                       'tdof_files',
+                                                       'mask_file']),
+                        name='inputspec')
+
+    workflow = pe.Workflow(name=name)
+
+    permutation = pe.Node(SignFlipPermutation(n_permutations=n_permutations,
+                                              cluster_threshold=cluster_threshold,
+                                              n_procs=n_procs,
+                                              seed=seed),
+                          name='permutation')
+
+    workflow.connect(inputspec, 'cope_files', permutation, 'cope_files')
+    workflow.connect(inputspec, 'mask_file', permutation, 'mask_file')
+
+    outputspec = pe.Node(util.IdentityInterface(fields=['tstat', 'vox_corrp', 'clusterm_corrp']),
+                         name='outputspec')
+
+    for field in ['tstat', 'vox_corrp', 'clusterm_corrp']:
+        workflow.connect(permutation, field, outputspec, field)
 
     return workflow
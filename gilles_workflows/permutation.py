@@ -0,0 +1,150 @@
+""" Sign-flip permutation inference for one-sample group means, an
+in-process alternative to `randomise -1`.
+
+The sign flips of a batch are rows of a (permutations x subjects) matrix,
+so the t-maps of a whole batch come from one matrix product with the
+(subjects x voxels) data. Batches are spread over a thread pool; the
+matrix product and the cluster labelling release the GIL, and unlike a
+process pool threads also run in parallel inside nipype's daemonic
+MultiProc workers. Every batch draws its flips from its own seed, so
+results do not depend on the number of threads.
+"""
+import os
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+
+from .stats import load_mask, _save_in_mask
+
+
+def sign_flips(n_subjects, n_permutations, seed=0, batch_size=100):
+    """ (permutations x subjects) matrices of +-1, one per batch. The
+    first row is the unpermuted data. All 2 ** n_subjects flips are used
+    when that is at most n_permutations. """
+    if 2 ** n_subjects <= n_permutations:
+        flips = 1 - 2 * ((np.arange(2 ** n_subjects)[:, np.newaxis] >> np.arange(n_subjects)) & 1)
+        return [flips[i:i + batch_size] for i in range(0, len(flips), batch_size)]
+
+    batches = []
+    for i, start in enumerate(range(0, n_permutations, batch_size)):
+        rs = np.random.RandomState([seed, i])
+        batch = rs.randint(0, 2, (min(batch_size, n_permutations - start), n_subjects)) * 2 - 1
+        if start == 0:
+            batch[0] = 1
+        batches.append(batch)
+
+    return batches
+
+
+def one_sample_t(flips, data, sum_squares=None):
+    """ t-maps (permutations x voxels) of the mean of data (subjects x
+    voxels) under every row of sign flips. """
+    n = data.shape[0]
+    if sum_squares is None:
+        sum_squares = (data ** 2).sum(0)
+
+    mean = flips.dot(data) / n
+    variance = (sum_squares - n * mean ** 2) / (n - 1)
+
+    return mean / np.sqrt(np.maximum(variance, 1e-12) / n)
+
+
+def cluster_masses(t, mask, threshold, structure):
+    """ (labels, masses) of the clusters of t > threshold, with the mass
+    the sum of t - threshold over a cluster. """
+    volume = np.zeros(mask.shape)
+    volume[mask] = t
+    labels, n = ndimage.label(volume > threshold, structure)
+
+    if n == 0:
+        return labels, np.zeros(0)
+
+    return labels, ndimage.sum(volume - threshold, labels, np.arange(1, n + 1))
+
+
+def _null_batch(flips, data, sum_squares, mask, cluster_threshold, structure):
+    """ Maximum t and maximum cluster mass of every permutation in a
+    batch. """
+    t = one_sample_t(flips, data, sum_squares)
+
+    # An empty mask has no maximum
+    max_t = t.max(1) if t.shape[1] else np.full(len(t), -np.inf)
+    max_mass = np.zeros(len(t))
+
+    if cluster_threshold is not None:
+        for i in range(len(t)):
+            _, masses = cluster_masses(t[i], mask, cluster_threshold, structure)
+            if len(masses):
+                max_mass[i] = masses.max()
+
+    return max_t, max_mass
+
+
+def permutation_test(data, mask, n_permutations=5000, cluster_threshold=3.,
+                     seed=0, n_procs=1, batch_size=100):
+    """ Sign-flip test of the mean of data (subjects x in-mask voxels).
+
+    Returns (t, vox_corrp, clusterm_corrp, n_permutations) where the
+    corrected maps hold 1 - FWE p-value, as randomise writes them, from
+    the null distributions of the maximum t and of the maximum cluster
+    mass above `cluster_threshold` (None skips cluster inference). The
+    batches run in `n_procs` threads. """
+    from multiprocessing.pool import ThreadPool
+
+    batches = sign_flips(data.shape[0], n_permutations, seed, batch_size)
+
+    sum_squares = (data ** 2).sum(0)
+    structure = ndimage.generate_binary_structure(3, 3)
+
+    def null_batch(flips):
+        return _null_batch(flips, data, sum_squares, mask, cluster_threshold, structure)
+
+    if n_procs == 1:
+        nulls = [null_batch(flips) for flips in batches]
+    else:
+        pool = ThreadPool(n_procs)
+        try:
+            nulls = pool.map(null_batch, batches)
+        finally:
+            pool.close()
+
+    max_t = np.concatenate([null[0] for null in nulls])
+    max_mass = np.concatenate([null[1] for null in nulls])
+    n_done = len(max_t)
+
+    t = one_sample_t(np.ones((1, data.shape[0])), data)[0]
+
+    # Number of permutations with a maximum of at least t, per voxel
+    exceeding = n_done - np.searchsorted(np.sort(max_t), t, side='left')
+    vox_corrp = 1 - exceeding / float(n_done)
+
+    clusterm_corrp = np.zeros_like(t)
+    if cluster_threshold is not None:
+        labels, masses = cluster_masses(t, mask, cluster_threshold,
+                                        ndimage.generate_binary_structure(3, 3))
+        for i, mass in enumerate(masses):
+            cluster = labels[mask] == i + 1
+            clusterm_corrp[cluster] = 1 - (max_mass >= mass).sum() / float(n_done)
+
+    return t, vox_corrp, clusterm_corrp, n_done
+
+
+def permutation_test_images(cope_files, mask_file, base_name='randomise', out_dir='.', **kwargs):
+    """ `permutation_test` on subject cope images. Writes
+    <base_name>_tstat1, <base_name>_vox_corrp_tstat1 and
+    <base_name>_clusterm_corrp_tstat1 (randomise's names) and returns
+    their paths. """
+    mask_image = nb.load(mask_file)
+    mask = load_mask(mask_file)
+
+    data = np.array([nb.load(fn).get_data()[mask] for fn in cope_files], dtype=np.float64)
+
+    t, vox_corrp, clusterm_corrp, _ = permutation_test(data, mask, **kwargs)
+
+    def path(name):
+        return os.path.abspath(os.path.join(out_dir, '%s_%s.nii.gz' % (base_name, name)))
+
+    return {'tstat': _save_in_mask(t, mask, mask_image, path('tstat1')),
+            'vox_corrp': _save_in_mask(vox_corrp, mask, mask_image, path('vox_corrp_tstat1')),
+            'clusterm_corrp': _save_in_mask(clusterm_corrp, mask, mask_image, path('clusterm_corrp_tstat1'))}
@@ -0,0 +1,259 @@
+""" Per-node runtime and memory profiles of workflow runs.
+
+`run_profiled` runs a workflow with nipype's resource monitor enabled and
+a status callback that records every node and MapNode iteration. Each one
+becomes a row in a CSV file with the columns in `COLUMNS`. `summarize` and
+`render_gantt` work on that file offline.
+
+input_bytes and output_bytes are the on-disk sizes of a node's input and
+output files, not the I/O it did: files it rereads, streams or reads only
+partly count once at their full size. Nodes run in MultiProc worker
+processes, out of reach of the callback's I/O counters.
+"""
+import os
+import csv
+import time
+from collections import defaultdict
+
+from .scheduling import profile_key, node_workers
+
+
+COLUMNS = ['workflow', 'node', 'interface', 'status', 'start', 'end',
+           'wall_time_s', 'cpu_time_s', 'peak_rss_gb', 'input_bytes', 'output_bytes', 'jobs']
+
+
+def _file_bytes(values):
+    """ Total size of the existing files in a (nested) container of
+    values. """
+    if hasattr(values, 'get') and not isinstance(values, dict):
+        values = values.get()
+    if isinstance(values, dict):
+        values = list(values.values())
+    if isinstance(values, (list, tuple)):
+        return sum(_file_bytes(value) for value in values)
+
+    try:
+        if os.path.isfile(values):
+            return os.path.getsize(values)
+    except (TypeError, ValueError):
+        pass
+
+    return 0
+
+
+class ProfileRecorder(object):
+    """ nipype status callback that collects one row per node run. """
+
+    def __init__(self):
+        self.rows = []
+        self._started = {}
+
+    def __call__(self, node, status):
+        if status == 'start':
+            self._started[id(node)] = time.time()
+            return
+
+        end = time.time()
+        start = self._started.pop(id(node), end)
+
+        row = dict((column, '') for column in COLUMNS)
+        row.update(workflow=node._hierarchy or '',
+                   node=node.name,
+                   interface=profile_key(node),
+                   status=status,
+                   start='%.3f' % start,
+                   end='%.3f' % end,
+                   wall_time_s='%.3f' % (end - start),
+                   jobs=node_workers(node)[1])
+
+        try:
+            result = node.result
+        except Exception:
+            result = None
+
+        runtime = getattr(result, 'runtime', None)
+        # MapNodes report a list of runtimes, one per iteration
+        if isinstance(runtime, list):
+            runtime = None
+
+        if runtime is not None:
+            duration = getattr(runtime, 'duration', None)
+            if duration is not None:
+                row['wall_time_s'] = '%.3f' % duration
+
+            cpu_percent = getattr(runtime, 'cpu_percent', None)
+            if cpu_percent is not None and duration is not None:
+                row['cpu_time_s'] = '%.3f' % (cpu_percent / 100. * duration)
+
+            mem_peak_gb = getattr(runtime, 'mem_peak_gb', None)
+            if mem_peak_gb is not None:
+                row['peak_rss_gb'] = '%.3f' % mem_peak_gb
+
+        if result is not None:
+            row['input_bytes'] = _file_bytes(getattr(result, 'inputs', None))
+            row['output_bytes'] = _file_bytes(getattr(result, 'outputs', None))
+
+        self.rows.append(row)
+
+    def write(self, fn):
+        with open(fn, 'w') as f:
+            writer = csv.DictWriter(f, COLUMNS)
+            writer.writeheader()
+            writer.writerows(sorted(self.rows, key=lambda row: row['start']))
+        return os.path.abspath(fn)
+
+    def append(self, fn, keep=5000):
+        """ Adds the rows to an existing profile, keeping the last `keep`
+        rows. """
+        rows = []
+        if os.path.exists(fn):
+            with open(fn) as f:
+                rows = list(csv.DictReader(f))
+
+        if not os.path.isdir(os.path.dirname(os.path.abspath(fn))):
+            os.makedirs(os.path.dirname(os.path.abspath(fn)))
+
+        rows += sorted(self.rows, key=lambda row: row['start'])
+
+        with open(fn, 'w') as f:
+            writer = csv.DictWriter(f, COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows[-keep:])
+        return os.path.abspath(fn)
+
+
+def enable_resource_monitor():
+    try:
+        from nipype import config
+        config.enable_resource_monitor()
+        return True
+    except Exception:
+        return False
+
+
+def run_profiled(workflow, profile_file='profile.csv', plugin='MultiProc', plugin_args=None):
+    """ Runs `workflow` and writes the profile of every node to
+    `profile_file`, also when the run fails. """
+    enable_resource_monitor()
+
+    recorder = ProfileRecorder()
+    plugin_args = dict(plugin_args or {})
+    plugin_args['status_callback'] = recorder
+
+    try:
+        return workflow.run(plugin=plugin, plugin_args=plugin_args)
+    finally:
+        recorder.write(profile_file)
+
+
+def read_profile(fn):
+    with open(fn) as f:
+        rows = list(csv.DictReader(f))
+
+    for row in rows:
+        for column in COLUMNS[4:]:
+            # Profiles written before a column was added lack it
+            value = row.get(column, '')
+            row[column] = float(value) if value != '' else None
+
+    return rows
+
+
+def summarize(fn, key='interface'):
+    """ Totals per `key` ('interface', 'node' or 'workflow'), most wall
+    time first, as (name, count, wall_time_s, cpu_time_s, max_peak_rss_gb,
+    input_gb, output_gb). input_gb and output_gb add up the sizes of the
+    nodes' input and output files, which is not the I/O they did (see
+    the module docstring). """
+    totals = defaultdict(lambda: [0, 0., 0., 0., 0., 0.])
+
+    for row in read_profile(fn):
+        total = totals[row[key]]
+        total[0] += 1
+        total[1] += row['wall_time_s'] or 0
+        total[2] += row['cpu_time_s'] or 0
+        total[3] = max(total[3], row['peak_rss_gb'] or 0)
+        total[4] += (row['input_bytes'] or 0) / 1024. ** 3
+        total[5] += (row['output_bytes'] or 0) / 1024. ** 3
+
+    return sorted(((name,) + tuple(total) for name, total in totals.items()),
+                  key=lambda total: -total[2])
+
+
+def resource_profiles(fn, headroom=1.2):
+    """ {interface: (mem_gb, threads)} from a profile, for
+    `scheduling.tag_resources`. Uses the largest peak memory (times
+    `headroom`) and the largest average CPU use seen per interface, per
+    job for nodes that run several jobs at once. """
+    import math
+
+    profiles = {}
+
+    for row in read_profile(fn):
+        if not row['peak_rss_gb'] or not row['wall_time_s']:
+            continue
+
+        jobs = row['jobs'] or 1
+        threads = int(math.ceil((row['cpu_time_s'] or 0) / row['wall_time_s'] / jobs)) or 1
+        mem_gb, max_threads = profiles.get(row['interface'], (0, 1))
+        profiles[row['interface']] = (max(mem_gb, row['peak_rss_gb'] * headroom / jobs),
+                                      max(max_threads, threads))
+
+    return profiles
+
+
+def render_gantt(fn, out_file='profile.png'):
+    """ Gantt chart of a profile, one row per node run, colored per
+    workflow. Needs matplotlib. """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    rows = [row for row in read_profile(fn) if row['start'] is not None]
+    t0 = min(row['start'] for row in rows)
+
+    workflows = sorted(set(row['workflow'] for row in rows))
+    colors = dict((workflow, plt.cm.tab20(i % 20)) for i, workflow in enumerate(workflows))
+
+    fig, ax = plt.subplots(figsize=(12, max(3, 0.2 * len(rows))))
+
+    for i, row in enumerate(rows):
+        ax.barh(i, row['end'] - row['start'], left=row['start'] - t0,
+                color=colors[row['workflow']])
+
+    ax.set_yticks(range(len(rows)))
+    ax.set_yticklabels(['%s.%s' % (row['workflow'], row['node']) for row in rows], fontsize=6)
+    ax.invert_yaxis()
+    ax.set_xlabel('time (s)')
+
+    fig.tight_layout()
+    fig.savefig(out_file)
+    plt.close(fig)
+
+    return os.path.abspath(out_file)
+
+
+def main(argv=None):
+    """ python -m gilles_workflows.profiling profile.csv [--by interface]
+    [--gantt profile.png] """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Summarize a workflow profile')
+    parser.add_argument('profile_file')
+    parser.add_argument('--by', default='interface', choices=['interface', 'node', 'workflow'])
+    parser.add_argument('--gantt', default=None, help='also render a Gantt chart to this file')
+    args = parser.parse_args(argv)
+
+    print('%-40s %6s %10s %10s %8s %10s %10s' % (args.by, 'runs', 'wall (s)', 'cpu (s)', 'rss (GB)',
+                                                 'in (GB)', 'out (GB)'))
+    for name, count, wall_time, cpu_time, peak_rss, input_gb, output_gb in summarize(args.profile_file,
+                                                                                      args.by):
+        print('%-40s %6d %10.1f %10.1f %8.2f %10.2f %10.2f' % (name[-40:], count, wall_time, cpu_time,
+                                                               peak_rss, input_gb, output_gb))
+
+    if args.gantt:
+        print('Wrote %s' % render_gantt(args.profile_file, args.gantt))
+
+
+if __name__ == '__main__':
+    main()
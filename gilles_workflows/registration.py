@@ -6,10 +6,104 @@ import nipype.interfaces.fsl as fsl
 import nipype.interfaces.utility as util
 from nipype.interfaces.c3 import C3dAffineTool
 
+from .interfaces import CachedFAST, CachedRegistration, BatchApplyTransforms
+
+
+# Per-stage (Rigid, Affine, SyN) multi-resolution schedules
+REGISTRATION_PRESETS = {
+    'draft': {'number_of_iterations': [[100,50,25,10]]*2 + [[10,10,7,2]],
+              'shrink_factors': [[8,4,2,1]]*2 + [[6,4,2,1]],
+              'smoothing_sigmas': [[3,2,1,0]]*3},
+    'standard': {'number_of_iterations': [[500,250,100,50]]*2 + [[50,50,35,10]],
+                 'shrink_factors': [[8,4,2,1]]*2 + [[6,4,2,1]],
+                 'smoothing_sigmas': [[3,2,1,0]]*3},
+    'full': {'number_of_iterations': [[1000,500,250,100]]*2 + [[100,100,70,20]],
+             'shrink_factors': [[8,4,2,1]]*2 + [[6,4,2,1]],
+             'smoothing_sigmas': [[3,2,1,0]]*3},
+}
+
+
+def get_registration_schedule(preset='full', warm_start=False):
+    """ number_of_iterations, shrink_factors and smoothing_sigmas for a
+    preset. With warm_start=True only the two finest levels of every stage
+    are kept, for runs that start from the transform of a cheaper run. """
+
+    if preset not in REGISTRATION_PRESETS:
+        raise ValueError('Unknown registration preset %r, use one of %s' %
+                         (preset, sorted(REGISTRATION_PRESETS)))
+
+    schedule = dict((key, [list(levels) for levels in value])
+                    for key, value in REGISTRATION_PRESETS[preset].items())
+
+    if warm_start:
+        schedule = dict((key, [levels[-2:] for levels in value])
+                        for key, value in schedule.items())
+
+    return schedule
+
+
+def create_registration_node(name='antsRegister', preset='full', warm_start=False):
+    """ Rigid + Affine + SyN ANTs registration. With warm_start=True the
+    `initial_moving_transform` input has to be set (e.g. to the
+    `composite_transform` of a draft run) instead of initializing on the
+    centers of mass. """
+
+    reg = pe.Node(CachedRegistration(), name=name)
+    reg.inputs.transforms = ['Rigid', 'Affine', 'SyN']
+    reg.inputs.transform_parameters = [(0.1,), (0.1,), (0.1, 3.0, 0.0)]
+    reg.inputs.dimension = 3
+    reg.inputs.write_composite_transform = True
+    reg.inputs.collapse_output_transforms = True
+    reg.inputs.metric = ['MI']*2 + ['CC']
+    reg.inputs.metric_weight = [1]*3 # Default (value ignored currently by ANTs)
+    reg.inputs.radius_or_number_of_bins = [32]*2 + [4]
+    reg.inputs.sampling_strategy = ['Regular']*2 + [None]
+    reg.inputs.sampling_percentage = [0.25]*2 + [None]
+    reg.inputs.convergence_threshold = [1.e-8]*2 + [1e-9]
+    reg.inputs.convergence_window_size = [10]*2 + [15]
+    reg.inputs.sigma_units = ['mm']*3
+    reg.inputs.use_estimate_learning_rate_once = [True, True, True]
+    reg.inputs.use_histogram_matching = [False]*2 + [True] # This is the default
+    reg.inputs.output_warped_image = True
+    reg.inputs.winsorize_lower_quantile = 0.01
+    reg.inputs.winsorize_upper_quantile = 0.99
+
+    if not warm_start:
+        reg.inputs.initial_moving_transform_com = True
+
+    for key, value in get_registration_schedule(preset, warm_start).items():
+        setattr(reg.inputs, key, value)
+
+    return reg
+
 
 def create_fsl_ants_registration_workflow(name='fsl_ants_registration_workflow',
                         base_dir=None,
-                        quick=False):
+                        quick=False,
+                        preset=None,
+                        warm_start=False,
+                        batch_apply=False,
+                        batch_apply_n_procs=1,
+                        use_init_matrix=False):
+    """ preset is 'draft', 'standard' or 'full' (default 'full', or 'draft'
+    when quick=True). With warm_start=True the ANTs registration starts
+    from `inputspec.initial_moving_transform`, e.g. the composite transform
+    of a draft run, and skips the coarse levels.
+
+    With batch_apply=True all `to_target` images are resampled by one node
+    that composes the transforms into a single displacement field first,
+    running `batch_apply_n_procs` resampling processes at once.
+
+    With use_init_matrix=True, `inputspec.init_matrix` (e.g. a header-based
+    or previous-session epi -> anat FLIRT matrix) seeds BBR directly when a
+    cheap alignment check accepts it and its NMI is close to that of a
+    FLIRT search (see alignment.init_epi2anat), instead of a 6-dof FLIRT
+    search. `outputspec.init_estimated_seconds_saved` estimates the time
+    saved from earlier FLIRT searches; it is negative when the check was
+    followed by a FLIRT search after all. """
+
+    if preset is None:
+        preset = 'draft' if quick else 'full'
     
     if base_dir == None:
         base_dir = os.path.expanduser('~/workflow_folders/')
@@ -21,13 +115,15 @@ def create_fsl_ants_registration_workflow(name='fsl_ants_registration_workflow',
                                                        'anatomical_t1_weighted',
                                                        'anatomical_mp2rage',
                                                        'target',
-                                                       'to_target']),
+                                                       'to_target',
+                                                       'initial_moving_transform',
+                                                       'init_matrix']),
                         name='inputspec')
     
     inputspec.inputs.target = fsl.Info.standard_image('MNI152_T1_2mm_brain.nii.gz')
     inputspec.inputs.to_target = []    
     
-    fast = pe.Node(fsl.FAST(), name='fast')
+    fast = pe.Node(CachedFAST(), name='fast')
     
     binarize = pe.Node(fsl.ImageMaths(op_string='-nan -thr 0.5 -bin'),
                        name='binarize')
@@ -37,8 +133,24 @@ def create_fsl_ants_registration_workflow(name='fsl_ants_registration_workflow',
 
     workflow.connect(inputspec, 'anatomical_t1_weighted', fast, 'in_files')
     
-    mean2anat = pe.Node(fsl.FLIRT(), name='mean2anat')
-    mean2anat.inputs.dof = 6
+    if use_init_matrix:
+
+        def init_epi2anat(in_file, reference, init_matrix=None):
+            from gilles_workflows.alignment import init_epi2anat
+            return init_epi2anat(in_file, reference, init_matrix)
+
+        # Only runs the FLIRT search when inputspec.init_matrix fails the
+        # alignment check
+        mean2anat = pe.Node(util.Function(function=init_epi2anat,
+                                          input_names=['in_file', 'reference', 'init_matrix'],
+                                          output_names=['out_matrix_file', 'used_init_matrix',
+                                                        'estimated_seconds_saved']),
+                            name='mean2anat')
+        workflow.connect(inputspec, 'init_matrix', mean2anat, 'init_matrix')
+    else:
+        mean2anat = pe.Node(fsl.FLIRT(), name='mean2anat')
+        mean2anat.inputs.dof = 6
+
     workflow.connect(inputspec, 'mean_epi', mean2anat, 'in_file')
     workflow.connect(inputspec, 'anatomical_mp2rage', mean2anat, 'reference')
 
@@ -55,37 +167,10 @@ def create_fsl_ants_registration_workflow(name='fsl_ants_registration_workflow',
                      mean2anatbbr, 'in_matrix_file')
     
 
-    reg = pe.Node(ants.Registration(), name='antsRegister')
-    reg.inputs.transforms = ['Rigid', 'Affine', 'SyN']
-    reg.inputs.transform_parameters = [(0.1,), (0.1,), (0.1, 3.0, 0.0)]
-    reg.inputs.number_of_iterations = [[1000,500,250,100]]*2 + [[100,100,70,20]]
-    reg.inputs.dimension = 3
-    reg.inputs.write_composite_transform = True
-    reg.inputs.collapse_output_transforms = True
-    reg.inputs.metric = ['MI']*2 + ['CC']
-    reg.inputs.metric_weight = [1]*3 # Default (value ignored currently by ANTs)
-    reg.inputs.radius_or_number_of_bins = [32]*2 + [4]
-    reg.inputs.sampling_strategy = ['Regular']*2 + [None]
-    reg.inputs.sampling_percentage = [0.25]*2 + [None]
-    reg.inputs.convergence_threshold = [1.e-8]*2 + [1e-9]
-    reg.inputs.convergence_window_size = [10]*2 + [15]
-    reg.inputs.smoothing_sigmas = [[3,2,1,0]]*3
-    reg.inputs.sigma_units = ['mm']*3
-    reg.inputs.shrink_factors = [[8,4,2,1]]*2 + [[6,4,2,1]]
-    reg.inputs.use_estimate_learning_rate_once = [True, True, True]
-    reg.inputs.use_histogram_matching = [False]*2 + [True] # This is the default
-    reg.inputs.initial_moving_transform_com = True
-    reg.inputs.output_warped_image = True
-    reg.inputs.winsorize_lower_quantile = 0.01
-    reg.inputs.winsorize_upper_quantile = 0.99
-    
-    if quick:
-        reg.inputs.number_of_iterations = [[100,50,25,10]]*2 + [[10,10,7,2]]        
-    else:
-        reg.inputs.number_of_iterations = [[1000,500,250,100]]*2 + [[100,100,70,20]]
-        
-    
-    
+    reg = create_registration_node(preset=preset, warm_start=warm_start)
+
+    if warm_start:
+        workflow.connect(inputspec, 'initial_moving_transform', reg, 'initial_moving_transform')
     
     workflow.connect(inputspec, 'target', reg, 'fixed_image')
     workflow.connect(inputspec, 'anatomical_mp2rage', reg, 'moving_image')
@@ -95,11 +180,15 @@ def create_fsl_ants_registration_workflow(name='fsl_ants_registration_workflow',
     outputspec = pe.Node(util.IdentityInterface(fields=fields_ants + ['transformed_anat_space',
                                                                  'transformed_target_space',
                                                                  'epi2anat_transform',
-                                                                      'epi_in_anat_space']),
+                                                                      'epi_in_anat_space',
+                                                                      'init_estimated_seconds_saved']),
                          name='outputspec')
     
     for field in fields_ants:
         workflow.connect(reg, field, outputspec, field)
+
+    if use_init_matrix:
+        workflow.connect(mean2anat, 'estimated_seconds_saved', outputspec, 'init_estimated_seconds_saved')
     
     convert2itk = pe.Node(C3dAffineTool(),
                       name='convert2itk')
@@ -118,12 +207,18 @@ def create_fsl_ants_registration_workflow(name='fsl_ants_registration_workflow',
     workflow.connect(reg, 'composite_transform', merge, 'in1')
 
 
-    mni_applier = pe.MapNode(ants.ApplyTransforms(), iterfield=['input_image'], name='mni_applier')
+    if batch_apply:
+        mni_applier = pe.Node(BatchApplyTransforms(), name='mni_applier')
+        mni_applier.inputs.n_procs = batch_apply_n_procs
+        workflow.connect(inputspec, 'to_target', mni_applier, 'input_images')
+        workflow.connect(mni_applier, 'output_images', outputspec, 'transformed_target_space')
+    else:
+        mni_applier = pe.MapNode(ants.ApplyTransforms(), iterfield=['input_image'], name='mni_applier')
+        workflow.connect(inputspec, 'to_target', mni_applier, 'input_image')
+        workflow.connect(mni_applier, 'output_image', outputspec, 'transformed_target_space')
 
     workflow.connect(inputspec, 'target', mni_applier, 'reference_image')
     workflow.connect(merge, 'out', mni_applier, 'transforms')
-    workflow.connect(inputspec, 'to_target', mni_applier, 'input_image')
-    workflow.connect(mni_applier, 'output_image', outputspec, 'transformed_target_space')
 
     
     return workflow
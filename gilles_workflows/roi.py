@@ -0,0 +1,180 @@
+import os
+
+import numpy as np
+import nibabel as nb
+from scipy import sparse
+
+
+def iter_volume_blocks(data_image, max_memory_mb=512):
+    """ Yields (start, stop, block) with block an (n_voxels, n_volumes)
+    view on consecutive volumes of a 4D image, so no more than roughly
+    `max_memory_mb` is held at once.
+
+    Uncompressed NIfTI is memory-mapped by nibabel. For .nii.gz the file
+    is kept open so every block continues decompressing where the previous
+    one stopped."""
+
+    shape = data_image.shape
+    n_voxels = int(np.prod(shape[:3]))
+    n_volumes = shape[3]
+
+    # Raw block plus its scaled float64 copy
+    bytes_per_volume = n_voxels * (data_image.get_data_dtype().itemsize + 8)
+    block_size = max(1, int(max_memory_mb * 1024 ** 2 // bytes_per_volume))
+
+    dataobj = data_image.dataobj
+
+    for start in range(0, n_volumes, block_size):
+        stop = min(start + block_size, n_volumes)
+        block = np.asarray(dataobj[..., start:stop], dtype=float)
+        yield start, stop, block.reshape((n_voxels, stop - start), order='F')
+
+
+def stack_images(in_files, out_file):
+    """ Stacks 3D images into one 4D image, one volume per input. """
+    images = [nb.load(fn) for fn in in_files]
+    data = np.stack([image.get_data() for image in images], axis=-1)
+    nb.save(nb.Nifti1Image(data, images[0].affine), out_file)
+    return os.path.abspath(out_file)
+
+
+def _roi_entries(rois, label_atlas=False):
+    """ Nonzero entries of an ROI image as (voxels, rows, columns, values,
+    n_rois), where voxels are flat Fortran-order indices and rows index
+    into voxels. """
+
+    rois = nb.load(rois).get_data()
+    n_voxels = int(np.prod(rois.shape[:3]))
+
+    if label_atlas:
+        labels = np.round(rois).astype(int).ravel(order='F')
+        voxels = np.flatnonzero(labels)
+        _, columns = np.unique(labels[voxels], return_inverse=True)
+        rows = np.arange(len(voxels))
+        values = np.ones(len(voxels))
+        n_rois = columns.max() + 1 if len(columns) else 0
+    else:
+        rois = rois.reshape((n_voxels, -1), order='F')
+        nonzero_rows, columns = np.nonzero(rois)
+        values = rois[nonzero_rows, columns].astype(float)
+        voxels, rows = np.unique(nonzero_rows, return_inverse=True)
+        n_rois = rois.shape[1]
+
+    return voxels, rows, columns, values, n_rois
+
+
+def _normalized_matrix(rows, columns, values, shape):
+    matrix = sparse.csc_matrix((values, (rows, columns)), shape=shape)
+
+    sums = np.asarray(matrix.sum(0)).ravel()
+    empty = sums == 0
+    sums[empty] = 1
+
+    return matrix.dot(sparse.diags(1. / sums)), empty
+
+
+def roi_weight_matrix(rois, label_atlas=False, weights=None):
+    """ Sparse (voxels x ROIs) matrix with every column summing to one.
+
+    `rois` is a 3D mask, a 4D image with one ROI per volume or, with
+    label_atlas=True, a 3D image of integer labels. `weights` (e.g. a gray
+    matter partial volume map) multiplies every ROI before normalization.
+
+    Returns the flat (Fortran-order) indices of the voxels that are in any
+    ROI, the matrix, and a boolean array flagging empty ROIs."""
+
+    voxels, rows, columns, values, n_rois = _roi_entries(rois, label_atlas)
+
+    if weights is not None:
+        weights = nb.load(weights).get_data().astype(float).ravel(order='F')
+        values = values * weights[voxels[rows]]
+
+    matrix, empty = _normalized_matrix(rows, columns, values, (len(voxels), n_rois))
+
+    return voxels, matrix, empty
+
+
+def save_roi_weights(rois, out_file, label_atlas=False, gray_matter=None):
+    """ Normalizes the ROIs once so every run of a subject can reuse them.
+
+    Stores the in-ROI voxel indices and one (ROIs x voxels) matrix with the
+    plain ROI weights and, if `gray_matter` is given, the gray matter
+    weighted ROIs stacked below them. """
+
+    voxels, rows, columns, values, n_rois = _roi_entries(rois, label_atlas)
+    shape = (len(voxels), n_rois)
+
+    matrix, empty = _normalized_matrix(rows, columns, values, shape)
+    matrices, empties = [matrix.T], [empty]
+
+    if gray_matter is not None:
+        weights = nb.load(gray_matter).get_data().astype(float).ravel(order='F')
+        matrix, empty = _normalized_matrix(rows, columns,
+                                           values * weights[voxels[rows]], shape)
+        matrices.append(matrix.T)
+        empties.append(empty)
+
+    matrix = sparse.vstack(matrices).tocsr()
+
+    np.savez(out_file,
+             voxels=voxels,
+             data=matrix.data,
+             indices=matrix.indices,
+             indptr=matrix.indptr,
+             shape=matrix.shape,
+             empty=np.concatenate(empties),
+             n_rois=n_rois)
+
+    return os.path.abspath(out_file)
+
+
+def load_roi_weights(fn):
+    weights = np.load(fn)
+    matrix = sparse.csr_matrix((weights['data'], weights['indices'], weights['indptr']),
+                               shape=tuple(weights['shape']))
+    return weights['voxels'], matrix, weights['empty'], int(weights['n_rois'])
+
+
+def extract_timecourses(data, voxels, matrix, max_memory_mb=512):
+    """ matrix.dot(data) for an (n x voxels) weight matrix, in a single
+    streaming pass over the 4D `data`. """
+
+    data_image = nb.load(data, keep_file_open=True)
+    timecourses = np.empty((matrix.shape[0], data_image.shape[3]))
+
+    for start, stop, block in iter_volume_blocks(data_image, max_memory_mb):
+        timecourses[:, start:stop] = matrix.dot(block[voxels])
+
+    return timecourses
+
+
+def extract_roi_weights(data, roi_weights, max_memory_mb=512):
+    """ Time courses for every weight set in a `save_roi_weights` file, as a
+    list of (ROIs x time) arrays. Empty ROIs get NaN. """
+
+    voxels, matrix, empty, n_rois = load_roi_weights(roi_weights)
+
+    timecourses = extract_timecourses(data, voxels, matrix, max_memory_mb)
+    timecourses[empty] = np.nan
+
+    return [timecourses[i:i + n_rois] for i in range(0, matrix.shape[0], n_rois)]
+
+
+def roi_timecourses(data, rois, label_atlas=False, weights=None, max_memory_mb=512):
+    """ (ROIs x time) array of weighted mean time courses for all ROIs,
+    computed in a single streaming pass over the 4D `data`. Empty ROIs
+    get NaN. See `roi_weight_matrix` for `rois` and `weights`. """
+
+    voxels, matrix, empty = roi_weight_matrix(rois, label_atlas, weights)
+
+    timecourses = extract_timecourses(data, voxels, matrix.T.tocsr(), max_memory_mb)
+    timecourses[empty] = np.nan
+
+    return timecourses
+
+
+def weighted_mean_timecourse(data, mask, max_memory_mb=512):
+    """ Time course of `data` averaged with the weights in `mask`
+    (normalized to sum to one), streaming over blocks of volumes and
+    touching only the nonzero mask voxels. """
+    return roi_timecourses(data, mask, max_memory_mb=max_memory_mb)[0]
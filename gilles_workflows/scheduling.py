@@ -0,0 +1,230 @@
+""" Resource-aware execution of the package workflows.
+
+Nodes are tagged with the peak memory and number of threads their
+interface needs, so nipype's MultiProc plugin can pack them onto the cores
+and RAM of one machine without oversubscribing either.
+"""
+import os
+import multiprocessing
+
+
+# Module-qualified interface class -> (peak memory in GB, threads). A key
+# matches the class in that module or any submodule, so
+# 'nipype.interfaces.fsl.Merge' is fslmerge but not the list Merge of
+# nipype.interfaces.utility. These are estimates for whole brain 2 mm group
+# data and 0.7 mm 7T anatomies; profiles measured with `run` (see
+# `measured_profiles`) take precedence. For interfaces with a WORKER_INPUTS
+# input the profile is per job and is multiplied by the number of jobs
+# the node runs at once.
+RESOURCE_PROFILES = {
+    'nipype.interfaces.fsl.FLAMEO': (1.0, 1),
+    'nipype.interfaces.fsl.FLAMEO:flame1': (3.0, 1),
+    'nipype.interfaces.ants.Registration': (4.0, 4),
+    'gilles_workflows.interfaces.CachedRegistration': (4.0, 4),
+    'nipype.interfaces.fsl.FAST': (2.0, 1),
+    'gilles_workflows.interfaces.CachedFAST': (2.0, 1),
+    'nipype.interfaces.fsl.FILMGLS': (2.0, 1),
+    'nipype.interfaces.fsl.FLIRT': (0.5, 1),
+    'nipype.interfaces.ants.ApplyTransforms': (1.0, 1),
+    'gilles_workflows.interfaces.BatchApplyTransforms': (1.0, 1),
+    'gilles_workflows.interfaces.BatchFILMGLS': (2.0, 1),
+    'gilles_workflows.interfaces.NumpyGLM': (1.0, 1),
+    'gilles_workflows.interfaces.ChunkedFLAMEO': (1.0, 1),
+    'gilles_workflows.interfaces.SignFlipPermutation': (1.0, 1),
+    'nipype.interfaces.fsl.Merge': (1.5, 1),
+    'gilles_workflows.interfaces.NumpyFDR': (1.0, 1),
+    'gilles_workflows.interfaces.FDRThreshold': (1.0, 1),
+}
+
+# Interface inputs that set the number of threads the tool uses
+THREAD_INPUTS = ['num_threads']
+
+# Interface inputs that set the number of jobs a node runs at once
+WORKER_INPUTS = ['n_procs']
+
+
+def total_memory_gb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024. ** 3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def default_profile_file():
+    return os.environ.get('GILLES_WORKFLOWS_RESOURCE_PROFILE',
+                          os.path.expanduser('~/workflow_folders/resource_profile.csv'))
+
+
+def profile_key(node):
+    """ Module-qualified interface class of a node, the key of
+    RESOURCE_PROFILES and of measured profiles. """
+    cls = node.interface.__class__
+    key = '%s.%s' % (cls.__module__, cls.__name__)
+
+    # flame1 needs much more memory than fixed effects
+    if cls.__name__ == 'FLAMEO' and getattr(node.inputs, 'run_mode', None) == 'flame1':
+        key += ':flame1'
+
+    return key
+
+
+def _matches(pattern, key):
+    module, _, name = pattern.rpartition('.')
+    key_module, _, key_name = key.rpartition('.')
+    return name == key_name and (key_module == module or key_module.startswith(module + '.'))
+
+
+def measured_profiles(profile_file=None):
+    """ RESOURCE_PROFILES, overridden by the profiles measured in
+    `profile_file` (default: `default_profile_file()`) when it exists. """
+    from .profiling import resource_profiles
+
+    if profile_file is None:
+        profile_file = default_profile_file()
+
+    profiles = dict(RESOURCE_PROFILES)
+    if os.path.exists(profile_file):
+        profiles.update(resource_profiles(profile_file))
+
+    return profiles
+
+
+def get_resource_profile(node, profiles=None):
+    """ (mem_gb, n_procs) for a node, or None if it has no profile. """
+    if profiles is None:
+        profiles = RESOURCE_PROFILES
+
+    key = profile_key(node)
+
+    if key in profiles:
+        return profiles[key]
+
+    for pattern, profile in profiles.items():
+        if _matches(pattern, key):
+            return profile
+
+    return None
+
+
+def process_map(function, jobs, n_procs=1, initializer=None, initargs=()):
+    """ map(function, jobs) in a pool of `n_procs` processes. Runs
+    serially when n_procs is 1 and inside daemonic processes (e.g. the
+    workers of nipype's MultiProc plugin), which cannot have children. """
+    if n_procs == 1 or multiprocessing.current_process().daemon:
+        if initializer is not None:
+            initializer(*initargs)
+        return [function(job) for job in jobs]
+
+    pool = multiprocessing.Pool(n_procs, initializer=initializer, initargs=initargs)
+    try:
+        return pool.map(function, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def set_node_resources(node, mem_gb, n_procs):
+    # nipype >= 1.0 keeps resources on the node, older versions on the
+    # interface
+    if hasattr(node, 'mem_gb'):
+        node._mem_gb = mem_gb
+        node._n_procs = n_procs
+    else:
+        node.interface.estimated_memory_gb = mem_gb
+        node.interface.num_threads = n_procs
+
+    for name in THREAD_INPUTS:
+        if name in node.inputs.copyable_trait_names():
+            setattr(node.inputs, name, n_procs)
+
+
+def node_workers(node):
+    """ (input name, number of jobs) for a node that runs several jobs
+    at once, or (None, 1). """
+    from nipype.interfaces.base import isdefined
+
+    for name in WORKER_INPUTS:
+        if name in node.inputs.copyable_trait_names():
+            value = getattr(node.inputs, name)
+            if isdefined(value):
+                return name, max(1, value)
+
+    return None, 1
+
+
+def tag_resources(workflow, profiles=None, max_mem_gb=None, n_procs=None):
+    """ Tags every node of `workflow` (including nested workflows and
+    MapNodes) that has a resource profile. Nodes that run several jobs at
+    once (`node_workers`) reserve the profile once per job. Requests are
+    clipped to `max_mem_gb` and `n_procs` so every node can still be
+    scheduled; a node's number of jobs is lowered to what fits in the
+    clipped threads. Returns {node full name: (mem_gb, n_procs)}. """
+    tagged = {}
+
+    from .utils import all_nodes
+
+    for node in all_nodes(workflow):
+        profile = get_resource_profile(node, profiles)
+
+        if profile is None:
+            continue
+
+        worker_input, workers = node_workers(node)
+        job_threads = profile[1]
+        mem_gb, threads = profile[0] * workers, job_threads * workers
+
+        if max_mem_gb is not None:
+            mem_gb = min(mem_gb, max_mem_gb)
+        if n_procs is not None:
+            threads = min(threads, n_procs)
+
+        if worker_input is not None and threads < job_threads * workers:
+            setattr(node.inputs, worker_input, max(1, threads // job_threads))
+
+        set_node_resources(node, mem_gb, threads)
+        tagged[node.fullname] = (mem_gb, threads)
+
+    return tagged
+
+
+def run(workflow, max_mem_gb=None, n_procs=None, profiles=None, profile_file=None,
+        **plugin_args):
+    """ Runs `workflow` with MultiProc, packing the tagged nodes onto
+    `n_procs` cores (default: all) and `max_mem_gb` of memory (default: 90%
+    of physical memory). Extra keyword arguments go to the plugin.
+
+    Unless `profiles` is given, nodes are tagged with `measured_profiles`.
+    The run is profiled and its nodes are added to `profile_file` (default:
+    `default_profile_file()`), so later runs use measured needs. """
+    from .profiling import ProfileRecorder, enable_resource_monitor
+
+    if n_procs is None:
+        n_procs = multiprocessing.cpu_count()
+
+    if max_mem_gb is None:
+        max_mem_gb = total_memory_gb()
+        if max_mem_gb is not None:
+            max_mem_gb *= 0.9
+
+    if profile_file is None:
+        profile_file = default_profile_file()
+
+    if profiles is None:
+        profiles = measured_profiles(profile_file)
+
+    tag_resources(workflow, profiles, max_mem_gb, n_procs)
+
+    plugin_args['n_procs'] = n_procs
+    if max_mem_gb is not None:
+        plugin_args['memory_gb'] = max_mem_gb
+
+    recorder = None
+    if 'status_callback' not in plugin_args:
+        enable_resource_monitor()
+        recorder = plugin_args['status_callback'] = ProfileRecorder()
+
+    try:
+        return workflow.run(plugin='MultiProc', plugin_args=plugin_args)
+    finally:
+        if recorder is not None and recorder.rows:
+            recorder.append(profile_file)
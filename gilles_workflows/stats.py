@@ -0,0 +1,144 @@
+import os
+
+import numpy as np
+import nibabel as nb
+from scipy.special import ndtr
+
+
+def z_to_p(z):
+    """ One-tailed p-values of z-scores, like `fslmaths -ztop`. """
+    return ndtr(-np.asarray(z, dtype=float))
+
+
+def fdr_adjust(p_values, method='bh'):
+    """ Benjamini-Hochberg ('bh') or Benjamini-Yekutieli ('by') adjusted
+    p-values along the last axis of `p_values`. Every row is treated as an
+    independent family, so several maps can be adjusted in one call."""
+
+    p_values = np.asarray(p_values, dtype=float)
+    n = p_values.shape[-1]
+
+    if n == 0:
+        return p_values.copy()
+
+    order = np.argsort(p_values, axis=-1, kind='mergesort')
+    sorted_p = np.take_along_axis(p_values, order, axis=-1)
+
+    ranks = np.arange(1, n + 1, dtype=float)
+    scale = n / ranks
+
+    if method == 'by':
+        scale *= np.sum(1. / ranks)
+    elif method != 'bh':
+        raise ValueError('Unknown FDR method %r, use "bh" or "by"' % method)
+
+    adjusted = sorted_p * scale
+    adjusted = np.minimum.accumulate(adjusted[..., ::-1], axis=-1)[..., ::-1]
+    np.clip(adjusted, 0, 1, out=adjusted)
+
+    result = np.empty_like(adjusted)
+    np.put_along_axis(result, order, adjusted, axis=-1)
+
+    return result
+
+
+def fdr_p_threshold(p_values, adjusted_p_values, q):
+    """ Largest uncorrected p-value that survives FDR at level q (0 if
+    nothing survives), per row, as printed by FSL's `fdr`."""
+
+    p_values = np.atleast_2d(p_values)
+    adjusted_p_values = np.atleast_2d(adjusted_p_values)
+
+    surviving = np.where(adjusted_p_values <= q, p_values, 0)
+
+    if surviving.shape[-1] == 0:
+        return np.zeros(surviving.shape[:-1])
+
+    return surviving.max(-1)
+
+
+def load_mask(mask):
+    return nb.load(mask).get_data() != 0
+
+
+def save_like(data, image, out_file):
+    header = image.header.copy()
+    header.set_data_dtype(data.dtype)
+    nb.save(nb.Nifti1Image(data, image.affine, header), out_file)
+    return os.path.abspath(out_file)
+
+
+def _load_in_mask(files, mask):
+    images = [nb.load(fn) for fn in files]
+    stacked = np.empty((len(images), mask.sum()))
+
+    for i, image in enumerate(images):
+        stacked[i] = image.get_data()[mask]
+
+    return images, stacked
+
+
+def _save_in_mask(values, mask, image, out_file):
+    data = np.zeros(mask.shape, dtype=np.float32)
+    data[mask] = values
+    return save_like(data, image, out_file)
+
+
+def fdr_adjust_images(p_values, mask, out_files, q=0.05, method='bh',
+                      from_z=False):
+    """ FDR-adjust a list of p-value images within `mask` in one batch.
+
+    Only in-mask voxels are sorted. Voxels outside the mask are 0 in the
+    adjusted images, like the output of `fdr -a`. With from_z=True the
+    images are z-stats and are converted to p-values in memory. Returns the
+    p-value threshold for every image."""
+
+    mask = load_mask(mask)
+
+    images, stacked = _load_in_mask(p_values, mask)
+
+    if from_z:
+        stacked = z_to_p(stacked)
+
+    adjusted = fdr_adjust(stacked, method=method)
+
+    for image, values, out_file in zip(images, adjusted, out_files):
+        _save_in_mask(values, mask, image, out_file)
+
+    return fdr_p_threshold(stacked, adjusted, q).tolist()
+
+
+def fdr_threshold_images(z_stats, p_values, mask, thresholded_files,
+                         adjusted_files, q=0.05, method='bh'):
+    """ Single-pass version of fdr -> fslmaths -uthr -> fslmaths -mas.
+
+    Every z-map and p-map is read once. If `p_values` is None they are
+    computed from the z-maps. Only the thresholded z-maps and the adjusted
+    p-maps are written. Returns the p-value threshold for every image."""
+
+    if p_values is not None and len(z_stats) != len(p_values):
+        raise ValueError('Got %d z-stat images but %d p-value images' %
+                         (len(z_stats), len(p_values)))
+
+    mask = load_mask(mask)
+
+    z_images, z_stacked = _load_in_mask(z_stats, mask)
+
+    if p_values is None:
+        p_stacked = z_to_p(z_stacked)
+    else:
+        _, p_stacked = _load_in_mask(p_values, mask)
+
+    adjusted = fdr_adjust(p_stacked, method=method)
+
+    # Unlike the three-node chain, voxels whose p-value underflowed to 0
+    # are kept
+    z_stacked[adjusted > q] = 0
+
+    for image, values, out_file in zip(z_images, z_stacked, thresholded_files):
+        _save_in_mask(values, mask, image, out_file)
+
+    for image, values, out_file in zip(z_images, adjusted, adjusted_files):
+        _save_in_mask(values, mask, image, out_file)
+
+    return fdr_p_threshold(p_stacked, adjusted, q).tolist()
@@ -0,0 +1,61 @@
+import json
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+
+from gilles_workflows import alignment
+
+
+def _image(tmpdir):
+    data = ndimage.gaussian_filter(np.random.RandomState(0).uniform(0, 1, size=(30, 30, 30)), 2)
+    data[data < np.percentile(data, 20)] = 0
+    fn = str(tmpdir.join('image.nii.gz'))
+    nb.save(nb.Nifti1Image(data * 1000, np.diag([2., 2., 2., 1.])), fn)
+    return fn
+
+
+def _shift(mm):
+    matrix = np.eye(4)
+    matrix[0, 3] = mm
+    return matrix
+
+
+def test_is_local_optimum(tmpdir):
+    image = _image(tmpdir)
+
+    good, quality = alignment.is_local_optimum(image, image, np.eye(4), step=2)
+    assert good
+    assert quality > alignment.alignment_quality(image, image, _shift(6.), step=2)
+
+    assert not alignment.is_local_optimum(image, image, _shift(4.), step=2)[0]
+
+
+def test_quality_floor(tmpdir):
+    image = _image(tmpdir)
+    flirt_quality = alignment.alignment_quality(image, image, np.eye(4))
+
+    assert alignment.passes_quality_floor(flirt_quality, flirt_quality)
+    assert not alignment.passes_quality_floor(alignment.alignment_quality(image, image, _shift(10.)),
+                                              flirt_quality)
+    assert not alignment.passes_quality_floor(flirt_quality, None)
+
+
+def test_init_epi2anat_seed(tmpdir, monkeypatch):
+    monkeypatch.setenv('GILLES_WORKFLOWS_CACHE_DIR', str(tmpdir.join('cache')))
+
+    image = _image(tmpdir)
+    seed = str(tmpdir.join('seed.mat'))
+    np.savetxt(seed, np.eye(4))
+
+    # As stored by an earlier FLIRT search that produced the seed
+    with open(seed + '.json', 'w') as f:
+        json.dump({'nmi': alignment.alignment_quality(image, image, seed)}, f)
+    assert alignment.flirt_quality(seed) is not None
+
+    matrix_file, used_seed, seconds_saved = alignment.init_epi2anat(image, image, seed)
+
+    assert matrix_file == seed
+    assert used_seed
+    # No FLIRT search was timed yet
+    assert np.isnan(seconds_saved)
@@ -0,0 +1,57 @@
+import os
+
+from gilles_workflows.cache import ResultCache
+
+
+def _write(fn, content):
+    with open(fn, 'w') as f:
+        f.write(content)
+    return str(fn)
+
+
+def test_put_restore_renamed(tmpdir):
+    cache = ResultCache(str(tmpdir.mkdir('cache')))
+    in_file = _write(tmpdir.join('in.txt'), 'input')
+    out_file = _write(tmpdir.join('sub01_seg.txt'), 'output')
+
+    key = cache.key([in_file], {'parameter': 1})
+    cache.put(key, [out_file], names=['cached_seg.txt'])
+
+    assert cache.key([in_file], {'parameter': 1}) == key
+    assert cache.key([in_file], {'parameter': 2}) != key
+
+    restored = cache.restore(key, str(tmpdir.mkdir('restored')))
+    assert [os.path.basename(fn) for fn in restored] == ['cached_seg.txt']
+    assert open(restored[0]).read() == 'output'
+
+
+def test_miss(tmpdir):
+    cache = ResultCache(str(tmpdir))
+    assert cache.get('0' * 40) is None
+    assert cache.restore('0' * 40, str(tmpdir)) is None
+
+
+def test_prune_evicts_least_recently_used(tmpdir):
+    cache = ResultCache(str(tmpdir.mkdir('cache')), max_size_gb=250 / 1024. ** 3)
+    keys = []
+
+    for i in range(3):
+        fn = _write(tmpdir.join('out%d.txt' % i), 'x' * 100)
+        keys.append(cache.key([], {'i': i}))
+        cache.put(keys[-1], [fn])
+
+    # Only the latest entry fits
+    assert [entry['key'] for entry in cache.entries()] == keys[-1:]
+
+
+def test_key_parameters(tmpdir):
+    import numpy as np
+    import pytest
+
+    cache = ResultCache(str(tmpdir))
+
+    assert cache.key([], {'contrast': np.array([1., -1.]), 'runs': set([2, 1])}) == \
+        cache.key([], {'contrast': [1., -1.], 'runs': [1, 2]})
+
+    with pytest.raises(TypeError):
+        cache.key([], {'parameter': object()})
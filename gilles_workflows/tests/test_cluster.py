@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import nibabel as nb
+from numpy.testing import assert_allclose, assert_array_equal
+
+from gilles_workflows.cache import ResultCache
+from gilles_workflows.cluster import label_clusters, cluster_table, local_maxima, cluster_image
+
+
+def _volume():
+    data = np.zeros((8, 8, 8))
+    data[1:3, 1:3, 1:3] = 3.       # 8 voxels
+    data[2, 2, 2] = 5.
+    data[6, 6, 6] = 4.             # 1 voxel
+    return data
+
+
+def test_label_clusters_fsl_order():
+    labels, sizes = label_clusters(_volume(), 2.)
+
+    # FSL numbers clusters by increasing size
+    assert_array_equal(sizes, [1, 8])
+    assert labels[6, 6, 6] == 1
+    assert labels[1, 1, 1] == 2
+
+
+def test_connectivity():
+    data = np.zeros((4, 4, 4))
+    data[1, 1, 1] = data[2, 2, 2] = 3.
+
+    assert len(label_clusters(data, 2., 26)[1]) == 1
+    assert len(label_clusters(data, 2., 6)[1]) == 2
+
+
+def test_cluster_table():
+    data = _volume()
+    labels, sizes = label_clusters(data, 2.)
+
+    table = cluster_table(data, labels, sizes)
+
+    # Largest first: index, voxels, max, max position, centre of gravity
+    assert_allclose(table[0], [2, 8, 5, 2, 2, 2, 1.5, 1.5, 1.5])
+    assert_allclose(table[1], [1, 1, 4, 6, 6, 6, 6, 6, 6])
+
+
+def test_local_maxima():
+    data = _volume()
+    labels, _ = label_clusters(data, 2.)
+
+    assert [row[:2] for row in local_maxima(data, labels)] == [(2, 5.), (1, 4.)]
+
+
+def _save(data, fn):
+    nb.save(nb.Nifti1Image(np.asarray(data, dtype=np.float32), np.eye(4)), str(fn))
+    return str(fn)
+
+
+def test_cluster_image(tmpdir):
+    in_file = _save(_volume(), tmpdir.join('zstat1.nii.gz'))
+
+    results = cluster_image(in_file, [2., 4.5], out_dir=str(tmpdir), cache_dir=str(tmpdir.join('cache')))
+
+    assert [os.path.basename(fn) for fn in results[0]] == ['zstat1_thresh2_index.nii.gz',
+                                                          'zstat1_thresh2_localmax.txt',
+                                                          'zstat1_thresh2_table.txt']
+    assert nb.load(results[0][0]).get_data().max() == 2
+    assert nb.load(results[1][0]).get_data().max() == 1
+
+
+def test_cluster_image_same_content_other_name(tmpdir):
+    # Empty thresholded maps of different contrasts share a cache entry
+    cache_dir = str(tmpdir.join('cache'))
+    first = _save(np.zeros((4, 4, 4)), tmpdir.join('zstat1.nii.gz'))
+    second = _save(np.zeros((4, 4, 4)), tmpdir.join('zstat2.nii.gz'))
+
+    cluster_image(first, out_dir=str(tmpdir), cache_dir=cache_dir)
+    results = cluster_image(second, out_dir=str(tmpdir.mkdir('second')), cache_dir=cache_dir)
+
+    assert all(os.path.isfile(fn) for fn in results[0])
+    assert os.path.basename(results[0][0]) == 'zstat2_thresh2_index.nii.gz'
+    assert open(results[0][2]).read().count('\n') == 1
+    assert len(ResultCache(cache_dir).entries()) == 1
+
+
+def test_cluster_image_without_cache(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    in_file = _save(_volume(), tmpdir.join('zstat1.nii.gz'))
+
+    results = cluster_image(in_file, out_dir=str(tmpdir), cache_dir=cache_dir, use_cache=False)
+
+    assert all(os.path.isfile(fn) for fn in results[0])
+    assert not os.path.exists(cache_dir)
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from gilles_workflows.design import (check_design_options, double_gamma, highpass_matrix,
+                                     level1_design, contrast_matrix, condition_name,
+                                     read_events, event_regressor)
+
+
+def test_double_gamma_peak():
+    t = np.arange(0, 32, 0.01)
+    assert abs(t[np.argmax(double_gamma(t))] - 5) < 0.01
+
+
+def test_highpass_removes_linear_trends():
+    # A running line filter leaves lines untouched, so the high-pass
+    # removes them completely
+    highpass = highpass_matrix(100, 2., 32.)
+    t = np.arange(100.)
+
+    assert_allclose(highpass.dot(3 + 0.5 * t), 0, atol=1e-8)
+
+
+def test_highpass_keeps_fast_signals():
+    highpass = highpass_matrix(200, 2., 32.)
+    signal = np.sin(np.arange(200) * np.pi / 2)
+
+    assert_allclose(highpass.dot(signal)[20:-20], signal[20:-20], atol=0.05)
+
+
+def test_no_highpass():
+    assert_allclose(highpass_matrix(10, 2., 0), np.eye(10))
+
+
+def test_check_design_options():
+    t_contrast = ('task', 'T', ['task'], [1])
+    check_design_options({'dgamma': {'derivs': True}}, [t_contrast])
+
+    with pytest.raises(ValueError):
+        check_design_options({'gamma': {}}, [t_contrast])
+    with pytest.raises(ValueError):
+        check_design_options({'dgamma': {'derivs': True, 'tempderiv': 1}}, [t_contrast])
+    with pytest.raises(ValueError):
+        check_design_options(None, [t_contrast, ('all', 'F', [t_contrast])])
+    with pytest.raises(ValueError):
+        check_design_options(None, [('task', 'T', ['task'], [1], [1, 0])])
+
+
+def test_level1_design(tmpdir):
+    event_file = str(tmpdir.join('task.txt'))
+    np.savetxt(event_file, [[10, 5, 1], [60, 5, 1]])
+
+    design, names, real_columns = level1_design([event_file], 50, 2., 0, cache_dir=str(tmpdir))
+
+    assert names == ['task', 'task_derivative']
+    assert real_columns == [0]
+    assert_allclose(design.mean(0), 0, atol=1e-10)
+
+    # The response to the first event peaks about 5 s after its middle
+    assert abs(np.argmax(design[:30, 0]) * 2. - 17.5) <= 2
+
+    assert_allclose(contrast_matrix([('task', 'T', ['task'], [1])], names, real_columns), [[1, 0]])
+
+
+def test_read_events(tmpdir):
+    one_column = str(tmpdir.join('one.txt'))
+    np.savetxt(one_column, [[10], [20]])
+    two_columns = str(tmpdir.join('two.txt'))
+    np.savetxt(two_columns, [[10, 4], [20, 4]])
+    empty = str(tmpdir.join('empty.txt'))
+    open(empty, 'w').close()
+
+    # Missing durations are sticks, missing weights 1, as in SpecifyModel
+    assert_allclose(read_events(one_column), [[10, 0, 1], [20, 0, 1]])
+    assert_allclose(read_events(two_columns), [[10, 4, 1], [20, 4, 1]])
+    assert read_events(empty).shape == (0, 3)
+
+    # A 4 s boxcar at 2 s TR is 2 volumes long
+    assert event_regressor(two_columns, 2., 20).sum() == 2 * 2 * 16
+
+
+def test_condition_name():
+    assert condition_name('/events/task.txt') == 'task'
+    assert condition_name('/events/task.run002.txt') == 'task'
+
+
+def test_level1_design_empty_condition(tmpdir):
+    task = str(tmpdir.join('task.run001.txt'))
+    np.savetxt(task, [[10], [60]])
+    empty = str(tmpdir.join('rest.run001.txt'))
+    open(empty, 'w').close()
+
+    design, names, real_columns = level1_design([task, empty], 50, 2., 0, cache_dir=str(tmpdir))
+
+    assert names == ['task', 'task_derivative']
+    assert design.shape == (50, 2)
+
+    contrasts = [('task', 'T', ['task'], [1]), ('task>rest', 'T', ['task', 'rest'], [1, -1])]
+    assert_allclose(contrast_matrix(contrasts, names, real_columns), [[1, 0], [1, 0]])
@@ -0,0 +1,80 @@
+import numpy as np
+from numpy.testing import assert_allclose
+
+from gilles_workflows.glm import t_to_z, ols, contrast_stats, ar1_coefficients, ar1_whiten, fit
+
+
+def _design(n=200):
+    x = np.sin(np.arange(n) / 5.)
+    return (x - x.mean())[:, np.newaxis]
+
+
+def test_ols_recovers_betas():
+    design = np.column_stack([_design()[:, 0], np.ones(200)])
+    data = design.dot([[2, -1], [5, 3]])
+
+    betas, residuals, sigma_squared, dof = ols(design, data)
+
+    assert_allclose(betas, [[2, -1], [5, 3]])
+    assert_allclose(residuals, 0, atol=1e-10)
+    assert dof == 198
+
+
+def test_contrast_stats_closed_form():
+    design = _design()
+    betas = np.array([[2., 3.]])
+    sigma_squared = np.array([1., 4.])
+
+    copes, varcopes = contrast_stats(design, betas, sigma_squared, np.array([[2.]]))
+
+    assert_allclose(copes, [[4, 6]])
+    assert_allclose(varcopes, 4 * sigma_squared[np.newaxis] / (design ** 2).sum())
+
+
+def test_t_to_z():
+    assert_allclose(t_to_z(np.array([0.]), 10), [0])
+    assert_allclose(t_to_z(np.array([-1.96, 1.96]), 1e7), [-1.96, 1.96], rtol=1e-5)
+
+    # Far in the tail z stays finite and ordered
+    z = t_to_z(np.array([20., 40.]), 100)
+    assert np.all(np.isfinite(z)) and z[1] > z[0] > 8
+
+
+def test_ar1():
+    rs = np.random.RandomState(0)
+    noise = np.zeros((20000, 1))
+    for t in range(1, len(noise)):
+        noise[t] = 0.5 * noise[t - 1] + rs.randn()
+
+    assert_allclose(ar1_coefficients(noise), [0.5], atol=0.02)
+    assert_allclose(ar1_coefficients(ar1_whiten(noise, 0.5)), [0], atol=0.02)
+
+
+def test_fit_prewhitened_matches_truth():
+    rs = np.random.RandomState(1)
+    design = _design()
+    data = design.dot([[1., 2., 3.]]) + 0.1 * rs.randn(200, 3)
+
+    copes, varcopes, _, _, dof = fit(design, np.array([[1.]]), data)
+
+    assert_allclose(copes, [[1, 2, 3]], atol=0.05)
+    assert np.all(varcopes > 0)
+    assert dof == 199
+
+
+def test_fit_identical_voxels():
+    rs = np.random.RandomState(2)
+    data = np.tile(_design() + 0.1 * rs.randn(200, 1), (1, 4))
+
+    copes, varcopes, _, _, _ = fit(_design(), np.array([[1.]]), data)
+
+    assert_allclose(copes, copes[:, :1].repeat(4, 1))
+    assert_allclose(varcopes, varcopes[:, :1].repeat(4, 1))
+
+
+def test_fit_empty_mask():
+    for prewhiten in [True, False]:
+        copes, varcopes, betas, sigma_squared, _ = fit(_design(), np.array([[1.]]),
+                                                       np.zeros((200, 0)), prewhiten)
+        assert copes.shape == varcopes.shape == (1, 0)
+        assert betas.shape == (1, 0)
@@ -0,0 +1,92 @@
+import os
+import shutil
+
+import pytest
+
+from gilles_workflows import graphs
+
+
+def double(x):
+    return 2 * x
+
+
+def _fanout(subjects, base_dir):
+    import nipype.pipeline.engine as pe
+    import nipype.interfaces.utility as util
+
+    workflow = pe.Workflow(name='fanout', base_dir=base_dir)
+
+    inputspec = pe.Node(util.IdentityInterface(fields=['x']), name='inputspec')
+    inputspec.iterables = ('x', subjects)
+
+    nested = pe.Workflow(name='nested')
+    first = pe.Node(util.Function(function=double, input_names=['x'], output_names=['y']), name='first')
+    second = pe.Node(util.Function(function=double, input_names=['x'], output_names=['y']), name='second')
+    nested.connect(first, 'y', second, 'x')
+
+    workflow.connect(inputspec, 'x', nested, 'first.x')
+    return workflow
+
+
+def test_load_expanded_graph(tmpdir):
+    graph_dir = str(tmpdir.join('graphs'))
+
+    execgraph, loaded = graphs.load_expanded_graph(_fanout([1, 2, 3], str(tmpdir)), graph_dir)
+    assert not loaded
+    assert len(execgraph.nodes()) == 6
+    assert os.stat(graph_dir).st_mode & 0o077 == 0
+
+    execgraph, loaded = graphs.load_expanded_graph(_fanout([1, 2, 3], str(tmpdir)), graph_dir)
+    assert loaded
+    assert len(execgraph.nodes()) == 6
+
+    execgraph, loaded = graphs.load_expanded_graph(_fanout([1, 2], str(tmpdir)), graph_dir)
+    assert not loaded
+    assert len(execgraph.nodes()) == 4
+
+
+def test_shared_graph_dir(tmpdir):
+    graph_dir = tmpdir.mkdir('graphs')
+    graph_dir.chmod(0o777)
+
+    with pytest.raises(IOError):
+        graphs.load_expanded_graph(_fanout([1], str(tmpdir)), str(graph_dir))
+
+
+def _results(execgraph):
+    return sorted((node.fullname, node.result.outputs.y) for node in execgraph.nodes())
+
+
+def test_run_workflow(tmpdir):
+    from nipype.pipeline.engine import workflows
+
+    expected = _results(_fanout([1, 2, 3], str(tmpdir.mkdir('run'))).run())
+    assert [y for _, y in expected if _.endswith('second')] == [4, 8, 12]
+
+    base_dir = str(tmpdir.mkdir('run_workflow'))
+    graph_dir = str(tmpdir.join('graphs'))
+    generate_expanded_graph = workflows.generate_expanded_graph
+
+    results = []
+    for _ in range(2):
+        execgraph = graphs.run_workflow(_fanout([1, 2, 3], base_dir), plugin='Linear', graph_dir=graph_dir)
+        results.append(_results(execgraph))
+        # Start over, so the second run executes the loaded graph rather
+        # than collecting the results of the first
+        shutil.rmtree(os.path.join(base_dir, 'fanout'))
+
+    assert graphs.load_expanded_graph(_fanout([1, 2, 3], base_dir), graph_dir)[1]
+    assert results == [expected, expected]
+    assert workflows.generate_expanded_graph is generate_expanded_graph
+
+
+def test_key_resources_and_plugin(tmpdir):
+    from gilles_workflows.scheduling import set_node_resources
+
+    workflow = _fanout([1], str(tmpdir))
+    key = graphs.workflow_key(workflow)
+
+    assert graphs.workflow_key(workflow, plugin='MultiProc', plugin_args={'n_procs': 2}) != key
+
+    set_node_resources(workflow.get_node('nested.first'), 4., 2)
+    assert graphs.workflow_key(workflow) != key
@@ -0,0 +1,211 @@
+import os
+
+import numpy as np
+import nibabel as nb
+from numpy.testing import assert_allclose
+
+from gilles_workflows.group import (fixed_effects, fixed_effects_images, mixed_effects,
+                                    IncrementalGroupModel, split_mask, assemble_chunks)
+
+
+def _save(data, fn):
+    nb.save(nb.Nifti1Image(np.asarray(data, dtype=np.float32), np.eye(4)), str(fn))
+    return str(fn)
+
+
+def _runs(tmpdir, copes, varcopes):
+    cope_files = [_save(c, tmpdir.join('cope%d.nii.gz' % i)) for i, c in enumerate(copes)]
+    varcope_files = [_save(v, tmpdir.join('varcope%d.nii.gz' % i)) for i, v in enumerate(varcopes)]
+    return cope_files, varcope_files
+
+
+def test_fixed_effects_closed_form(tmpdir):
+    rs = np.random.RandomState(0)
+    copes = rs.randn(3, 4, 4, 2)
+    varcopes = rs.uniform(0.5, 2, (3, 4, 4, 2))
+    mask = np.ones((4, 4, 2), dtype=bool)
+
+    cope, varcope = fixed_effects(*(_runs(tmpdir, copes, varcopes) + (mask,)))
+
+    weights = 1. / varcopes
+    assert_allclose(cope, ((weights * copes).sum(0) / weights.sum(0))[mask], rtol=1e-5)
+    assert_allclose(varcope, (1. / weights.sum(0))[mask], rtol=1e-5)
+
+
+def test_fixed_effects_identical_runs(tmpdir):
+    copes = np.full((2, 2, 2, 2), 3.)
+    varcopes = np.full((2, 2, 2, 2), 4.)
+    mask = np.ones((2, 2, 2), dtype=bool)
+
+    cope, varcope = fixed_effects(*(_runs(tmpdir, copes, varcopes) + (mask,)))
+
+    assert_allclose(cope, 3)
+    assert_allclose(varcope, 2)
+
+
+def test_fixed_effects_zero_varcope(tmpdir):
+    copes = np.ones((2, 2, 2, 2))
+    varcopes = np.ones((2, 2, 2, 2))
+    varcopes[1, 0, 0, 0] = 0
+    mask = np.ones((2, 2, 2), dtype=bool)
+
+    cope, varcope = fixed_effects(*(_runs(tmpdir, copes, varcopes) + (mask,)))
+
+    assert cope[0] == 0 and varcope[0] == 0
+    assert_allclose(cope[1:], 1)
+
+
+def test_fixed_effects_images(tmpdir):
+    copes = np.full((2, 2, 2, 2), 2.)
+    varcopes = np.full((2, 2, 2, 2), 2.)
+    cope_files, varcope_files = _runs(tmpdir, copes, varcopes)
+    mask = _save(np.ones((2, 2, 2)), tmpdir.join('mask.nii.gz'))
+
+    dof_files = []
+    for i in range(2):
+        dof_files.append(str(tmpdir.join('dof%d' % i)))
+        np.savetxt(dof_files[-1], [50])
+
+    outputs = fixed_effects_images([cope_files], [varcope_files], dof_files, mask, str(tmpdir))
+
+    assert_allclose(nb.load(outputs['copes'][0]).get_data(), 2)
+    assert_allclose(nb.load(outputs['varcopes'][0]).get_data(), 1)
+    assert_allclose(nb.load(outputs['tdof'][0]).get_data(), 100)
+    assert np.all(nb.load(outputs['zstats'][0]).get_data() > 1.9)
+
+
+def test_fixed_effects_images_empty_mask(tmpdir):
+    cope_files, varcope_files = _runs(tmpdir, np.ones((2, 2, 2, 2)), np.ones((2, 2, 2, 2)))
+    mask = _save(np.zeros((2, 2, 2)), tmpdir.join('mask.nii.gz'))
+    dof_file = str(tmpdir.join('dof'))
+    np.savetxt(dof_file, [50])
+
+    outputs = fixed_effects_images([cope_files], [varcope_files], [dof_file] * 2, mask, str(tmpdir))
+
+    assert os.path.exists(outputs['zstats'][0])
+    assert_allclose(nb.load(outputs['copes'][0]).get_data(), 0)
+
+
+def test_mixed_effects_equal_variances():
+    # With equal within-subject variances the REML estimate of the total
+    # variance is the sample variance
+    rs = np.random.RandomState(1)
+    copes = rs.randn(20, 5) * 2 + 1
+    varcopes = np.full((20, 5), 0.5)
+
+    cope, varcope, sigma_squared, _ = mixed_effects(copes, varcopes, tol=1e-10, max_iter=200)
+
+    assert_allclose(cope, copes.mean(0))
+    assert_allclose(sigma_squared, copes.var(0, ddof=1) - 0.5, rtol=1e-6)
+    assert_allclose(varcope, copes.var(0, ddof=1) / 20, rtol=1e-6)
+
+
+def test_mixed_effects_identical_subjects():
+    cope, varcope, sigma_squared, _ = mixed_effects(np.full((10, 3), 2.), np.full((10, 3), 1.))
+
+    assert_allclose(cope, 2)
+    assert_allclose(sigma_squared, 0)
+    assert_allclose(varcope, 0.1)
+
+
+def _subjects(tmpdir, n, shape=(3, 3, 2)):
+    rs = np.random.RandomState(2)
+    copes = [_save(rs.randn(*shape), tmpdir.join('cope%d.nii.gz' % i)) for i in range(n)]
+    varcopes = [_save(rs.uniform(0.5, 1, shape), tmpdir.join('varcope%d.nii.gz' % i))
+                for i in range(n)]
+    return copes, varcopes
+
+
+def _result(model):
+    return np.load(model._path('result.npz'))['cope']
+
+
+def test_incremental_matches_full(tmpdir):
+    copes, varcopes = _subjects(tmpdir, 6)
+    mask = _save(np.ones((3, 3, 2)), tmpdir.join('mask.nii.gz'))
+
+    incremental = IncrementalGroupModel(str(tmpdir.join('incremental')))
+    assert incremental.update(copes[:4], varcopes[:4], mask) == (True, 4)
+    assert incremental.update(copes, varcopes, mask) == (True, 2)
+    assert incremental.update(copes, varcopes, mask) == (False, 0)
+
+    full = IncrementalGroupModel(str(tmpdir.join('full')))
+    full.update(copes, varcopes, mask)
+
+    assert_allclose(_result(incremental), _result(full), rtol=1e-5)
+
+    # Removing a subject rebuilds
+    assert incremental.update(copes[1:], varcopes[1:], mask) == (True, 5)
+
+
+def test_incremental_interrupted_update(tmpdir):
+    copes, varcopes = _subjects(tmpdir, 4)
+    mask = _save(np.ones((3, 3, 2)), tmpdir.join('mask.nii.gz'))
+
+    model = IncrementalGroupModel(str(tmpdir.join('state')))
+    model.update(copes[:3], varcopes[:3], mask)
+
+    # An update that appended its rows but died before the subject list
+    # was written
+    model._append('copes.dat', np.ones((1, 18)))
+    model._append('varcopes.dat', np.ones((1, 18)))
+
+    assert model.update(copes, varcopes, mask) == (True, 1)
+    assert os.path.getsize(model._path('copes.dat')) == 8 * 4 * 18
+
+    full = IncrementalGroupModel(str(tmpdir.join('full')))
+    full.update(copes, varcopes, mask)
+    assert_allclose(_result(model), _result(full), rtol=1e-5)
+
+
+def test_incremental_empty_mask(tmpdir):
+    copes, varcopes = _subjects(tmpdir, 3)
+    mask = _save(np.zeros((3, 3, 2)), tmpdir.join('mask.nii.gz'))
+
+    model = IncrementalGroupModel(str(tmpdir.join('state')))
+    model.update(copes, varcopes, mask)
+    outputs = model.write_results(mask, str(tmpdir))
+
+    assert_allclose(nb.load(outputs['zstat']).get_data(), 0)
+
+
+def test_split_mask(tmpdir):
+    mask = np.zeros((4, 4, 5))
+    mask[1:3, 1:4, :] = 1
+    mask_file = _save(mask, tmpdir.join('mask.nii.gz'))
+
+    chunks = [nb.load(fn).get_data() > 0 for fn in split_mask(mask_file, 4, str(tmpdir))]
+
+    assert len(chunks) == 4
+    assert_allclose(sum(chunk.astype(int) for chunk in chunks), mask)
+    assert max(chunk.sum() for chunk in chunks) - min(chunk.sum() for chunk in chunks) <= 1
+
+
+def test_assemble_chunks(tmpdir):
+    rs = np.random.RandomState(3)
+    mask = np.ones((4, 4, 5))
+    mask[0] = 0
+    mask_file = _save(mask, tmpdir.join('mask.nii.gz'))
+    chunk_masks = split_mask(mask_file, 3, str(tmpdir))
+
+    # Values outside a chunk's own mask must not leak into the result
+    truth = rs.randn(4, 4, 5) * mask
+    results = []
+    for i, fn in enumerate(chunk_masks):
+        chunk = nb.load(fn).get_data() > 0
+        results.append(_save(np.where(chunk, truth, 100 + i), tmpdir.join('zstat_chunk%d.nii.gz' % i)))
+
+    assembled = assemble_chunks(results, chunk_masks, str(tmpdir.join('zstat1.nii.gz')))
+
+    assert_allclose(nb.load(assembled).get_data(), truth, rtol=1e-6)
+
+
+def test_split_mask_empty(tmpdir):
+    mask_file = _save(np.zeros((2, 2, 2)), tmpdir.join('mask.nii.gz'))
+    chunk_masks = split_mask(mask_file, 4, str(tmpdir))
+
+    assert len(chunk_masks) == 1
+
+    result = _save(np.ones((2, 2, 2)), tmpdir.join('zstat.nii.gz'))
+    assembled = assemble_chunks([result], chunk_masks, str(tmpdir.join('zstat1.nii.gz')))
+    assert_allclose(nb.load(assembled).get_data(), 0)
@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip('nipype.workflows.fmri.fsl')
+
+from gilles_workflows import model
+
+
+def _fdr_nodes(workflow):
+    fdr_workflow = workflow.get_node('fdr_threshold')
+    return dict((name, fdr_workflow.get_node(name)) for name in ['ztop', 'fdr'])
+
+
+@pytest.mark.parametrize('factory', [model.create_modelfit_workflow_bfsl,
+                                     model.create_random_effects_workflow])
+def test_factories_fdr_engine(factory):
+    from gilles_workflows.interfaces import NumpyFDR
+
+    nodes = _fdr_nodes(factory())
+    assert nodes['ztop'] is None
+    assert isinstance(nodes['fdr'].interface, NumpyFDR)
+
+    nodes = _fdr_nodes(factory(fdr_engine='fsl'))
+    assert nodes['ztop'].nested
+    assert nodes['ztop'].interface.inputs.op_string == '-ztop'
+
+
+def test_fdr_threshold_workflow():
+    workflow = model.create_fdr_threshold_workflow(p_from_z=True, fused=True)
+    assert workflow.get_node('fdr_thresholder') is not None
+    assert workflow.get_node('ztop') is None
+
+    with pytest.raises(ValueError):
+        model.create_fdr_threshold_workflow(engine='fsl', fused=True)
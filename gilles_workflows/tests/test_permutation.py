@@ -0,0 +1,112 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+from scipy import ndimage
+
+from gilles_workflows.permutation import sign_flips, one_sample_t, cluster_masses, permutation_test
+
+
+def test_sign_flips_exhaustive():
+    flips = np.vstack(sign_flips(3, 100, batch_size=3))
+
+    assert flips.shape == (8, 3)
+    assert len(set(map(tuple, flips))) == 8
+    assert_array_equal(flips[0], 1)
+
+
+def test_sign_flips_random():
+    batches = sign_flips(20, 250, seed=3)
+
+    assert [len(batch) for batch in batches] == [100, 100, 50]
+    assert_array_equal(batches[0][0], 1)
+    assert set(np.unique(np.vstack(batches))) == set([-1, 1])
+    assert_array_equal(np.vstack(batches), np.vstack(sign_flips(20, 250, seed=3)))
+
+
+def test_one_sample_t_closed_form():
+    data = np.random.RandomState(0).randn(10, 5) + 0.5
+
+    t = one_sample_t(np.ones((1, 10)), data)[0]
+
+    assert_allclose(t, data.mean(0) / (data.std(0, ddof=1) / np.sqrt(10)))
+
+
+def test_cluster_masses():
+    mask = np.ones((5, 5, 5), dtype=bool)
+    t = np.zeros((5, 5, 5))
+    t[1, 1, 1:3] = [4, 5]
+    t[4, 4, 4] = 3.5
+
+    labels, masses = cluster_masses(t[mask], mask, 3., ndimage.generate_binary_structure(3, 3))
+
+    assert labels.max() == 2
+    assert_allclose(sorted(masses), [0.5, 3])
+
+
+def test_exhaustive_p_value():
+    # With all subjects positive only the unflipped data reaches the
+    # observed t, so p = 1 / 2 ** n
+    data = np.array([[1.], [2.], [1.5], [3.]])
+    mask = np.ones((1, 1, 1), dtype=bool)
+
+    t, vox_corrp, _, n_done = permutation_test(data, mask, n_permutations=1000,
+                                               cluster_threshold=None)
+
+    assert n_done == 16
+    assert_allclose(vox_corrp, 1 - 1 / 16.)
+    assert_allclose(t, data.mean() / (data.std(ddof=1) / 2))
+
+
+def test_identical_subjects():
+    data = np.full((6, 4), 2.)
+    mask = np.zeros((2, 2, 2), dtype=bool)
+    mask[0] = True
+
+    t, vox_corrp, clusterm_corrp, _ = permutation_test(data, mask, cluster_threshold=3.)
+
+    assert np.all(np.isfinite(t)) and np.all(np.isfinite(vox_corrp))
+    assert np.all((clusterm_corrp >= 0) & (clusterm_corrp <= 1))
+
+
+def test_empty_mask():
+    mask = np.zeros((2, 2, 2), dtype=bool)
+
+    t, vox_corrp, clusterm_corrp, n_done = permutation_test(np.zeros((5, 0)), mask,
+                                                            n_permutations=10)
+
+    assert t.shape == vox_corrp.shape == clusterm_corrp.shape == (0,)
+
+
+def test_n_procs_does_not_change_results():
+    rs = np.random.RandomState(1)
+    mask = np.ones((4, 4, 4), dtype=bool)
+    data = rs.randn(12, 64) + 0.3
+
+    serial = permutation_test(data, mask, n_permutations=300, n_procs=1, seed=5)
+    parallel = permutation_test(data, mask, n_permutations=300, n_procs=2, seed=5)
+
+    for a, b in zip(serial, parallel):
+        assert_allclose(a, b)
+
+
+def _threads_in_worker(args):
+    data, mask = args
+    return permutation_test(data, mask, n_permutations=300, n_procs=3, seed=5)
+
+
+def test_threads_inside_daemonic_worker():
+    import multiprocessing
+
+    rs = np.random.RandomState(1)
+    mask = np.ones((4, 4, 4), dtype=bool)
+    data = rs.randn(12, 64) + 0.3
+
+    # As in a MultiProc worker, which cannot start processes
+    pool = multiprocessing.Pool(1)
+    try:
+        result = pool.map(_threads_in_worker, [(data, mask)])[0]
+    finally:
+        pool.close()
+        pool.join()
+
+    for a, b in zip(result, permutation_test(data, mask, n_permutations=300, seed=5)):
+        assert_allclose(a, b)
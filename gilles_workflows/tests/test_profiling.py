@@ -0,0 +1,21 @@
+import csv
+
+from gilles_workflows.profiling import COLUMNS, summarize
+
+
+def test_summarize(tmpdir):
+    fn = str(tmpdir.join('profile.csv'))
+    rows = [{'interface': 'fsl.FLAMEO', 'wall_time_s': 10, 'cpu_time_s': 9, 'peak_rss_gb': 2,
+             'input_bytes': 2 * 1024 ** 3, 'output_bytes': 1024 ** 3},
+            {'interface': 'fsl.FLAMEO', 'wall_time_s': 20, 'cpu_time_s': 19, 'peak_rss_gb': 3,
+             'input_bytes': 1024 ** 3, 'output_bytes': ''},
+            {'interface': 'fsl.Merge', 'wall_time_s': 5, 'cpu_time_s': 1, 'peak_rss_gb': 1,
+             'input_bytes': '', 'output_bytes': ''}]
+
+    with open(fn, 'w') as f:
+        writer = csv.DictWriter(f, COLUMNS, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    assert summarize(fn) == [('fsl.FLAMEO', 2, 30., 28., 3., 3., 1.),
+                             ('fsl.Merge', 1, 5., 1., 1., 0., 0.)]
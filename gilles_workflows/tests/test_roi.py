@@ -0,0 +1,123 @@
+import numpy as np
+import nibabel as nb
+import pytest
+from numpy.testing import assert_allclose
+
+from gilles_workflows import roi
+
+
+def _save(data, fn):
+    nb.save(nb.Nifti1Image(data, np.eye(4)), str(fn))
+    return str(fn)
+
+
+def _dense_weighted_mean(data, mask):
+    """ The baseline extracter: the whole run times the normalized mask. """
+    mask = mask / mask.sum()
+    return (data * mask[..., np.newaxis]).reshape((-1, data.shape[-1])).sum(0)
+
+
+@pytest.fixture
+def epi():
+    return np.random.RandomState(0).normal(100, 10, size=(6, 5, 4, 30))
+
+
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+def test_iter_volume_blocks(tmpdir, epi, extension):
+    image = nb.load(_save(epi, tmpdir.join('epi' + extension)))
+
+    # One volume is 6 * 5 * 4 * 16 bytes, so blocks of 3 volumes
+    blocks = list(roi.iter_volume_blocks(image, max_memory_mb=3 * 6 * 5 * 4 * 16 / 1024. ** 2))
+
+    assert [(start, stop) for start, stop, _ in blocks] == [(i, min(i + 3, 30)) for i in range(0, 30, 3)]
+    assert_allclose(np.hstack([block for _, _, block in blocks]),
+                    epi.reshape((-1, 30), order='F'))
+
+
+def test_weighted_mean_timecourse(tmpdir, epi):
+    mask = np.zeros(epi.shape[:3])
+    mask[1:4, 2:4, 1:3] = np.random.RandomState(1).uniform(0.2, 1, size=(3, 2, 2))
+
+    data = _save(epi, tmpdir.join('epi.nii.gz'))
+    mask_file = _save(mask, tmpdir.join('mask.nii.gz'))
+
+    assert_allclose(roi.weighted_mean_timecourse(data, mask_file, max_memory_mb=0.01),
+                    _dense_weighted_mean(epi, mask))
+
+
+def _rois(shape):
+    rois = np.zeros(shape + (3,))
+    rois[:3, :, :2, 0] = 1
+    rois[2:, 1:4, 1:, 1] = np.random.RandomState(2).uniform(0.1, 1, size=(4, 3, 3))
+    # The third ROI is empty
+    return rois
+
+
+def test_multi_roi_timecourses(tmpdir, epi):
+    rois = _rois(epi.shape[:3])
+    data = _save(epi, tmpdir.join('epi.nii.gz'))
+
+    timecourses = roi.roi_timecourses(data, _save(rois, tmpdir.join('rois.nii.gz')),
+                                      max_memory_mb=0.01)
+
+    assert timecourses.shape == (3, 30)
+    for i in range(2):
+        assert_allclose(timecourses[i], _dense_weighted_mean(epi, rois[..., i]))
+    assert np.isnan(timecourses[2]).all()
+
+
+def test_label_atlas_timecourses(tmpdir, epi):
+    labels = np.zeros(epi.shape[:3])
+    labels[:3] = 7
+    labels[3:, :2] = 2
+    labels[3:, 4] = 11
+
+    data = _save(epi, tmpdir.join('epi.nii.gz'))
+    atlas = _save(labels, tmpdir.join('atlas.nii.gz'))
+
+    timecourses = roi.roi_timecourses(data, atlas, label_atlas=True)
+
+    # In increasing label order
+    assert timecourses.shape == (3, 30)
+    for i, label in enumerate([2, 7, 11]):
+        assert_allclose(timecourses[i], _dense_weighted_mean(epi, (labels == label).astype(float)))
+
+
+def test_weighted_rois(tmpdir, epi):
+    rois = _rois(epi.shape[:3])[..., :2]
+    gray_matter = np.random.RandomState(3).uniform(0, 1, size=epi.shape[:3])
+
+    timecourses = roi.roi_timecourses(_save(epi, tmpdir.join('epi.nii.gz')),
+                                      _save(rois, tmpdir.join('rois.nii.gz')),
+                                      weights=_save(gray_matter, tmpdir.join('gm.nii.gz')))
+
+    for i in range(2):
+        assert_allclose(timecourses[i], _dense_weighted_mean(epi, rois[..., i] * gray_matter))
+
+
+def test_saved_roi_weights(tmpdir, epi):
+    rois = _rois(epi.shape[:3])
+    gray_matter = np.random.RandomState(4).uniform(0, 1, size=epi.shape[:3])
+
+    data = _save(epi, tmpdir.join('epi.nii.gz'))
+    roi_weights = roi.save_roi_weights(_save(rois, tmpdir.join('rois.nii.gz')),
+                                       str(tmpdir.join('roi_weights.npz')),
+                                       gray_matter=_save(gray_matter, tmpdir.join('gm.nii.gz')))
+
+    plain, weighted = roi.extract_roi_weights(data, roi_weights, max_memory_mb=0.01)
+
+    for i in range(2):
+        assert_allclose(plain[i], _dense_weighted_mean(epi, rois[..., i]))
+        assert_allclose(weighted[i], _dense_weighted_mean(epi, rois[..., i] * gray_matter))
+    assert np.isnan(plain[2]).all() and np.isnan(weighted[2]).all()
+
+
+def test_saved_roi_weights_single_mask(tmpdir, epi):
+    mask = np.zeros(epi.shape[:3])
+    mask[2:5, 1:3, :] = 1
+
+    roi_weights = roi.save_roi_weights(_save(mask, tmpdir.join('mask.nii.gz')),
+                                       str(tmpdir.join('roi_weights.npz')))
+
+    timecourses, = roi.extract_roi_weights(_save(epi, tmpdir.join('epi.nii.gz')), roi_weights)
+    assert_allclose(timecourses, [_dense_weighted_mean(epi, mask)])
@@ -0,0 +1,53 @@
+import csv
+
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as util
+
+from gilles_workflows import scheduling
+from gilles_workflows.interfaces import BatchApplyTransforms, SignFlipPermutation
+from gilles_workflows.profiling import COLUMNS, resource_profiles
+
+
+def _workflow(n_procs):
+    workflow = pe.Workflow(name='batch')
+    inputspec = pe.Node(util.IdentityInterface(fields=['in_files']), name='inputspec')
+    apply_transforms = pe.Node(BatchApplyTransforms(n_procs=n_procs), name='apply_transforms')
+    permutation = pe.Node(SignFlipPermutation(), name='permutation')
+    workflow.connect(inputspec, 'in_files', apply_transforms, 'input_images')
+    workflow.connect(inputspec, 'in_files', permutation, 'cope_files')
+    return workflow
+
+
+def test_tag_batch_nodes():
+    workflow = _workflow(4)
+    tagged = scheduling.tag_resources(workflow)
+
+    assert tagged['batch.apply_transforms'] == (4.0, 4)
+    assert tagged['batch.permutation'] == (1.0, 1)
+    assert 'batch.inputspec' not in tagged
+
+    node = workflow.get_node('apply_transforms')
+    assert node.n_procs == 4
+    assert node.inputs.n_procs == 4
+
+
+def test_tag_clips_batch_jobs():
+    workflow = _workflow(8)
+    tagged = scheduling.tag_resources(workflow, n_procs=2)
+
+    assert tagged['batch.apply_transforms'] == (8.0, 2)
+    assert workflow.get_node('apply_transforms').inputs.n_procs == 2
+
+
+def test_measured_profiles_per_job(tmpdir):
+    fn = str(tmpdir.join('profile.csv'))
+    rows = [{'interface': 'batch', 'wall_time_s': 10, 'cpu_time_s': 40, 'peak_rss_gb': 4, 'jobs': 4},
+            {'interface': 'single', 'wall_time_s': 10, 'cpu_time_s': 10, 'peak_rss_gb': 2, 'jobs': ''}]
+    with open(fn, 'w') as f:
+        writer = csv.DictWriter(f, COLUMNS, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    profiles = resource_profiles(fn, headroom=1.)
+    assert profiles['batch'] == (1., 1)
+    assert profiles['single'] == (2., 1)
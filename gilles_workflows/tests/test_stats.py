@@ -0,0 +1,61 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from gilles_workflows.stats import z_to_p, fdr_adjust, fdr_p_threshold
+
+
+def _bh_reference(p_values):
+    """ adjusted[i] = min over p[j] >= p[i] of p[j] * n / rank(j), as
+    computed by FSL's fdr -a. """
+    n = len(p_values)
+    order = np.argsort(p_values, kind='mergesort')
+    adjusted = np.empty(n)
+    for rank, i in enumerate(order):
+        adjusted[i] = min(1, min(p_values[j] * n / float(r + 1)
+                                 for r, j in enumerate(order) if r >= rank))
+    return adjusted
+
+
+def test_fdr_adjust_known_values():
+    # p.adjust(c(0.01, 0.04, 0.03, 0.2), 'BH') in R
+    assert_allclose(fdr_adjust([0.01, 0.04, 0.03, 0.2]),
+                    [0.04, 0.04 * 4 / 3., 0.04 * 4 / 3., 0.2])
+
+
+def test_fdr_adjust_matches_reference():
+    p_values = np.random.RandomState(0).uniform(0, 0.2, (3, 50))
+
+    adjusted = fdr_adjust(p_values)
+
+    for row, adjusted_row in zip(p_values, adjusted):
+        assert_allclose(adjusted_row, _bh_reference(row))
+
+
+def test_fdr_adjust_by_is_scaled_bh():
+    p_values = np.array([0.001, 0.01, 0.02, 0.5])
+    assert_allclose(fdr_adjust(p_values, 'by'),
+                    np.minimum(fdr_adjust(p_values) * np.sum(1. / np.arange(1, 5)), 1))
+
+
+def test_fdr_identical_p_values():
+    adjusted = fdr_adjust(np.full(10, 0.03))
+
+    assert_allclose(adjusted, 0.03)
+    assert_allclose(fdr_p_threshold(np.full(10, 0.03), adjusted, 0.05), [0.03])
+
+
+def test_fdr_empty_mask():
+    p_values = np.zeros((2, 0))
+    adjusted = fdr_adjust(p_values)
+
+    assert adjusted.shape == (2, 0)
+    assert_array_equal(fdr_p_threshold(p_values, adjusted, 0.05), [0, 0])
+
+
+def test_fdr_p_threshold_nothing_survives():
+    p_values = np.array([0.5, 0.6, 0.9])
+    assert_array_equal(fdr_p_threshold(p_values, fdr_adjust(p_values), 0.05), [0])
+
+
+def test_z_to_p():
+    assert_allclose(z_to_p([0, 1.6448536269514722]), [0.5, 0.05])
@@ -1,5 +1,202 @@
-def show_workflow(workflow):
-    from IPython.display import Image
-    import os
-    workflow.write_graph()
-    return Image(os.path.join(workflow.base_dir, workflow.name, 'graph.dot.png'))
+import os
+import hashlib
+import threading
+import subprocess
+
+
+def _node_id(node, ids):
+    """ Ids numbered in drawing order rather than from memory addresses,
+    so equal graphs give equal source (and hash). """
+    if id(node) not in ids:
+        ids[id(node)] = 'node%d' % len(ids)
+    return ids[id(node)]
+
+
+def _is_workflow(node):
+    return hasattr(node, '_graph') and hasattr(node, 'get_node')
+
+
+def all_nodes(workflow):
+    """ Every node of `workflow`, descending into nested workflows.
+    nipype only exposes the nodes and connections of an unexpanded
+    workflow through the private `_graph`; this module is the only one
+    that reads it. """
+    nodes = []
+    for node in workflow._graph.nodes():
+        if _is_workflow(node):
+            nodes += all_nodes(node)
+        else:
+            nodes.append(node)
+    return nodes
+
+
+def describe_workflow(workflow):
+    """ The nodes (interface, inputs, iterables, resources, ...) and connections of
+    `workflow` and its nested workflows, with nodes keyed by name and
+    connections sorted, so equal workflows give equal descriptions. """
+    from nipype.interfaces.base import isdefined
+
+    nodes = {}
+    for node in workflow._graph.nodes():
+        if _is_workflow(node):
+            nodes[node.name] = describe_workflow(node)
+            continue
+
+        interface = type(node.interface)
+        nodes[node.name] = {
+            'class': type(node).__name__,
+            'interface': '%s.%s' % (interface.__module__, interface.__name__),
+            'inputs': dict((name, value) for name, value in node.inputs.get().items() if isdefined(value)),
+            'config': node.config,
+            'iterables': node.iterables,
+            'synchronize': node.synchronize,
+            'itersource': node.itersource,
+            'iterfield': getattr(node, 'iterfield', None),
+            'joinsource': getattr(node, 'joinsource', None),
+            'joinfield': getattr(node, 'joinfield', None),
+            # Set by scheduling.tag_resources, on the node or (nipype < 1.0)
+            # the interface
+            'mem_gb': getattr(node, '_mem_gb', getattr(node.interface, 'estimated_memory_gb', None)),
+            'n_procs': getattr(node, '_n_procs', getattr(node.interface, 'num_threads', None)),
+        }
+
+    connections = sorted([[u.name, v.name, data['connect']] for u, v, data in workflow._graph.edges(data=True)],
+                         key=repr)
+
+    return {'nodes': nodes, 'connections': connections, 'config': workflow.config}
+
+
+def node_connections(workflow, node):
+    """ The (source, destination, [(field, field), ...]) connections of
+    `node` in `workflow`, incoming first, as `Workflow.connect` takes them. """
+    connections = [(u, v, data['connect']) for u, v, data in workflow._graph.in_edges(node, data=True)]
+    connections += [(u, v, data['connect']) for u, v, data in workflow._graph.out_edges(node, data=True)]
+    return connections
+
+
+def _endpoint(node, field, depth):
+    """ The node drawn for `node.field`, descending into nested workflows
+    that are expanded at this depth. """
+    if isinstance(field, tuple):
+        field = field[0]
+
+    while _is_workflow(node) and depth > 0 and '.' in field:
+        name, field = field.split('.', 1)
+        node, depth = node.get_node(name), depth - 1
+
+    return node
+
+
+def _dot_lines(workflow, depth, ids, indent='  '):
+    lines = []
+
+    for node in sorted(workflow._graph.nodes(), key=lambda node: node.name):
+        if _is_workflow(node) and depth > 0:
+            lines.append('%ssubgraph cluster_%s {' % (indent, _node_id(node, ids)))
+            lines.append('%s  label="%s";' % (indent, node.name))
+            lines += _dot_lines(node, depth - 1, ids, indent + '  ')
+            lines.append('%s}' % indent)
+        elif _is_workflow(node):
+            lines.append('%s%s [label="%s\\n(%d nodes)", shape=folder, style=filled, fillcolor=lightgrey];'
+                         % (indent, _node_id(node, ids), node.name, len(all_nodes(node))))
+        else:
+            shape = 'box3d' if node.__class__.__name__ == 'MapNode' else 'box'
+            lines.append('%s%s [label="%s\\n(%s)", shape=%s];'
+                         % (indent, _node_id(node, ids), node.name,
+                            node.interface.__class__.__name__, shape))
+
+    edges = set()
+    for u, v, data in workflow._graph.edges(data=True):
+        for source, destination in data['connect']:
+            edges.add((_node_id(_endpoint(u, source, depth), ids),
+                       _node_id(_endpoint(v, destination, depth), ids)))
+
+    lines += ['%s%s -> %s;' % (indent, u, v) for u, v in sorted(edges)]
+
+    return lines
+
+
+def workflow_dot(workflow, depth=1):
+    """ Graphviz source of `workflow`. Nested workflows deeper than
+    `depth` are drawn as one node, MapNodes as one node regardless of
+    their number of iterations. """
+    lines = ['digraph "%s" {' % workflow.name, '  compound=true;']
+    lines += _dot_lines(workflow, depth, {})
+    lines.append('}')
+
+    return '\n'.join(lines)
+
+
+def _run_dot(dot_file, out_file, fmt, timeout):
+    try:
+        process = subprocess.Popen(['dot', '-T%s' % fmt, '-o', out_file + '.tmp', dot_file],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        # Graphviz is not installed
+        return
+
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    try:
+        process.communicate()
+    finally:
+        timer.cancel()
+
+    if process.returncode == 0:
+        os.rename(out_file + '.tmp', out_file)
+    elif os.path.exists(out_file + '.tmp'):
+        os.remove(out_file + '.tmp')
+
+
+def render_workflow(workflow, depth=1, out_dir=None, fmt='png', timeout=60, wait=True):
+    """ Renders `workflow_dot(workflow, depth)` with Graphviz in a
+    separate process that is killed after `timeout` seconds.
+
+    Renders are cached in `out_dir` (default: the workflow's base_dir or
+    the current directory) by the hash of the graph source, so an
+    unchanged graph is not rendered again. With wait=False the call
+    returns at once and the file appears when Graphviz finishes. Returns
+    the path of the rendered file, or of the .dot file when rendering
+    failed or timed out. """
+    if out_dir is None:
+        out_dir = workflow.base_dir or os.getcwd()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    source = workflow_dot(workflow, depth)
+    stem = os.path.join(os.path.abspath(out_dir),
+                        '%s_graph_%s' % (workflow.name, hashlib.sha1(source.encode()).hexdigest()[:12]))
+    dot_file, out_file = stem + '.dot', '%s.%s' % (stem, fmt)
+
+    if os.path.exists(out_file):
+        return out_file
+
+    with open(dot_file, 'w') as f:
+        f.write(source)
+
+    if not wait:
+        thread = threading.Thread(target=_run_dot, args=(dot_file, out_file, fmt, timeout))
+        thread.daemon = True
+        thread.start()
+        return out_file
+
+    _run_dot(dot_file, out_file, fmt, timeout)
+
+    return out_file if os.path.exists(out_file) else dot_file
+
+
+def show_workflow(workflow, depth=1, out_dir=None, timeout=60, wait=True):
+    """ Renders the workflow graph (see `render_workflow`) and returns its
+    path. Works without IPython; in IPython the image is also displayed
+    when it is available right away (wait=True or an earlier render). """
+    out_file = render_workflow(workflow, depth, out_dir, 'png', timeout, wait)
+
+    try:
+        from IPython.display import Image, display
+    except ImportError:
+        return out_file
+
+    if out_file.endswith('.png') and os.path.exists(out_file):
+        display(Image(out_file))
+
+    return out_file